@@ -37,6 +37,8 @@ from vsc.utils import fancylogger
 from vsc.manage.config import get_options
 from vsc.manage.manage import Manager
 # after importing config
+import sys
+import time
 
 
 def main():
@@ -53,12 +55,17 @@ def main():
     if manager.status:
         print "Status:\n %s" % manager.status
 
-    #actually do requested commands
-    out = manager.doit()
+    #actually do requested commands, the output of every node is shown as soon as it is done
+    start = time.time()
+    out = manager.iterdoit()
     #parse and display the output
     errors = []
+    done = set()
     if out:
-        for i in out:  # this is an array of nodes and their  output,err
+        for position, i in enumerate(out):  # this is an array of nodes and their  output,err
+            if position:
+                # the first one is the output of the monitoring, a node can come back again f.ex. with --wait
+                done.add(i[0])
             if len(i) > 1 and len(i[1]) > 0:  # only print if something to show
                 print "%s:" % i[0]  # first element is the node
                 for j in i[1]:  # second element is an array of [outputs of commands,errors]
@@ -66,6 +73,8 @@ def main():
                     if j[1][1]:
                         print "    error:  %s" % str(j[1][1])
                         errors.append(i[0])
+                sys.stdout.flush()
+        print "Done: %s nodes in %.1f seconds, %s with errors" % (len(done), time.time() - start, len(set(errors)))
 
     # print all nodes with errors out on the end
     if len(errors) > 0:
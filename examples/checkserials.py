@@ -32,62 +32,36 @@ This module contains some example scripts that use manage to make some tasks eas
 '''
 
 import sys
-sys.path.append("../.")
-from manage import options, Manager
-from nodes import Node
-
-#usage: give a list of clusternames you want to check the serials from
-#also set the ENV in config to TESTING or SERVER
+import time
 
+# usage: give a list of clusternames you want to check the serials from
+# also set the ENV in config to TESTING or SERVER
 CLUSTERS = sys.argv[1:]
-SERIAL_XPATH = "/*/nlist[@name='hardware']/string[@name='serialnumber']"
+# the manage options are parsed from the command line, leave the clusternames out
+del sys.argv[1:]
+
+from vsc.manage.clusters import Cluster
+from vsc.manage.config import get_config
+
+SERIAL_COMMAND = "dmidecode -s system-serial-number"
+
 
 def checkSerials():
     """
     check all serials in all nodes on all clusters,
     compare the serials in quattor with the real serials reported by the machines
     """
-    #set options
-    opts = options() #default options object
-    opts.all_nodes = True
-    opts.verbose= 0
-    opts.forced = True
-    opts.runcmd = "dmidecode -s system-serial-number"
-
-    for cluster in CLUSTERS:
-        opts.cluster = cluster
-
-        #create manager
-        manager = Manager(opts)
-
-        #get serials from quattor
-        serials = {}
-        for  node in manager.nodes.getNodes():
-            serials[node.nodeid] = node._getQuattorElement(SERIAL_XPATH)
-        print serials
-
-        #get serials from nodes
-        out = manager.doit()
-
-        #parse output and compare
-        for nodeout in out:
-            if not isinstance(nodeout[0],Node):
-                continue #skip monitoring etc...
-
-            node = nodeout[0].nodeid
-            if nodeout[1] and len(nodeout[1]) > 0 and len(nodeout[1][0]) > 1:
-                serial = nodeout[1][0][1][0]
-                if nodeout[1][0][1][1]:
-                    print "error checking %s: %s"%(node,nodeout[1][0][1][1])
+    start = time.time()
+    for name in CLUSTERS:
+        cluster = Cluster.getCluster(name)
+        # all nodes with a quattor profile, the serials come from the profile index
+        for node, serial, reported, err in cluster.diffQuattorColumn(get_config("SERIAL_JSON"), SERIAL_COMMAND,
+                                                                      quattor=True):
+            if err:
+                print "error checking %s: %s" % (node, err)
             else:
-                serial = None
-
-            try:
-                if serials[node] != serial:
-                    print "serial for %s is incorrect in quattor:%s, reported by machine: %s"%(node,serials[node],serial)
-                #print node,serial,serials[node]
-            except (KeyError,AttributeError):
-                pass #master or icinga gets added my manager, ignore this.
+                print "serial for %s is incorrect in quattor: %s, reported by machine: %s" % (node, serial, reported)
+    print "checked %s in %.1f seconds" % (", ".join(CLUSTERS), time.time() - start)
 
 
 checkSerials()
@@ -35,11 +35,12 @@ To add real clusters extend this class in this file, and it will be automaticall
 """
 import platform
 import os
-import re
 from vsc.manage.nodes import CompositeNode, MasterNode, StorageNode, DracMasterNode, \
     CuboneWorkerNode, BladeWorkerNode, ImmMasterNode, ImmWorkerNode, \
-    IpmiWorkerNode, DMTFSMASHCLPIpmiWorkerNode, DMTFSMASHCLPIpmiMasterNode, BladeMasterNode
-from vsc.manage.managecommands import PBSStateCommand
+    IpmiWorkerNode, DMTFSMASHCLPIpmiWorkerNode, DMTFSMASHCLPIpmiMasterNode, BladeMasterNode, CHASSIS, BMC, \
+    DEADLINE_GRACE
+from vsc.manage.quattor import MASTER, STORAGE, WORKER, scan_profiles
+from vsc.manage.scheduler import TOTAL, get_worker_pool
 from vsc.manage.config import get_config
 from vsc.utils import fancylogger
 
@@ -50,7 +51,11 @@ class Cluster(object):
     A cluster has a list of nodes in it
     A real cluster should extend this class and at least set the self.masterNodeClass and workerNodeClass
     this class should be an extensions of the Node class
+    limits is a dict kind: limit with the maximum number of nodes using the same resource at the same time,
+    f.ex. {CHASSIS: 3, BMC: 1, TOTAL: 40} keeps fragile management modules from getting overloaded.
     """
+    limits = None
+
     def __init__(self):
         """
         constructor
@@ -65,6 +70,8 @@ class Cluster(object):
         self.storagenodes = None
         self.name = self.__class__.__name__
         self.master = None
+        # seconds the node states saved by an earlier run may be old to be used instead of asking a master
+        self.max_staleness = None
 
     def __str__(self):
         return str(self.__class__.__name__)
@@ -114,40 +121,21 @@ class Cluster(object):
             self.masters = masternodes
         return self.masters
 
-    def _getNodeIds(self, regex):
+    def _getNodeIds(self, role):
         """
-        returns a list of id's. based on a regex
-        this regex should have a named group id
-        and represents a file in the quattor dir
+        returns a sorted list of the id's of the hosts in this cluster with role (WORKER, MASTER or STORAGE),
+        from the names of the files in the quattor dir, all clusters are sorted out in one scan (see scan_profiles)
         """
         if not os.path.exists(get_config("QUATTOR_PATH")):
             self.log.raiseException("Path %s not found, is this not a quattor server?" % get_config("QUATTOR_PATH"),
                                     QuattorException)
-        filelistAll = os.listdir(get_config("QUATTOR_PATH"))
-        self.log.debug("matching files for regex %s" % regex.pattern)
-        nodenames = []
-        for filename in filelistAll:
-            # The compiled versions of the most recent patterns passed to re.match(), re.search() or re.compile() are
-            # cached so programs that use only a few regular expressions at a time needn't worry about compiling regular
-            # expressions.
-            m = regex.match(filename)
-            if m:
-                nodenames.append(m.group('id'))
-                self.log.debug("matched filename: %s" % filename)
-        # we might have doubles
-        nodenames = sorted(set(nodenames))
-        return nodenames
+        return scan_profiles(get_config("QUATTOR_PATH")).get(self.name, {}).get(role, [])
 
     def _getWorkerNodeIdsFromQuattor(self):
         """
         get a set of all node id's in this cluster, using the quattor dir naming
         """
-        # create regex from template
-        template = get_config("QUATTOR_FILES_TPL") % {"clustername": self.name,
-                                                      "nodeid": get_config("QUATTOR_NODEID_REGEX")}
-        regex = re.compile(template)
-
-        return self._getNodeIds(regex)
+        return self._getNodeIds(WORKER)
 
     def _getWorkerNodeIds(self, quattor=False):
         """
@@ -170,9 +158,7 @@ class Cluster(object):
         """
         return a set of all storage node id's in this cluster
         """
-        regex = re.compile(get_config("QUATTOR_FILES_TPL") % {'nodeid': get_config("QUATTOR_STORAGEID_REGEX"),
-                                                              'clustername': self.name})
-        nodenames = self._getNodeIds(regex)
+        nodenames = self._getNodeIds(STORAGE)
         self.log.debug("storage id's for %s: %s" % (self.name, str(nodenames)))
         return nodenames
 
@@ -180,9 +166,7 @@ class Cluster(object):
         """
         get a set of all master node ids in this cluster using the quattor dir
         """
-        regex = re.compile(get_config("QUATTOR_FILES_TPL") % {'nodeid': get_config("QUATTOR_MASTERID_REGEX"),
-                                                              'clustername': self.name})
-        nodenames = self._getNodeIds(regex)
+        nodenames = self._getNodeIds(MASTER)
         self.log.debug("master id's for %s: %s" % (self.name, str(nodenames)))
         return nodenames
 
@@ -215,6 +199,34 @@ class Cluster(object):
         """
         return self.workerNodeClass(nodeid, self.__class__.__name__, self.getMaster())
 
+    def getQuattorFields(self, jsonpaths=None, quattor=False):
+        """
+        returns a dict nodeid: fields with the given json paths (a dict name: json path) from the quattor profiles
+        of all worker nodes in this cluster, the fields in the profile index without jsonpaths
+        see CompositeNode.getQuattorFields
+        """
+        return self.getWorkerNodes(quattor=quattor).getQuattorFields(jsonpaths)
+
+    def getQuattorColumn(self, jsonpath, quattor=False):
+        """
+        returns a dict nodeid: value with the value at jsonpath from the quattor profiles of all worker nodes
+        in this cluster, see CompositeNode.getQuattorColumn
+        """
+        return self.getWorkerNodes(quattor=quattor).getQuattorColumn(jsonpath)
+
+    def diffQuattorColumn(self, jsonpath, command, quattor=False):
+        """
+        compares the value at jsonpath in the quattor profiles of all worker nodes in this cluster with the output
+        of command on them, see CompositeNode.diffQuattorColumn
+        """
+        return self.getWorkerNodes(quattor=quattor).diffQuattorColumn(jsonpath, command)
+
+    def getNodesInStates(self, states):
+        """
+        returns the worker nodes that are in any of the given pbs states, f.ex. [Node.DOWN, Node.OFFLINE]
+        """
+        return self.getWorkerNodes().getNodesInStates(states)
+
     def getDownNodes(self):
         """
         return a compositenode with all down worker nodes in it
@@ -237,7 +249,8 @@ class Cluster(object):
         """
         returns a master of this cluster
         This will first make sure the master is having a working pbs installation,
-        and try the next one if this fails
+        all masters are asked at the same time and the first one that answers is used (see _probeMasters).
+        With max_staleness set, node states saved by an earlier run are used instead, if there are recent ones.
         """
         # cache this function
         if self.master:
@@ -251,17 +264,54 @@ class Cluster(object):
         if not masters:
             raise ClusterException("Could not get masterNode for %s, check your quattor configuration" % self.name)
 
-        for master in masters:
-            # check if this master gives us a valid pbsnodes response
-            out, err = PBSStateCommand(master.hostname, get_config("COMMAND_FAST_TIMEOUT")).run()
-            if not err:
-                self.master = master
-                return master
+        if self.max_staleness:
+            max_age = min(self.max_staleness, float(get_config("PBS_CACHE_TTL")))
+            if masters[0].loadNodeStates(max_age):
+                self.log.info("using the node states of %s saved by an earlier run" % self.name)
+                self.master = masters[0]
+                return self.master
+
+        master = self._probeMasters(masters)
+        if master:
+            self.master = master
+            return master
         self.log.warning("Cound not get a working master for %s, make sure pbs is working on it, will conitinue without"
                          "working master" % self.name)
         self.master = masters[0]
         return masters[0]
 
+    def _probeMasters(self, masters):
+        """
+        run pbsnodes on all masters at the same time
+        returns the first master that gives a valid pbsnodes response, or None if none does.
+        This response is used as the state of the nodes of that master, so it is not asked for again.
+        """
+        executor = get_worker_pool()
+        probes = {}
+        for master in masters:
+            command = master.getProbeCommand()
+            probes[executor.submit(command.run)] = (master, command)
+        timeout = max([command.timeout for _, command in probes.values()]) + DEADLINE_GRACE
+        found = None
+        for task in executor.as_completed(probes.keys(), timeout=timeout):
+            master, command = probes.pop(task)
+            if not task.done or task.error:
+                self.log.warning("pbsnodes on %s did not answer: %s" % (master, task.error))
+                continue
+            out, err = task.result
+            if err:
+                self.log.warning("pbsnodes on %s failed: %s" % (master, err))
+                continue
+            self.log.debug("pbsnodes on %s answered first" % master)
+            master.setNodeStates(out)
+            found = master
+            break
+        # no need to wait for the slower ones
+        for task, (master, command) in probes.items():
+            command.cancel()
+            executor.abandon(task)
+        return found
+
     # # factory methods for cluster
     # to add a new cluster just create a new class that extends the cluster class
     # see http://stackoverflow.com/questions/456672/class-factory-in-python
@@ -317,7 +367,8 @@ class shuppet(Cluster):
     """
     this class represents the shuppet cluster
     """
-    group_by_chassis = False
+    # the chassis modules and imms don't cope well with a lot of sessions at once
+    limits = {CHASSIS: 3, BMC: 1, TOTAL: 40}
 
     def __init__(self):
         """
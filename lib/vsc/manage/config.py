@@ -59,6 +59,15 @@ def parseoptions():
 
     if options.poweroff and (options.poweron or options.hardreboot) or (options.poweron and options.hardreboot):
         parser.log.error("--hardreboot, --poweron and --poweroff are mutually exclusive")
+    if options.staggered and not options.poweron:
+        parser.log.error("--staggered only applies to --poweron")
+    if options.wait and not (options.poweron or options.hardreboot or options.poweroff or options.powercut):
+        parser.log.error("--wait only applies to --poweron, --hardreboot, --poweroff and --powercut")
+    if options.max_staleness and not (options.down or options.idle or options.offline):
+        parser.log.error("--max-staleness only applies to --down, --idle and --offline")
+    if options.max_staleness and (options.setonline or options.setoffline or options.pause or options.resume or
+                                  options.restart):
+        parser.log.error("--max-staleness can't be used with actions on the master")
     if options.restart and not options.forced:
         parser.log.error("You trying to restart the scheduler"
                          "without the --forced option, do you know what you are doing?")
@@ -133,6 +142,8 @@ class Options(object):
         """
         self.verbose = 2
         self.non_threaded = False
+        self.backend = 'threads'
+        self.deadline = None
         self.test_run = False
         self.forced = False
         self.ack = None
@@ -142,6 +153,8 @@ class Options(object):
         # actions
         self.state = False
         self.poweron = False
+        self.staggered = False
+        self.wait = False
         self.setonline = False
         self.setoffline = False
         self.hardreboot = False
@@ -165,6 +178,7 @@ class Options(object):
         self.down = False
         self.worker = False
         self.quattor = True
+        self.max_staleness = None
         self.all_nodes = False
         self.imms = False
         self.idle = False
@@ -190,6 +204,11 @@ class ManageOptionParser(GeneralOption):
                        None, "store_true", False, "f"),
             "test-run": ("Print what would be done, without actually doing anything", None, 'store_true', False, 't'),
             "non-threaded": ("Disable threading, do commands one by one", None, "store_true", False),
+            "backend": ("How nodes are handled in parallel: a pool of worker threads, or an event loop in a single"
+                        " thread (ssh commands still use the worker threads)", "choice", "store", "threads",
+                        ["threads", "eventloop"]),
+            "deadline": ("Maximum number of seconds for the whole run, nodes that are not done by then are reported"
+                         " as timed out", "int", "store", None),
             "cluster": ("Specify the cluster to run on, When not specified, the script will attempt to detect the"
                         "current cluster. All operations can only affect one cluster at a time",
                         None, "store", None, "C")
@@ -220,6 +239,9 @@ class ManageOptionParser(GeneralOption):
                         " this might be faster, and also works if the master is offline."
                         " This option will be ignored when using the idle, down or offline node selection.",
                         None, "store_true", False, 'q'),
+            "max-staleness": ("With the idle, down or offline node selection, use the node states saved by an earlier"
+                              " run if they are at most this many seconds old (and not older than PBS_CACHE_TTL),"
+                              " instead of asking the master", "int", "store", None),
             "all-nodes": ("Select all servers, WARNING: THIS WILL INCLUDE MASTERS", None, "store_true", False),
         }
         self.add_group_parser(nodesel_group, descr)
@@ -244,6 +266,12 @@ class ManageOptionParser(GeneralOption):
             "poweroff": ("Power off the selected nodes in a clean way", None, "store_true", False),
             "powercut": ("Power off the selected nodes as soon as possible", None, "store_true", False),
             "poweron": ("Power on the selected nodes", None, "store_true", False),
+            "staggered": ("With --poweron, power on the nodes in waves, each wave is confirmed on before the next one"
+                          " starts (see POWERON_* in the config)", None, "store_true", False),
+            "wait": ("With --poweron, --hardreboot, --poweroff or --powercut, wait until the power state of the nodes"
+                     " is on (or off, with --hardreboot on again after being seen off), and show how long it took"
+                     " (see POWER_WAIT_* in the config)",
+                     None, "store_true", False),
             "reboot": ("Reboot the selected nodes in a clean way", None, "store_true", False),
             "hardreboot": ("Power cycle the selected nodes", None, "store_true", False),
             "pbsmomrestart": ("Restart pbs_mom on the selected nodes", None, "store_true", False),
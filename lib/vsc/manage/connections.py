@@ -0,0 +1,500 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module contains pools of connections that are kept open for the lifetime of a run.
+
+Setting up an ssh connection (tcp connect, key exchange and authentication) costs a lot more
+than running a command over it, so ssh connections are shared by all commands to the same
+(host, user, port): every command opens its own channel on the shared transport.
+
+Logging in on a management module over telnet (IMMs) is slow too, but a telnet session can only run
+one command at a time, so commands to the same module take turns on one logged in session.
+
+@author: Jens Timmerman
+"""
+import atexit
+import socket
+import telnetlib
+import threading
+import time
+import traceback
+import warnings
+
+from vsc.manage.config import get_config
+from vsc.utils import fancylogger
+
+# ignore warnings when importing paramiko and it's dependencies
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    import paramiko
+
+
+class SshConnection(object):
+    """
+    An authenticated ssh client shared by all commands to one (host, user, port)
+    At most max_channels commands use it at the same time.
+    """
+    def __init__(self, key, client, max_channels):
+        """
+        constructor
+        """
+        self.key = key
+        self.client = client
+        self.max_channels = max_channels
+        self.channels = 0  # channels in use
+        self.last_used = time.time()
+        self.condition = threading.Condition()
+
+    def is_active(self):
+        """
+        returns True if the underlying transport is still usable
+        """
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def acquire(self, timeout):
+        """
+        reserve a channel on this connection, wait at most timeout seconds for one to become available
+        returns False if no channel became available in time
+        """
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while self.channels >= self.max_channels:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.channels += 1
+            return True
+        finally:
+            self.condition.release()
+
+    def release(self):
+        """
+        give back a channel reserved with acquire
+        """
+        self.condition.acquire()
+        self.channels -= 1
+        self.last_used = time.time()
+        self.condition.notify()
+        self.condition.release()
+
+    def exec_command(self, command, timeout, on_start=None):
+        """
+        run a command on a new channel of this connection (see SSHClient.exec_command)
+        """
+        if on_start is None:
+            return self.client.exec_command(command, timeout=timeout)
+        return self.client.exec_command(command, timeout=timeout, on_start=on_start)
+
+    def invoke_shell(self, timeout):
+        """
+        start an interactive shell on a new channel of this connection (see SSHClient.invoke_shell)
+        a wide terminal is requested, so the remote side doesn't wrap long lines
+        """
+        chan = self.client.invoke_shell(width=1024)
+        chan.settimeout(float(timeout))
+        return chan
+
+    def is_idle(self, idle_timeout):
+        """
+        returns True if nobody used this connection for idle_timeout seconds
+        """
+        return self.channels == 0 and time.time() - self.last_used > idle_timeout
+
+    def close(self):
+        """
+        close the underlying ssh client
+        """
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SshConnectionPool(object):
+    """
+    Process wide pool of authenticated ssh connections, keyed by (host, user, port)
+
+    Connections that were not used for idle_timeout seconds are closed the next time the pool is used,
+    at most max_channels commands run at the same time on one host.
+    """
+    def __init__(self, idle_timeout, max_channels):
+        """
+        constructor
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.idle_timeout = float(idle_timeout)
+        self.max_channels = int(max_channels)
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.connecting = {}  # key -> lock, so only one thread sets up a connection to a host
+
+    def get(self, host, user, port=22, passwd=None, timeout=None, client_class=paramiko.SSHClient):
+        """
+        returns an SshConnection to host with a channel reserved for the caller,
+        call release when the command is done.
+        A new connection is set up if there is none yet, or if the existing one died.
+        """
+        key = (host, user, port)
+        self._evictIdle()
+
+        self.lock.acquire()
+        connecting = self.connecting.setdefault(key, threading.Lock())
+        self.lock.release()
+
+        connecting.acquire()
+        try:
+            self.lock.acquire()
+            connection = self.connections.get(key)
+            if connection is not None:
+                # make sure it does not get evicted before we reserved a channel
+                connection.last_used = time.time()
+            self.lock.release()
+            if connection is not None and not connection.is_active():
+                self.log.debug("ssh connection to %s died, reconnecting" % (key,))
+                self.discard(connection)
+                connection = None
+            if connection is None:
+                connection = SshConnection(key, self._connect(host, user, port, passwd, timeout, client_class),
+                                           self.max_channels)
+                self.lock.acquire()
+                self.connections[key] = connection
+                self.lock.release()
+        finally:
+            connecting.release()
+
+        if timeout is None:
+            timeout = float(get_config("COMMAND_TIMEOUT"))
+        if not connection.acquire(timeout):
+            raise SshPoolException("No free channel to %s within %s seconds" % (host, timeout))
+        return connection
+
+    def release(self, connection):
+        """
+        give back a connection returned by get
+        """
+        connection.release()
+
+    def discard(self, connection):
+        """
+        remove a connection from the pool and close it, f.ex. because it stopped working
+        commands still using it will fail
+        """
+        self.lock.acquire()
+        if self.connections.get(connection.key) is connection:
+            del self.connections[connection.key]
+        self.lock.release()
+        connection.close()
+
+    def closeAll(self):
+        """
+        close all connections in the pool
+        """
+        self.lock.acquire()
+        connections = self.connections.values()
+        self.connections = {}
+        self.lock.release()
+        for connection in connections:
+            connection.close()
+
+    def _evictIdle(self):
+        """
+        close connections that were not used for idle_timeout seconds
+        """
+        self.lock.acquire()
+        idle = [c for c in self.connections.values() if c.is_idle(self.idle_timeout)]
+        for connection in idle:
+            del self.connections[connection.key]
+        self.lock.release()
+        for connection in idle:
+            self.log.debug("closing idle ssh connection to %s" % (connection.key,))
+            connection.close()
+
+    def _connect(self, host, user, port, passwd, timeout, client_class):
+        """
+        set up a new authenticated ssh client
+        """
+        self.log.debug("setting up ssh connection to %s@%s:%s" % (user, host, port))
+        client = client_class()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            if passwd:
+                # no need to use the agent or keys, we have the password
+                client.connect(host, port=port, username=user, password=passwd, allow_agent=False,
+                               look_for_keys=False, timeout=timeout)
+            else:
+                client.connect(host, port=port, username=user, timeout=timeout)
+        except Exception:
+            self.log.debug(traceback.format_exc())
+            client.close()
+            raise
+        return client
+
+
+_SSH_POOL = None
+_SSH_POOL_LOCK = threading.Lock()
+
+
+def get_ssh_pool():
+    """
+    returns the ssh connection pool shared by all commands in this process
+    """
+    global _SSH_POOL
+    _SSH_POOL_LOCK.acquire()
+    try:
+        if _SSH_POOL is None:
+            _SSH_POOL = SshConnectionPool(get_config("SSH_IDLE_TIMEOUT"), get_config("SSH_MAX_CHANNELS"))
+            atexit.register(_SSH_POOL.closeAll)
+        return _SSH_POOL
+    finally:
+        _SSH_POOL_LOCK.release()
+
+
+class TelnetSession(object):
+    """
+    A logged in telnet session to one (host, port, user), it runs one command at a time
+    """
+    def __init__(self, key, telnet, prompt, logoff):
+        """
+        constructor
+        prompt is what the remote side shows when it is ready for the next command,
+        logoff the command to end the session
+        """
+        self.key = key
+        self.telnet = telnet
+        self.prompt = prompt
+        self.logoff = logoff
+        self.last_used = time.time()
+        self.lock = threading.Lock()  # held by the command using this session
+
+    def is_alive(self):
+        """
+        returns False if the remote side closed the session
+        """
+        try:
+            # anything left is output nobody waited for, throw it away
+            self.telnet.read_very_eager()
+        except (EOFError, socket.error):
+            return False
+        return True
+
+    def run(self, command, timeout):
+        """
+        run a command, returns everything up to and including the next prompt
+        raises EOFError when the session was closed, TelnetPoolException when there was no prompt within timeout
+        """
+        self.telnet.write(command + "\n")
+        out = self.telnet.read_until(self.prompt, timeout)
+        if not out.endswith(self.prompt):
+            raise TelnetPoolException("No prompt from %s within %s seconds after %s, got %s" %
+                                      (self.key[0], timeout, command, out))
+        return out
+
+    def is_idle(self, idle_timeout):
+        """
+        returns True if nobody used this session for idle_timeout seconds
+        """
+        return not self.lock.locked() and time.time() - self.last_used > idle_timeout
+
+    def abort(self):
+        """
+        stop a command waiting on this session, from another thread
+        the socket is shut down, so the waiting read gets an EOFError. The session can't be used anymore.
+        """
+        try:
+            self.telnet.get_socket().shutdown(socket.SHUT_RDWR)
+        except (AttributeError, socket.error):
+            pass
+
+    def close(self):
+        """
+        log off and close the connection
+        """
+        try:
+            self.telnet.write(self.logoff + "\n")
+            self.telnet.close()
+        except Exception:
+            pass
+
+
+class TelnetSessionPool(object):
+    """
+    Process wide pool of logged in telnet sessions, keyed by (host, port, user)
+
+    Commands to the same host wait for each other, sessions that were not used for idle_timeout seconds
+    are closed the next time the pool is used.
+    """
+    def __init__(self, idle_timeout):
+        """
+        constructor
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.idle_timeout = float(idle_timeout)
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, user, passwd=None, port=23, timeout=None, logintxt="login :", passwdtxt="Password:",
+            prompt=">", logoff="exit"):
+        """
+        returns the TelnetSession to host, for the caller only,
+        call release when the command is done, or discard when the session is not usable anymore.
+        The caller logs in first if there is no session yet, or if the existing one died.
+        """
+        if timeout is None:
+            timeout = float(get_config("COMMAND_TIMEOUT"))
+        key = (host, port, user)
+        self._evictIdle()
+
+        deadline = time.time() + timeout
+        while True:
+            self.lock.acquire()
+            session = self.sessions.get(key)
+            if session is None:
+                # reserve it, so nobody else logs in at the same time
+                session = TelnetSession(key, None, prompt, logoff)
+                session.lock.acquire()
+                self.sessions[key] = session
+                self.lock.release()
+                try:
+                    session.telnet = self._login(host, port, user, passwd, deadline, logintxt, passwdtxt, prompt)
+                except Exception:
+                    self.discard(session)
+                    raise
+                return session
+            session.last_used = time.time()
+            self.lock.release()
+            # take turns on the existing session
+            while not session.lock.acquire(False):
+                if time.time() > deadline:
+                    raise TelnetPoolException("Session to %s stayed busy for %s seconds" % (host, timeout))
+                time.sleep(0.01)
+            if self.sessions.get(key) is session and session.is_alive():
+                return session
+            self.log.debug("telnet session to %s died, logging in again" % (key,))
+            self.discard(session)
+
+    def release(self, session):
+        """
+        give back a session returned by get
+        """
+        session.last_used = time.time()
+        session.lock.release()
+
+    def discard(self, session):
+        """
+        remove a session returned by get from the pool and close it, f.ex. because it stopped working
+        """
+        self.lock.acquire()
+        if self.sessions.get(session.key) is session:
+            del self.sessions[session.key]
+        self.lock.release()
+        if session.telnet is not None:
+            session.close()
+        session.lock.release()
+
+    def closeAll(self):
+        """
+        close all sessions in the pool
+        """
+        self.lock.acquire()
+        sessions = self.sessions.values()
+        self.sessions = {}
+        self.lock.release()
+        for session in sessions:
+            if session.telnet is not None:
+                session.close()
+
+    def _evictIdle(self):
+        """
+        close sessions that were not used for idle_timeout seconds
+        """
+        self.lock.acquire()
+        idle = [s for s in self.sessions.values() if s.is_idle(self.idle_timeout)]
+        for session in idle:
+            del self.sessions[session.key]
+        self.lock.release()
+        for session in idle:
+            self.log.debug("closing idle telnet session to %s" % (session.key,))
+            session.close()
+
+    def _login(self, host, port, user, passwd, deadline, logintxt, passwdtxt, prompt):
+        """
+        set up a new logged in telnet connection
+        """
+        self.log.debug("logging in on %s@%s:%s over telnet" % (user, host, port))
+        telnet = telnetlib.Telnet(host, port, max(deadline - time.time(), 0.1))
+        try:
+            for expect, answer in [(logintxt, user), (passwdtxt, passwd)]:
+                if answer is None:
+                    continue
+                self.log.debug("waiting for %s" % expect)
+                got = telnet.read_until(expect, max(deadline - time.time(), 0.1))
+                if not got.endswith(expect):
+                    raise TelnetPoolException("No %s from %s, got %s" % (expect, host, got))
+                telnet.write(answer + "\n")
+            got = telnet.read_until(prompt, max(deadline - time.time(), 0.1))
+            if not got.endswith(prompt):
+                raise TelnetPoolException("No prompt %s from %s after logging in, got %s" % (prompt, host, got))
+        except Exception:
+            self.log.debug(traceback.format_exc())
+            telnet.close()
+            raise
+        return telnet
+
+
+_TELNET_POOL = None
+
+
+def get_telnet_pool():
+    """
+    returns the telnet session pool shared by all commands in this process
+    """
+    global _TELNET_POOL
+    _SSH_POOL_LOCK.acquire()
+    try:
+        if _TELNET_POOL is None:
+            _TELNET_POOL = TelnetSessionPool(get_config("TELNET_IDLE_TIMEOUT"))
+            atexit.register(_TELNET_POOL.closeAll)
+        return _TELNET_POOL
+    finally:
+        _SSH_POOL_LOCK.release()
+
+
+class SshPoolException(Exception):
+    """
+    SshPoolException
+    thrown when no ssh channel could be reserved in time
+    """
+    pass
+
+
+class TelnetPoolException(Exception):
+    """
+    TelnetPoolException
+    thrown when a telnet session could not be set up or did not respond in time
+    """
+    pass
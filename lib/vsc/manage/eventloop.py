@@ -0,0 +1,476 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module contains an event loop to run operations on a lot of nodes from a single thread.
+
+Python 2 has no asyncio, so the coroutines here are plain generators. A coroutine yields
+what it is waiting for, and the EventLoop resumes it when that happened:
+    - WaitRead/WaitWrite: resumed with the list of ready file descriptors
+      (an empty list when the deadline of the wait passed first)
+    - Sleep: resumed after the given amount of seconds
+    - Offload: the function is run in the worker pool, the coroutine is resumed with the result
+      (or the exception is raised in it), this is used for blocking libraries like paramiko
+    - another generator: it is run as a sub coroutine, its result is sent back
+    - Return: ends the coroutine with a value
+
+f.ex.
+    def arun(self):
+        ready = yield WaitRead([fd], deadline)
+        result = yield self.other_coroutine()
+        yield Return(result)
+
+@author: Jens Timmerman
+"""
+import errno
+import heapq
+import os
+import select
+import sys
+import threading
+import time
+import types
+from collections import deque
+
+from vsc.manage.scheduler import get_worker_pool
+from vsc.utils import fancylogger
+
+if hasattr(select, 'epoll'):
+    READ_EVENTS = select.EPOLLIN | select.EPOLLPRI
+    WRITE_EVENTS = select.EPOLLOUT
+else:
+    READ_EVENTS = select.POLLIN | select.POLLPRI
+    WRITE_EVENTS = select.POLLOUT
+
+
+class Return(object):
+    """
+    yield this to end a coroutine with a value
+    """
+    def __init__(self, value=None):
+        self.value = value
+
+
+class WaitRead(object):
+    """
+    yield this to wait until one of the fds is readable, or until deadline (in seconds since the epoch)
+    """
+    EVENTS = READ_EVENTS
+
+    def __init__(self, fds, deadline=None):
+        self.fds = fds
+        self.deadline = deadline
+
+
+class WaitWrite(WaitRead):
+    """
+    yield this to wait until one of the fds is writable, or until deadline (in seconds since the epoch)
+    """
+    EVENTS = WRITE_EVENTS
+
+
+class Sleep(object):
+    """
+    yield this to sleep for a number of seconds
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Offload(object):
+    """
+    yield this to run a blocking function in the worker pool
+    """
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+
+class Coroutine(object):
+    """
+    A coroutine spawned in an EventLoop
+    when done is True, result holds the value it returned and error the exception it raised (if any)
+    timedout is set when it got cancelled because it ran over its deadline
+    """
+    def __init__(self, generator, deadline=None):
+        self.generator = generator
+        self.stack = [generator]
+        self.deadline = deadline
+        self.result = None
+        self.error = None
+        self.done = False
+        self.timedout = False
+        self.token = 0  # changes every time the coroutine is resumed, to invalidate old wakeups
+        self.fds = []  # fds it is waiting on
+        self.offloaded = None  # Task in the worker pool it is waiting on
+
+
+class _Poller(object):
+    """
+    thin wrapper around epoll, or poll where epoll is not available
+    timeouts are in seconds, None means wait forever
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.scale = 1
+            self.forever = -1
+        else:
+            self.poller = select.poll()
+            self.scale = 1000
+            self.forever = None
+
+    def register(self, fd, events):
+        self.poller.register(fd, events)
+
+    def unregister(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            # closed fds are removed from epoll automatically
+            pass
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = self.forever
+        else:
+            timeout = max(timeout, 0) * self.scale
+            if self.scale != 1:
+                timeout = int(timeout) + 1
+        try:
+            return self.poller.poll(timeout)
+        except (IOError, OSError, select.error), ex:
+            if ex.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self.poller, 'close'):
+            self.poller.close()
+
+
+class EventLoop(object):
+    """
+    Runs coroutines from a single thread, multiplexing all their file descriptors with epoll
+    """
+    def __init__(self, executor=None):
+        """
+        constructor
+        executor is the WorkerPool used for Offload, the shared worker pool if it is not given
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.executor = executor
+        self.poller = _Poller()
+        self.waiting = {}  # fd -> coroutine
+        self.timers = []  # heap of (time, sequence, coroutine, token), token None for coroutine deadlines
+        self.sequence = 0
+        self.runnable = deque()  # (coroutine, value, exc_info) to resume
+        self.live = 0
+        self.finished = deque()  # coroutines that are done, for iterate
+        # offloaded functions signal their completion through this pipe
+        self.offloaded = []
+        self.offloaded_lock = threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.poller.register(self.wakeup_r, READ_EVENTS)
+
+    def spawn(self, generator, timeout=None):
+        """
+        schedule a coroutine, it is cancelled when it runs longer than timeout seconds
+        returns a Coroutine
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        coroutine = Coroutine(generator, deadline)
+        self.live += 1
+        if deadline is not None:
+            self._addTimer(deadline, coroutine, None)
+        self.runnable.append((coroutine, None, None))
+        return coroutine
+
+    def run(self):
+        """
+        run until all spawned coroutines are done
+        """
+        for _ in self.iterate():
+            pass
+
+    def iterate(self):
+        """
+        run until all spawned coroutines are done, yielding every Coroutine as soon as it is done
+        """
+        while self.live or self.finished:
+            while self.finished:
+                yield self.finished.popleft()
+            if self.live:
+                self._runOnce()
+
+    def _runOnce(self):
+        """
+        step all runnable coroutines, then wait for the next event or timer
+        """
+        while self.runnable:
+            coroutine, value, exc_info = self.runnable.popleft()
+            if not coroutine.done:
+                self._step(coroutine, value, exc_info)
+        if self.live and not self.finished:
+            events = self.poller.poll(self._nextTimeout())
+            ready = {}
+            for fd, _ in events:
+                if fd == self.wakeup_r:
+                    self._collectOffloaded()
+                    continue
+                coroutine = self.waiting.get(fd)
+                if coroutine is not None:
+                    ready.setdefault(coroutine, []).append(fd)
+            for coroutine, fds in ready.items():
+                self._resume(coroutine, fds)
+            self._runTimers()
+
+    def close(self):
+        """
+        release the resources of this loop
+        """
+        self.poller.close()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def _step(self, coroutine, value=None, exc_info=None):
+        """
+        run a coroutine until it waits for something, or is done
+        """
+        while True:
+            generator = coroutine.stack[-1]
+            try:
+                if exc_info:
+                    yielded = generator.throw(*exc_info)
+                else:
+                    yielded = generator.send(value)
+            except StopIteration:
+                yielded = Return()
+            except Exception:
+                coroutine.stack.pop()
+                exc_info = sys.exc_info()
+                value = None
+                if not coroutine.stack:
+                    self._finish(coroutine, error=exc_info[1])
+                    return
+                continue
+
+            value = None
+            exc_info = None
+            if isinstance(yielded, types.GeneratorType):
+                coroutine.stack.append(yielded)
+            elif isinstance(yielded, Return):
+                generator.close()
+                coroutine.stack.pop()
+                value = yielded.value
+                if not coroutine.stack:
+                    self._finish(coroutine, result=value)
+                    return
+            elif isinstance(yielded, WaitRead):
+                coroutine.token += 1
+                try:
+                    for fd in yielded.fds:
+                        if fd in self.waiting:
+                            raise EventLoopException("fd %s is already waited on by another coroutine" % fd)
+                        self.poller.register(fd, yielded.EVENTS)
+                        self.waiting[fd] = coroutine
+                        coroutine.fds.append(fd)
+                except Exception:
+                    exc_info = sys.exc_info()
+                    self._unwait(coroutine)
+                    continue
+                if yielded.deadline is not None:
+                    self._addTimer(yielded.deadline, coroutine, coroutine.token)
+                return
+            elif isinstance(yielded, Sleep):
+                coroutine.token += 1
+                self._addTimer(time.time() + yielded.seconds, coroutine, coroutine.token)
+                return
+            elif isinstance(yielded, Offload):
+                coroutine.token += 1
+                executor = self.executor or get_worker_pool()
+                coroutine.offloaded = executor.submit(self._offload, coroutine, coroutine.token, yielded)
+                return
+            else:
+                exc = EventLoopException("coroutine yielded something unknown: %r" % (yielded,))
+                exc_info = (EventLoopException, exc, None)
+
+    def _unwait(self, coroutine):
+        """
+        stop waiting for whatever the coroutine is waiting on
+        """
+        for fd in coroutine.fds:
+            self.poller.unregister(fd)
+            self.waiting.pop(fd, None)
+        coroutine.fds = []
+        coroutine.offloaded = None
+        coroutine.token += 1
+
+    def _resume(self, coroutine, value=None, exc_info=None):
+        """
+        stop waiting and schedule the coroutine to run again
+        """
+        self._unwait(coroutine)
+        self.runnable.append((coroutine, value, exc_info))
+
+    def _finish(self, coroutine, result=None, error=None):
+        """
+        mark a coroutine as done
+        """
+        coroutine.result = result
+        coroutine.error = error
+        coroutine.done = True
+        self.live -= 1
+        self.finished.append(coroutine)
+
+    def cancel(self, coroutine):
+        """
+        stop a coroutine, its generators are closed so their finally blocks can clean up
+        """
+        if coroutine.done:
+            return
+        if coroutine.offloaded is not None:
+            (self.executor or get_worker_pool()).abandon(coroutine.offloaded)
+        self._unwait(coroutine)
+        while coroutine.stack:
+            try:
+                coroutine.stack.pop().close()
+            except Exception, ex:
+                self.log.debug("closing cancelled coroutine failed: %s" % ex)
+        coroutine.timedout = True
+        self._finish(coroutine, error=EventLoopException("timed out"))
+
+    def _offload(self, coroutine, token, offload):
+        """
+        run an offloaded function, this runs in a worker thread
+        """
+        result = None
+        exc_info = None
+        try:
+            result = offload.function(*offload.args, **offload.kwargs)
+        except Exception:
+            exc_info = sys.exc_info()
+        self.offloaded_lock.acquire()
+        self.offloaded.append((coroutine, token, result, exc_info))
+        self.offloaded_lock.release()
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError:
+            # loop is closed already
+            pass
+
+    def _collectOffloaded(self):
+        """
+        resume coroutines whose offloaded function is done
+        """
+        try:
+            os.read(self.wakeup_r, 4096)
+        except OSError:
+            pass
+        self.offloaded_lock.acquire()
+        offloaded = self.offloaded
+        self.offloaded = []
+        self.offloaded_lock.release()
+        for coroutine, token, result, exc_info in offloaded:
+            if not coroutine.done and coroutine.token == token:
+                self._resume(coroutine, result, exc_info)
+
+    def _addTimer(self, when, coroutine, token):
+        """
+        wake up coroutine at when, if it did not get resumed in the meantime (token changed)
+        """
+        self.sequence += 1
+        heapq.heappush(self.timers, (when, self.sequence, coroutine, token))
+
+    def _nextTimeout(self):
+        """
+        seconds until the next timer expires
+        """
+        if self.runnable:
+            return 0
+        while self.timers:
+            _, _, coroutine, token = self.timers[0]
+            if coroutine.done or (token is not None and token != coroutine.token):
+                heapq.heappop(self.timers)
+            else:
+                return self.timers[0][0] - time.time()
+        return None
+
+    def _runTimers(self):
+        """
+        handle expired wait timeouts, sleeps and coroutine deadlines
+        """
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, coroutine, token = heapq.heappop(self.timers)
+            if coroutine.done:
+                continue
+            if token is None:
+                self.log.debug("coroutine %s timed out" % coroutine.stack[0])
+                self.cancel(coroutine)
+            elif token == coroutine.token:
+                value = None
+                if coroutine.fds:
+                    value = []
+                self._resume(coroutine, value)
+
+
+def run_coroutines(generators, timeout=None, executor=None):
+    """
+    run a list of coroutines in a new EventLoop
+    returns the list of Coroutines, in the same order
+    """
+    loop = EventLoop(executor)
+    try:
+        coroutines = [loop.spawn(generator, timeout) for generator in generators]
+        loop.run()
+    finally:
+        loop.close()
+    return coroutines
+
+
+def iter_coroutines(generators, timeout=None, executor=None):
+    """
+    run a list of coroutines in a new EventLoop
+    yields the Coroutines in the order they are done
+    """
+    loop = EventLoop(executor)
+    try:
+        for generator in generators:
+            loop.spawn(generator, timeout)
+        for coroutine in loop.iterate():
+            yield coroutine
+    finally:
+        loop.close()
+
+
+class EventLoopException(Exception):
+    """
+    EventLoopException
+    raised in coroutines that do something wrong, or run over their deadline
+    """
+    pass
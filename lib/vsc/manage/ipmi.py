@@ -0,0 +1,693 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module contains a small IPMI v2.0 (RMCP+) client, to control the power of nodes through their BMC
+without running ipmitool for every node.
+
+All sessions are driven from one udp socket: the requests to all BMCs are sent at once, and the answers
+are handed to their session (by its console session id) as they come in. Sessions stay open for the lifetime
+of the process, so later commands to the same BMC don't have to go through the session setup
+(open session request, RAKP 1-4) again. Several threads can run commands at the same time, they share the socket.
+
+Supported cipher suites are
+    1: RAKP-HMAC-SHA1 authentication, no integrity, no confidentiality
+    2: RAKP-HMAC-SHA1 authentication, HMAC-SHA1-96 integrity, no confidentiality
+    3: RAKP-HMAC-SHA1 authentication, HMAC-SHA1-96 integrity, AES-CBC-128 confidentiality (needs pycrypto),
+       this is what ipmitool -I lanplus uses.
+
+@author: Jens Timmerman
+"""
+import atexit
+import errno
+import hashlib
+import hmac
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+from vsc.manage.config import get_config
+from vsc.utils import fancylogger
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+IPMI_PORT = 623
+
+RMCP_HEADER = '\x06\x00\xff\x07'  # version 1.0, no rmcp ack, class ipmi
+AUTHTYPE_RMCPPLUS = 0x06
+
+# payload types
+PAYLOAD_IPMI = 0x00
+PAYLOAD_OPEN_SESSION_REQUEST = 0x10
+PAYLOAD_OPEN_SESSION_RESPONSE = 0x11
+PAYLOAD_RAKP1 = 0x12
+PAYLOAD_RAKP2 = 0x13
+PAYLOAD_RAKP3 = 0x14
+PAYLOAD_RAKP4 = 0x15
+ENCRYPTED = 0x80
+AUTHENTICATED = 0x40
+
+# authentication, integrity, confidentiality algorithm per cipher suite
+CIPHER_SUITES = {
+    1: (1, 0, 0),
+    2: (1, 1, 0),
+    3: (1, 1, 1),
+}
+
+PRIVILEGE_ADMINISTRATOR = 0x04
+NAME_ONLY_LOOKUP = 0x10
+
+NETFN_CHASSIS = 0x00
+NETFN_APP = 0x06
+CMD_GET_CHASSIS_STATUS = 0x01
+CMD_CHASSIS_CONTROL = 0x02
+CMD_SET_SESSION_PRIVILEGE = 0x3b
+CMD_CLOSE_SESSION = 0x3c
+
+# times a packet is sent before giving up on it
+MAX_TRIES = 4
+
+BMC_ADDRESS = 0x20
+CONSOLE_ADDRESS = 0x81
+
+# chassis power command -> chassis control code, and what ipmitool reports for it
+POWER_CONTROLS = {
+    'off': (0x00, 'Down/Off'),
+    'on': (0x01, 'Up/On'),
+    'cycle': (0x02, 'Cycle'),
+    'reset': (0x03, 'Reset'),
+    'soft': (0x05, 'Soft'),
+}
+
+
+def hmac_sha1(key, data):
+    """
+    returns the HMAC-SHA1 of data
+    """
+    return hmac.new(key, data, hashlib.sha1).digest()
+
+
+def checksum(data):
+    """
+    the 2's complement checksum used in ipmi messages
+    """
+    return -sum(bytearray(data)) & 0xff
+
+
+def ipmi_message(netfn, cmd, data, rqseq, source=CONSOLE_ADDRESS, target=BMC_ADDRESS):
+    """
+    returns an ipmi message (request or response) to target
+    """
+    head = chr(target) + chr(netfn << 2)
+    body = chr(source) + chr((rqseq << 2) & 0xff) + chr(cmd) + data
+    return head + chr(checksum(head)) + body + chr(checksum(body))
+
+
+def parse_ipmi_message(message):
+    """
+    returns netfn, rqseq, cmd, data of an ipmi message
+    raises IpmiException when the checksums are wrong
+    """
+    if len(message) < 7 or checksum(message[:3]) or checksum(message[3:]):
+        raise IpmiException("corrupt ipmi message %r" % message)
+    return ord(message[1]) >> 2, ord(message[4]) >> 2, ord(message[5]), message[6:-1]
+
+
+class IpmiJob(object):
+    """
+    A chassis power command (status, on, off, cycle, reset, soft) for one BMC
+    when done, out and err hold the result, in the same format as ipmitool chassis power would report it.
+    """
+    def __init__(self, command):
+        """
+        constructor
+        """
+        if command != 'status' and command not in POWER_CONTROLS:
+            raise IpmiException("Unsupported chassis power command %s" % command)
+        self.command = command
+        self.out = None
+        self.err = None
+        self.done = False
+        self.retried = False
+
+    def request(self):
+        """
+        returns netfn, cmd, data of the ipmi request for this job
+        """
+        if self.command == 'status':
+            return NETFN_CHASSIS, CMD_GET_CHASSIS_STATUS, ''
+        return NETFN_CHASSIS, CMD_CHASSIS_CONTROL, chr(POWER_CONTROLS[self.command][0])
+
+    def handle(self, data):
+        """
+        handle the response data (completion code and data) of the request
+        """
+        if ord(data[0]):
+            self.finish(None, "%s failed with completion code 0x%02x" % (self.command, ord(data[0])))
+        elif self.command == 'status':
+            self.finish("Chassis Power is %s" % ('on' if ord(data[1]) & 0x01 else 'off'), '')
+        else:
+            self.finish("Chassis Power Control: %s" % POWER_CONTROLS[self.command][1], '')
+
+    def finish(self, out, err):
+        """
+        set the result
+        """
+        self.out = out
+        self.err = err
+        self.done = True
+
+
+class IpmiSession(object):
+    """
+    The RMCP+ session to one BMC
+    It sets up the session, then runs the queued jobs one after the other.
+    The IpmiClient sends the packets it makes and hands it the packets the BMC sends back.
+    """
+    NEW, OPENING, RAKP1, RAKP3, PRIVILEGE, ACTIVE = range(6)
+
+    def __init__(self, host, port, user, passwd, suite):
+        """
+        constructor
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        if suite not in CIPHER_SUITES:
+            raise IpmiException("Unsupported cipher suite %s" % suite)
+        if CIPHER_SUITES[suite][2] and AES is None:
+            raise IpmiException("Cipher suite %s needs pycrypto for AES" % suite)
+        self.host = host
+        self.port = port
+        self.address = None
+        self.user = user or ''
+        self.passwd = passwd or ''
+        self.suite = suite
+        self.queue = deque()  # jobs waiting to run
+        self.job = None  # job waiting for its response
+        self.packet = None  # packet waiting for an answer
+        self.sent = None  # time the packet was (last) sent
+        self.tries = 0
+        self.reply = None  # packet answering the last packet handled
+        self.reset()
+
+    def reset(self):
+        """
+        forget the session, the next packet starts setting up a new one
+        """
+        self.state = self.NEW
+        self.console_sid = struct.unpack('<I', os.urandom(4))[0] | 1
+        self.bmc_sid = 0
+        self.seq = 0
+        self.rqseq = 0
+        self.tag = 0
+        self.rm = os.urandom(16)
+        self.rc = None
+        self.guid = None
+        self.k1 = None
+        self.k2 = None
+        self.packet = None
+
+    def is_active(self):
+        """
+        returns True if the session is set up
+        """
+        return self.state == self.ACTIVE
+
+    def next(self):
+        """
+        returns the next packet to send, or None if there is nothing to do
+        """
+        if self.packet is not None:
+            return None
+        if self.state == self.NEW:
+            if not self.queue:
+                return None
+            self.state = self.OPENING
+            self.tag = (self.tag + 1) & 0xff
+            auth, integrity, confidentiality = CIPHER_SUITES[self.suite]
+            payload = struct.pack('<BBHI', self.tag, PRIVILEGE_ADMINISTRATOR, 0, self.console_sid)
+            for kind, algorithm in enumerate([auth, integrity, confidentiality]):
+                payload += struct.pack('<BHBB3x', kind, 0, 8, algorithm)
+            return self._send(PAYLOAD_OPEN_SESSION_REQUEST, payload)
+        if self.state == self.ACTIVE and self.queue:
+            self.job = self.queue.popleft()
+            return self._sendIpmi(*self.job.request())
+        return None
+
+    def resend(self):
+        """
+        returns the packet that is waiting for an answer, to send it again
+        """
+        self.sent = time.time()
+        self.tries += 1
+        return self.packet
+
+    def fail(self, err):
+        """
+        give up on the current job, or on all jobs if the session could not be set up
+        """
+        if self.state == self.ACTIVE and self.job is not None:
+            job, self.job = self.job, None
+            self.packet = None
+            if not job.retried:
+                # the bmc might have closed the session in the mean time, try again on a new one
+                self.log.debug("no answer from %s on an existing session, setting up a new one" % self.host)
+                job.retried = True
+                self.queue.appendleft(job)
+                self.reset()
+                return
+            job.finish(None, err)
+            return
+        jobs = list(self.queue)
+        if self.job is not None:
+            jobs.append(self.job)
+        self.queue.clear()
+        self.job = None
+        for job in jobs:
+            job.finish(None, err)
+        self.reset()
+
+    def handle(self, data):
+        """
+        handle a packet from the BMC
+        """
+        try:
+            ptype, payload = self._parse(data)
+        except IpmiException, ex:
+            self.log.debug("ignoring packet from %s: %s" % (self.host, ex))
+            return
+
+        if self.state == self.OPENING and ptype == PAYLOAD_OPEN_SESSION_RESPONSE:
+            tag, status = ord(payload[0]), ord(payload[1])
+            if tag != self.tag:
+                return
+            if status:
+                self.fail("open session request to %s failed with status 0x%02x" % (self.host, status))
+                return
+            console_sid, self.bmc_sid = struct.unpack('<II', payload[4:12])
+            if console_sid != self.console_sid:
+                return
+            algorithms = (ord(payload[16]), ord(payload[24]), ord(payload[32]))
+            if algorithms != CIPHER_SUITES[self.suite]:
+                self.fail("%s does not support cipher suite %s" % (self.host, self.suite))
+                return
+            self.state = self.RAKP1
+            self.tag = (self.tag + 1) & 0xff
+            payload = struct.pack('<B3xI', self.tag, self.bmc_sid) + self.rm + chr(self._role()) + '\x00\x00'
+            payload += chr(len(self.user)) + self.user
+            self._reply(self._send(PAYLOAD_RAKP1, payload))
+
+        elif self.state == self.RAKP1 and ptype == PAYLOAD_RAKP2:
+            tag, status = ord(payload[0]), ord(payload[1])
+            if tag != self.tag:
+                return
+            if status:
+                self.fail("RAKP 2 from %s failed with status 0x%02x" % (self.host, status))
+                return
+            self.rc = payload[8:24]
+            self.guid = payload[24:40]
+            expected = hmac_sha1(self.passwd, struct.pack('<II', self.console_sid, self.bmc_sid) + self.rm +
+                                 self.rc + self.guid + self._name())
+            if payload[40:60] != expected:
+                self.fail("Wrong user or password for %s" % self.host)
+                return
+            self.state = self.RAKP3
+            self.tag = (self.tag + 1) & 0xff
+            authcode = hmac_sha1(self.passwd, self.rc + struct.pack('<I', self.console_sid) + self._name())
+            self._reply(self._send(PAYLOAD_RAKP3, struct.pack('<BB2xI', self.tag, 0, self.bmc_sid) + authcode))
+
+        elif self.state == self.RAKP3 and ptype == PAYLOAD_RAKP4:
+            tag, status = ord(payload[0]), ord(payload[1])
+            if tag != self.tag:
+                return
+            if status:
+                self.fail("RAKP 4 from %s failed with status 0x%02x" % (self.host, status))
+                return
+            sik = hmac_sha1(self.passwd, self.rm + self.rc + self._name())
+            if payload[8:20] != hmac_sha1(sik, self.rm + struct.pack('<I', self.bmc_sid) + self.guid)[:12]:
+                self.fail("Wrong integrity check value in RAKP 4 from %s" % self.host)
+                return
+            self.k1 = hmac_sha1(sik, '\x01' * 20)
+            self.k2 = hmac_sha1(sik, '\x02' * 20)
+            self.state = self.PRIVILEGE
+            self._reply(self._sendIpmi(NETFN_APP, CMD_SET_SESSION_PRIVILEGE, chr(PRIVILEGE_ADMINISTRATOR)))
+
+        elif self.state in (self.PRIVILEGE, self.ACTIVE) and ptype == PAYLOAD_IPMI:
+            try:
+                _, rqseq, _, data = parse_ipmi_message(payload)
+            except IpmiException, ex:
+                self.log.debug("ignoring packet from %s: %s" % (self.host, ex))
+                return
+            if rqseq != self.rqseq or not data:
+                return
+            if self.packet is None or (self.state == self.ACTIVE and self.job is None):
+                # a bmc that answers twice, or a retransmitted answer, this one was handled already
+                self.log.debug("ignoring duplicate answer from %s" % self.host)
+                return
+            self.packet = None
+            if self.state == self.PRIVILEGE:
+                if ord(data[0]):
+                    self.fail("Could not get administrator privileges on %s: 0x%02x" % (self.host, ord(data[0])))
+                    return
+                self.state = self.ACTIVE
+                self.log.debug("ipmi session to %s is active" % self.host)
+            else:
+                job, self.job = self.job, None
+                job.handle(data)
+
+    def close(self):
+        """
+        returns the packet closing the session, None if there is no session
+        """
+        if self.state not in (self.PRIVILEGE, self.ACTIVE):
+            return None
+        packet = self._sendIpmi(NETFN_APP, CMD_CLOSE_SESSION, struct.pack('<I', self.bmc_sid))
+        self.reset()
+        return packet
+
+    def _role(self):
+        """
+        the requested role in RAKP 1
+        """
+        return PRIVILEGE_ADMINISTRATOR | NAME_ONLY_LOOKUP
+
+    def _name(self):
+        """
+        the role, user name length and user name, as used in the RAKP hmacs
+        """
+        return chr(self._role()) + chr(len(self.user)) + self.user
+
+    def _reply(self, packet):
+        """
+        a packet that is sent as an answer to what we just got, it's picked up by the client
+        """
+        self.reply = packet
+
+    def _send(self, ptype, payload):
+        """
+        returns a session setup packet, and remembers it for retransmission
+        """
+        packet = RMCP_HEADER + struct.pack('<BBIIH', AUTHTYPE_RMCPPLUS, ptype, 0, 0, len(payload)) + payload
+        self.packet = packet
+        self.sent = time.time()
+        self.tries = 1
+        return packet
+
+    def _sendIpmi(self, netfn, cmd, data):
+        """
+        returns a packet with an ipmi request on the active session
+        """
+        self.rqseq = (self.rqseq + 1) & 0x3f
+        self.seq = (self.seq + 1) & 0xffffffff
+        payload = ipmi_message(netfn, cmd, data, self.rqseq)
+        _, integrity, confidentiality = CIPHER_SUITES[self.suite]
+        ptype = PAYLOAD_IPMI
+        if confidentiality:
+            ptype |= ENCRYPTED
+            payload = self._encrypt(payload)
+        if integrity:
+            ptype |= AUTHENTICATED
+        message = struct.pack('<BBIIH', AUTHTYPE_RMCPPLUS, ptype, self.bmc_sid, self.seq, len(payload)) + payload
+        if integrity:
+            pad = (4 - (len(message) + 2) % 4) % 4
+            message += '\xff' * pad + chr(pad) + '\x07'
+            message += hmac_sha1(self.k1, message)[:12]
+        self.packet = RMCP_HEADER + message
+        self.sent = time.time()
+        self.tries = 1
+        return self.packet
+
+    def _parse(self, data):
+        """
+        returns payload type and (decrypted) payload of a packet
+        raises IpmiException for packets that are not for us
+        """
+        if data[:4] != RMCP_HEADER or len(data) < 16 or ord(data[4]) != AUTHTYPE_RMCPPLUS:
+            raise IpmiException("not an RMCP+ packet")
+        ptype, sid, _, length = struct.unpack('<BIIH', data[5:16])
+        payload = data[16:16 + length]
+        if len(payload) != length:
+            raise IpmiException("truncated packet")
+        if ptype & AUTHENTICATED:
+            if self.k1 is None or hmac_sha1(self.k1, data[4:-12])[:12] != data[-12:]:
+                raise IpmiException("wrong integrity check value")
+        if ptype & ENCRYPTED:
+            if self.k2 is None:
+                raise IpmiException("encrypted packet before the session is set up")
+            payload = self._decrypt(payload)
+        if ptype & 0x3f != PAYLOAD_IPMI:
+            if sid != 0 and sid != self.console_sid:
+                raise IpmiException("packet for another session")
+        elif sid != self.console_sid:
+            raise IpmiException("packet for another session")
+        return ptype & 0x3f, payload
+
+    def _encrypt(self, payload):
+        """
+        AES-CBC-128 encrypt a payload, with the confidentiality trailer
+        """
+        iv = os.urandom(16)
+        pad = (16 - (len(payload) + 1) % 16) % 16
+        plain = payload + ''.join([chr(i) for i in range(1, pad + 1)]) + chr(pad)
+        return iv + AES.new(self.k2[:16], AES.MODE_CBC, iv).encrypt(plain)
+
+    def _decrypt(self, payload):
+        """
+        decrypt an AES-CBC-128 encrypted payload
+        """
+        if len(payload) < 32 or len(payload) % 16:
+            raise IpmiException("wrong length for an encrypted payload")
+        plain = AES.new(self.k2[:16], AES.MODE_CBC, payload[:16]).decrypt(payload[16:])
+        return plain[:-1 - ord(plain[-1])]
+
+
+class IpmiClient(object):
+    """
+    Runs chassis power commands on a lot of BMCs at the same time, from one udp socket
+    Sessions are kept, keyed by (host, port, user, passwd), so later commands reuse them.
+    """
+    def __init__(self, suite=3, retry=1.0):
+        """
+        constructor
+        suite is the cipher suite used for new sessions,
+        retry the number of seconds to wait for an answer before sending a packet again,
+        a packet is sent MAX_TRIES times before giving up
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.suite = int(suite)
+        self.retry = float(retry)
+        self.sessions = {}
+        self.bysid = {}  # console session id -> session, to hand the answers to
+        self.lock = threading.Condition()  # guards the sessions, notified when answers were handled
+        self.reading = False  # set while a run waits on the socket without holding the lock
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+
+    def run(self, requests, timeout):
+        """
+        run a list of (host, port, user, passwd, command) requests
+        returns a list with out, err for every request, in the same order
+        runs in several threads share the socket: one of them at a time waits for answers and hands them to
+        their session, the others wait until they are woken up by that or have to send something again,
+        so a BMC that doesn't answer only holds up the runs it is in.
+        """
+        self.lock.acquire()
+        try:
+            return self._run(requests, timeout)
+        finally:
+            self.lock.notifyAll()
+            self.lock.release()
+
+    def _run(self, requests, timeout):
+        """
+        see run
+        """
+        deadline = time.time() + timeout
+        jobs = []
+        sessions = set()  # the sessions in this run
+        for host, port, user, passwd, command in requests:
+            try:
+                job = IpmiJob(command)
+                session = self._session(host, port, user, passwd)
+                session.queue.append(job)
+                sessions.add(session)
+            except (IpmiException, socket.error), ex:
+                job = IpmiJob('status')
+                job.finish(None, str(ex))
+            jobs.append(job)
+
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN)
+        while not all(job.done for job in jobs):
+            now = time.time()
+            if now >= deadline:
+                break
+            wakeup = deadline
+            for session in sessions:
+                packet = session.next()
+                if packet is None and session.packet is not None and now - session.sent >= self.retry:
+                    if session.tries >= MAX_TRIES:
+                        session.fail("no answer from %s" % session.host)
+                        packet = session.next()
+                    else:
+                        packet = session.resend()
+                if packet is not None:
+                    self._sendto(packet, session)
+                if session.packet is not None:
+                    wakeup = min(wakeup, session.sent + self.retry)
+            wait = max(wakeup - time.time(), 0)
+            if self.reading:
+                # another run is on the socket, it wakes us up when it handled an answer
+                self.lock.wait(wait)
+                continue
+            self.reading = True
+            self.lock.release()
+            try:
+                ready = poller.poll(wait * 1000)
+            finally:
+                self.lock.acquire()
+                self.reading = False
+            if ready:
+                self._receive()
+            self.lock.notifyAll()
+
+        for job in jobs:
+            if not job.done:
+                job.finish(None, 'ipmi command timed out')
+        for session in sessions:
+            # forget what is still waiting for this run, the session is set up again on the next use,
+            # jobs of other runs on the same session stay queued
+            session.queue = deque([job for job in session.queue if not job.done])
+            if (session.job is not None and session.job.done) or (session.job is None and session.packet is not None
+                                                                  and not session.queue):
+                session.job = None
+                session.reset()
+        return [(job.out, job.err) for job in jobs]
+
+    def _session(self, host, port, user, passwd):
+        """
+        returns the session to a BMC, a new one if there is none yet
+        """
+        key = (host, port, user, passwd)
+        session = self.sessions.get(key)
+        if session is None:
+            session = IpmiSession(host, port, user, passwd, self.suite)
+            session.address = (socket.gethostbyname(host), port)
+            self.sessions[key] = session
+        return session
+
+    def _sendto(self, packet, session):
+        """
+        send a packet to the BMC of a session
+        """
+        self.bysid[session.console_sid] = session
+        try:
+            self.sock.sendto(packet, session.address)
+        except socket.error, ex:
+            self.log.debug("sending to %s failed: %s" % (session.host, ex))
+
+    def _receive(self):
+        """
+        read all packets waiting on the socket, and hand them to their session
+        """
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except socket.error, ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                # f.ex. a port unreachable for an earlier packet
+                self.log.debug("receiving failed: %s" % ex)
+                continue
+            session = self._lookup(data, address)
+            if session is None:
+                continue
+            session.reply = None
+            session.handle(data)
+            if session.reply is not None:
+                self._sendto(session.reply, session)
+
+    def _lookup(self, data, address):
+        """
+        returns the session a packet from address is for, None if it is for none of them
+        """
+        if len(data) < 24:
+            return None
+        sid = struct.unpack('<I', data[6:10])[0]
+        if not sid:
+            # session setup packets have the console session id in their payload
+            sid = struct.unpack('<I', data[20:24])[0]
+        session = self.bysid.get(sid)
+        if session is None or session.console_sid != sid or session.address != address:
+            return None
+        return session
+
+    def close(self):
+        """
+        close all sessions and the socket
+        """
+        self.lock.acquire()
+        try:
+            for session in self.sessions.values():
+                packet = session.close()
+                if packet is not None:
+                    self._sendto(packet, session)
+            self.sessions = {}
+            self.bysid = {}
+            self.sock.close()
+        finally:
+            self.lock.release()
+
+
+_IPMI_CLIENT = None
+_IPMI_CLIENT_LOCK = threading.Lock()
+
+
+def get_ipmi_client():
+    """
+    returns the ipmi client shared by all commands in this process
+    """
+    global _IPMI_CLIENT
+    _IPMI_CLIENT_LOCK.acquire()
+    try:
+        if _IPMI_CLIENT is None:
+            _IPMI_CLIENT = IpmiClient(get_config("IPMI_CIPHER_SUITE"), get_config("IPMI_RETRY"))
+            atexit.register(_IPMI_CLIENT.close)
+        return _IPMI_CLIENT
+    finally:
+        _IPMI_CLIENT_LOCK.release()
+
+
+class IpmiException(Exception):
+    """
+    IpmiException
+    thrown for unsupported commands and ipmi packets that can't be used
+    """
+    pass
@@ -35,11 +35,13 @@ Created on Oct 13, 2011
 '''
 
 import re
+import time
 
 from clusters import Cluster
 from config import get_config
 from monitoring import Icinga
-from nodes import CompositeNode, NodeException
+from nodes import CompositeNode, Node, NodeException
+from power import PowerOnSequencer, PowerStateWaiter
 from vsc.utils import fancylogger
 
 
@@ -79,9 +81,11 @@ class Manager(object):
             self.cluster = Cluster.getCluster(options.cluster)
 
         self.log.debug("creating cluster: %s" % self.cluster)
+        # read-only selections may use node states saved by an earlier run
+        self.cluster.max_staleness = options.max_staleness
 
-        # group by chassis
-        self.group_by_chassis = (hasattr(self.cluster, "group_by_chassis") and self.cluster.group_by_chassis)
+        # limits on the number of nodes using the same chassis, bmc, ... at the same time
+        self.limits = self.cluster.limits
 
         # get nodes from cluster
         self.nodes = self.getNodes()
@@ -90,6 +94,10 @@ class Manager(object):
         # monitoring service
         self.monitoring = Icinga(self.nodes.getNodes(), options.imms)
 
+        # set by parseActions for a staggered poweron, and to wait for the power state after a power action
+        self.sequencer = None
+        self.waiter = None
+
         # parse action(s)
         self.parseActions()
 
@@ -110,6 +118,67 @@ class Manager(object):
         [node002,[[command1,[out,err]]]]
         ]
         """
+        if not self._checkRun():
+            return False
+        self._startDeadline()
+
+        monout = self.monitoring.doIt()
+        self.log.debug("monitoring output: %s " % (monout))
+
+        out = self.nodes.doIt(not self.options.non_threaded, limits=self.limits, backend=self.options.backend)
+        if self.sequencer:
+            out.extend(self.sequencer.poweron(not self.options.non_threaded))
+        if self.waiter:
+            out.extend(self.waiter.wait(not self.options.non_threaded))
+        out.append(monout)
+        self.log.info("Done it")
+        return out
+
+    def iterdoit(self):
+        """
+        same as doit, but returns an iterator that yields the output of every node as soon as it is done,
+        instead of after all nodes are done. The monitoring output comes first.
+        returns False if nothing will be run
+        """
+        if not self._checkRun():
+            return False
+        self._startDeadline()
+        return self._iterdoit()
+
+    def _iterdoit(self):
+        """
+        yields the output of iterdoit
+        """
+        monout = self.monitoring.doIt()
+        self.log.debug("monitoring output: %s " % (monout))
+        yield monout
+
+        for out in self.nodes.iterDoIt(not self.options.non_threaded, limits=self.limits, backend=self.options.backend):
+            yield out
+        if self.sequencer:
+            for out in self.sequencer.iterPoweron(not self.options.non_threaded):
+                yield out
+        if self.waiter:
+            for out in self.waiter.iterWait(not self.options.non_threaded):
+                yield out
+        self.log.info("Done it")
+
+    def _startDeadline(self):
+        """
+        with the deadline option, everything on the nodes and in the monitoring has to be done
+        that many seconds from now
+        """
+        if self.options.deadline:
+            deadline = time.time() + self.options.deadline
+            self.log.debug("everything should be done in %s seconds" % self.options.deadline)
+            self.nodes.setDeadline(deadline)
+            self.monitoring.setDeadline(deadline)
+
+    def _checkRun(self):
+        """
+        check if the scheduled actions can be run, and add the master to the nodes
+        returns False if they should not be run
+        """
         # check for special nodes
         if self.hasSpecials():
             self.log.info("Selected nodes include special nodes (storage, masters,...)")
@@ -136,6 +205,8 @@ class Manager(object):
             self.nodes.add(self.cluster.getMaster())
 
         commands = self.nodes.showCommands()
+        if self.sequencer:
+            commands.extend(self.sequencer.showCommands())
         commands.append(self.monitoring.showCommands())
         if self.options.test_run:
             msg = "was going to run %s\n" % commands
@@ -144,14 +215,7 @@ class Manager(object):
             return False
         else:
             self.log.info("Going to run: %s" % commands)
-
-        monout = self.monitoring.doIt()
-        self.log.debug("monitoring output: %s " % (monout))
-
-        out = self.nodes.doIt(not self.options.non_threaded, group_by_chassis=self.group_by_chassis)
-        out.append(monout)
-        self.log.info("Done it")
-        return out
+        return True
 
     def getNodes(self):
         """
@@ -163,9 +227,11 @@ class Manager(object):
         if options.chassis:
             self.log.debug("option chassis: %s" % options.chassis)
             nodes.union(cluster.getNodesFromChassis(options.chassis, options.quattor))
+        # the states of the down, idle and offline selections are looked up together
+        states = []
         if options.down:
             self.log.debug("option down")
-            nodes.union(cluster.getDownNodes())
+            states.append(Node.DOWN)
         if options.all_nodes:
             self.log.debug("option all")
             tnodes = cluster.getAllNodes(quattor=bool(options.quattor))
@@ -178,10 +244,12 @@ class Manager(object):
 
         if options.idle:
             self.log.debug("option idle")
-            nodes.union(cluster.getIdleNodes())
+            states.append(Node.FREE)
         if options.offline:
             self.log.debug("option offline")
-            nodes.union(cluster.getOfflineNodes())
+            states.append(Node.OFFLINE)
+        if states:
+            nodes.union(cluster.getNodesInStates(states))
 
         if options.storage:
             self.log.debug("found --storage option: %s" % options.master)
@@ -293,7 +361,9 @@ class Manager(object):
         txt = "\nNodes - Chassis interface - Location        "\
               " tcpping - alivessh - pbs state - hwstate \n"
         txt += '-' * len(txt) + "\n"
-        statusses = self.nodes.getStatus(forced=False, threaded=(not self.options.non_threaded), group_by_chassis=self.group_by_chassis)
+        self._startDeadline()
+        statusses = self.nodes.getStatus(forced=False, threaded=(not self.options.non_threaded),
+                                         limits=self.limits, backend=self.options.backend)
         # parse results
         errors = {}
         for status in statusses:
@@ -354,7 +424,11 @@ class Manager(object):
         if options.powercut:
             self.nodes.powercut()
         if options.poweron:
-            self.nodes.poweron()
+            if options.staggered:
+                # this runs after the other actions, in waves
+                self.sequencer = PowerOnSequencer(self.nodes)
+            else:
+                self.nodes.poweron()
         if options.reboot:
             self.nodes.softreboot()
         if options.hardreboot:
@@ -363,6 +437,9 @@ class Manager(object):
             self.nodes.setonline()
         if options.pbsmomrestart:
             self.nodes.pbsmomrestart()
+        if options.wait and (options.poweron or options.hardreboot or options.poweroff or options.powercut):
+            # this runs after all other actions
+            self.waiter = PowerStateWaiter(self.nodes, on=bool(options.poweron), cycle=bool(options.hardreboot))
         if options.poweroff or options.hardreboot or options.powercut or options.reboot:
             if not options.downtime:
                 downtime = get_config('DOWN_TIME')
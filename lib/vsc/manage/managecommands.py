@@ -28,16 +28,22 @@ Created on Oct 21, 2011
 @author: Jens Timmerman
 '''
 from config import get_config
+from connections import get_ssh_pool, get_telnet_pool
+from eventloop import Offload, Return, Sleep, WaitRead, WaitWrite, run_coroutines
+from ipmi import IPMI_PORT, get_ipmi_client
+from pbsnodes import PBSNODES_XML, parse_pbsnodes
 from subprocess import Popen, PIPE
 from vsc.utils import fancylogger
-import datetime
+import errno
+import fcntl
 import getpass
 import os
 import re
+import select
 import signal
 import socket
 import struct
-import telnetlib
+import threading
 import time
 import traceback
 import warnings
@@ -63,6 +69,7 @@ class Worker(object):
             self.commands = commands  # queue commands here, these will be run when doIt is called
         else:
             self.commands = []
+        self.deadline = None
 
     def _adcommand(self, command):
         """
@@ -80,9 +87,43 @@ class Worker(object):
         """
         outputs = []
         for command in self.commands:
+            if command.expired():
+                self.log.info("deadline passed, not running %s" % command)
+                outputs.append([command, (None, 'command timed out')])
+                continue
             outputs.append([command, command.run()])
         return outputs
 
+    def adoIt(self):
+        """
+        awaitable variant of doIt, the commands are still run one by one
+        """
+        outputs = []
+        for command in self.commands:
+            if command.expired():
+                self.log.info("deadline passed, not running %s" % command)
+                outputs.append([command, (None, 'command timed out')])
+                continue
+            outputs.append([command, (yield command.arun())])
+        yield Return(outputs)
+
+    def setDeadline(self, deadline):
+        """
+        set the time (in seconds since the epoch) by which all queued commands should be done,
+        commands that did not start by then are not run anymore and report they timed out.
+        None removes the deadline
+        """
+        self.deadline = deadline
+        for command in self.commands:
+            command.setDeadline(deadline)
+
+    def cancel(self):
+        """
+        stop all queued commands, see Command.cancel
+        """
+        for command in self.commands:
+            command.cancel()
+
     def showCommands(self):
         """
         shows a list of commands to be run when doIt is called
@@ -106,6 +147,10 @@ class Command(object):
         self.command = command
         self.host = host
         self.timeout = int(timeout)
+        self.deadline = None  # set by setDeadline, the timeout is cut short to end by then
+        self.cancelled = False
+        self.resources = []  # functions closing what a running command is waiting on, for cancel
+        self.lock = threading.Lock()
 
     def __str__(self):
         return "going to run on %s: %s" % (self.host, str(self.getCommand()))
@@ -119,40 +164,329 @@ class Command(object):
         """
         return self.command
 
+    def setDeadline(self, deadline):
+        """
+        make this command end by deadline (in seconds since the epoch), None removes the deadline
+        this starts a new run, so it also undoes an earlier cancel
+        """
+        self.deadline = deadline
+        self.cancelled = False
+
+    def getTimeout(self):
+        """
+        returns the number of seconds this command can still take: its timeout, or less if the deadline is closer
+        """
+        if self.deadline is None:
+            return self.timeout
+        return max(min(self.timeout, self.deadline - time.time()), 0)
+
+    def expired(self):
+        """
+        returns True if this command got cancelled or its deadline has passed
+        """
+        return self.cancelled or (self.deadline is not None and time.time() >= self.deadline)
+
+    def cancel(self):
+        """
+        stop this command from another thread, f.ex. when the operation running it timed out
+        it won't be started anymore, and the process, channel or socket it is waiting on is closed,
+        so the thread running it is free again right away.
+        """
+        self.lock.acquire()
+        self.cancelled = True
+        resources, self.resources = self.resources, []
+        self.lock.release()
+        for close in resources:
+            try:
+                close()
+            except Exception, ex:
+                self.log.debug("closing %s of cancelled %s failed: %s" % (close, self, ex))
+
+    def _register(self, close):
+        """
+        register close, a function closing a live resource (process, channel, socket) of the running command,
+        so cancel can stop it. If the command is cancelled already, close is called right away.
+        """
+        self.lock.acquire()
+        cancelled = self.cancelled
+        if not cancelled:
+            self.resources.append(close)
+        self.lock.release()
+        if cancelled:
+            close()
+
+    def _release(self):
+        """
+        forget the registered resources, the command is done with them
+        """
+        self.lock.acquire()
+        self.resources = []
+        self.lock.release()
+
     def run(self):
         """
         Run commands
+        The output pipes are drained while the process runs, so it can't block on a full pipe,
+        and the process is killed as soon as it runs over its timeout.
         """
         self.log.debug("Run going to run %s" % self.command)
-        start = datetime.datetime.now()
-        # TODO: (high) buffer overflow here sometimes, check what happens and fix
-        # see easybuild/buildsoft/async
-        p = Popen(self.command, shell=True, stdout=PIPE, stderr=PIPE, close_fds=True)
-        timedout = False
-        while p.poll() is None:
-            time.sleep(1)
-            if os.path.exists("/proc/%s" % (p.pid)):
-                now = datetime.datetime.now()
-                if (now - start).seconds > self.timeout:
-                    if timedout is False:
-                        os.kill(p.pid, signal.SIGTERM)
-                        self.log.debug("Timeout occured with cmd %s. took more than %i secs to complete." %
-                                       (self.command, self.timeout))
-                        timedout = True
-                    else:
-                        os.kill(p.pid, signal.SIGKILL)
-        out = p.stdout.read().strip()
-        err = p.stderr.read().strip()
+        p = Popen(self.command, shell=True, stdout=PIPE, stderr=PIPE, close_fds=True, preexec_fn=os.setpgrp)
+        self._register(lambda: signal_process(p, signal.SIGKILL))
+        try:
+            reader = PipeReader(p)
+            deadline = time.time() + self.getTimeout()
+            timedout = not reader.drain(deadline)
+            if not timedout:
+                timedout = not wait_for_exit(p, deadline)
+        finally:
+            self._release()
+        timedout = timedout or self.cancelled
+        if timedout:
+            self.log.debug("Timeout occured with cmd %s. took more than %i secs to complete." %
+                           (self.command, self.timeout))
+            kill_process(p)
+        return self._processResult(p, reader, timedout)
+
+    def arun(self):
+        """
+        Awaitable variant of run, a coroutine for the EventLoop (see vsc.manage.eventloop)
+        The pipes of the process are polled by the event loop instead of a thread.
+        """
+        self.log.debug("Run going to run %s" % self.command)
+        p = Popen(self.command, shell=True, stdout=PIPE, stderr=PIPE, close_fds=True, preexec_fn=os.setpgrp)
+        self._register(lambda: signal_process(p, signal.SIGKILL))
+        reader = PipeReader(p)
+        deadline = time.time() + self.getTimeout()
+        try:
+            while reader.fds and time.time() < deadline:
+                for fd in (yield WaitRead(reader.fds, deadline)):
+                    reader.read(fd)
+            delay = 0.001
+            while not reader.fds and p.poll() is None and time.time() < deadline:
+                yield Sleep(min(delay, deadline - time.time()))
+                delay = min(delay * 2, 0.1)
+        except BaseException:
+            # the coroutine got cancelled, nothing can be waited for here anymore
+            if p.poll() is None:
+                self.log.debug("cmd %s got cancelled, killing it" % self.command)
+                kill_in_background(p)
+            raise
+        finally:
+            self._release()
+        # like in run: output that was not read to the end by the deadline is a timeout, even if the process exited
+        timedout = bool(reader.fds) or p.poll() is None or self.cancelled
+        if timedout:
+            self.log.debug("Timeout occured with cmd %s. took more than %i secs to complete." %
+                           (self.command, self.timeout))
+            signal_process(p, signal.SIGTERM)
+            for _ in range(10):
+                if p.poll() is not None:
+                    break
+                yield Sleep(0.1)
+            else:
+                kill_process(p)
+        yield Return(self._processResult(p, reader, timedout))
+
+    def _processResult(self, process, reader, timedout):
+        """
+        collect the output of a finished process
+        returns out, err
+        """
+        out, err = reader.output()
+        process.stdout.close()
+        process.stderr.close()
 
-        ec = p.returncode
+        if timedout:
+            self.log.info("Problem occured with cmd %s: out %s, err %s" % (self.command, out, err))
+            return out or None, 'command timed out'
+
+        ec = process.returncode
         if ec:
             err += " exitcode: %d" % ec
             self.log.info("Problem occured with cmd %s: out %s, err %s" % (self.command, out, err))
         else:
             self.log.debug("cmd %s on %s: %s" % (self.command, self.host, out))
+        return self.parseOutput(out, err)
+
+    def parseOutput(self, out, err):
+        """
+        post process the output of the command
+        override this to parse the output, returns out, err
+        """
         return out, err
 
 
+class PipeReader(object):
+    """
+    Collects the stdout and stderr of a running process
+    The pipes are made non blocking, so they can be read as soon as poll reports data on them.
+    """
+    def __init__(self, process):
+        """
+        constructor
+        process is a Popen object with stdout and stderr set to PIPE
+        """
+        self.stdout = process.stdout.fileno()
+        self.stderr = process.stderr.fileno()
+        self.buffers = {self.stdout: [], self.stderr: []}
+        self.fds = [self.stdout, self.stderr]  # fds that did not reach EOF yet
+        for fd in self.fds:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def read(self, fd):
+        """
+        read what is available on fd, returns False once EOF is reached
+        """
+        try:
+            data = os.read(fd, 65536)
+        except OSError, ex:
+            if ex.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            raise
+        if not data:
+            self.fds.remove(fd)
+            return False
+        self.buffers[fd].append(data)
+        return True
+
+    def drain(self, deadline):
+        """
+        read both pipes until they are closed or the deadline (in seconds since the epoch) has passed
+        returns False if the deadline passed before reaching EOF
+        """
+        while self.fds:
+            for fd in wait_for_fds(self.fds, deadline - time.time()):
+                self.read(fd)
+            if self.fds and time.time() >= deadline:
+                return False
+        return True
+
+    def output(self):
+        """
+        returns the stripped output collected so far as out, err
+        """
+        return ''.join(self.buffers[self.stdout]).strip(), ''.join(self.buffers[self.stderr]).strip()
+
+
+def wait_for_fds(fds, timeout):
+    """
+    wait until at least one of the given file descriptors is readable (or closed), for at most timeout seconds
+    returns the list of ready fds
+    poll is used instead of select, this does not break on fds above FD_SETSIZE
+    """
+    if timeout <= 0:
+        timeout = 0
+    poller = select.poll()
+    for fd in fds:
+        poller.register(fd, select.POLLIN | select.POLLPRI)
+    try:
+        # poll takes milliseconds
+        events = poller.poll(int(timeout * 1000) + 1)
+    except select.error, ex:
+        if ex.args[0] == errno.EINTR:
+            return []
+        raise
+    return [fd for fd, _ in events]
+
+
+class ChannelWaker(object):
+    """
+    lets another thread stop a thread that waits for data on a paramiko channel
+    Closing the channel is not enough for this: the pipe behind its fileno only signals the close once all copies of
+    it are closed, and processes forked in the meantime hold on to these.
+    """
+    def __init__(self, chan):
+        self.chan = chan
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.rfd, self.wfd = os.pipe()
+
+    def stop(self):
+        """
+        stop waiting, this can be called from any thread
+        """
+        self.lock.acquire()
+        if not self.stopped:
+            self.stopped = True
+            os.write(self.wfd, '.')
+        self.lock.release()
+
+    def wait(self, timeout):
+        """
+        wait at most timeout seconds for data or eof on the channel, or for stop
+        """
+        wait_for_fds([self.chan.fileno(), self.rfd], timeout)
+
+    def close(self):
+        """
+        close the channel, stop is a noop after this
+        """
+        self.lock.acquire()
+        if self.rfd is not None:
+            self.stopped = True
+            os.close(self.rfd)
+            os.close(self.wfd)
+            self.rfd = self.wfd = None
+        self.lock.release()
+        self.chan.close()
+
+
+def wait_for_exit(process, deadline):
+    """
+    wait for a process whose pipes are closed to exit, until deadline (in seconds since the epoch)
+    returns False if the process is still running after the deadline
+    Processes almost always exit right after closing their output, so this backs off from 1 ms.
+    """
+    delay = 0.001
+    while process.poll() is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.1)
+    return True
+
+
+def signal_process(process, sig):
+    """
+    send a signal to a process started by a Command, and to everything it started
+    (commands run in their own process group, so a shell pipeline is stopped as a whole)
+    """
+    try:
+        os.killpg(process.pid, sig)
+    except OSError:
+        # already gone
+        pass
+
+
+def kill_process(process, grace=1):
+    """
+    kill a process: send SIGTERM and SIGKILL it if it is still around after grace seconds
+    """
+    for sig, wait in ((signal.SIGTERM, grace), (signal.SIGKILL, grace)):
+        signal_process(process, sig)
+        if wait_for_exit(process, time.time() + wait):
+            return True
+    return False
+
+
+def kill_in_background(process, grace=1):
+    """
+    kill_process in a thread, for code that can't wait for it (f.ex. a coroutine that is being closed),
+    the pipes of the process are closed once it is gone
+    """
+    def kill():
+        kill_process(process, grace)
+        for pipe in (process.stdout, process.stderr):
+            if pipe is not None:
+                pipe.close()
+    thread = threading.Thread(target=kill, name="kill-%s" % process.pid)
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+
 # composite command
 class CompositeCommand(Command):
     """
@@ -169,9 +503,24 @@ class CompositeCommand(Command):
         """
         out = []
         for command in self.commands:
+            if command.expired():
+                out.append((None, 'command timed out'))
+                continue
             out.append(command.run())
         return out
 
+    def arun(self):
+        """
+        awaitable variant of run
+        """
+        out = []
+        for command in self.commands:
+            if command.expired():
+                out.append((None, 'command timed out'))
+                continue
+            out.append((yield command.arun()))
+        yield Return(out)
+
     def getCommand(self):
         """
         returns  a list of commands in this command
@@ -184,6 +533,35 @@ class CompositeCommand(Command):
         """
         self.commands.append(command)
 
+    def setDeadline(self, deadline):
+        """
+        set the deadline of all commands in this composite command
+        """
+        Command.setDeadline(self, deadline)
+        for command in self.commands:
+            command.setDeadline(deadline)
+
+    def cancel(self):
+        """
+        cancel all commands in this composite command
+        """
+        Command.cancel(self)
+        for command in self.commands:
+            command.cancel()
+
+
+def flatten_commands(commands):
+    """
+    returns the commands in a list of commands, with the CompositeCommands replaced by what is in them
+    """
+    flat = []
+    for command in commands:
+        if isinstance(command, CompositeCommand):
+            flat.extend(flatten_commands(command.commands))
+        else:
+            flat.append(command)
+    return flat
+
 
 class NetWorkCommand(Command):
     """
@@ -213,6 +591,13 @@ class NetWorkCommand(Command):
         return "%s: %s@%s:%s command: %s" % (self.__class__.__name__, self.user, self.host, str(self.port),
                                              self.command)
 
+    def arun(self):
+        """
+        awaitable variant of run
+        network commands that have no event driven implementation are run in the worker pool
+        """
+        yield Return((yield Offload(self.run)))
+
     def __str__(self):
         return self.getCommand()
 
@@ -230,30 +615,59 @@ class SshCommand(NetWorkCommand):
         for timeouts
         from http://mohangk.org/blog/2011/07/paramiko-sshclient-exec_command-timeout-workaround/
         """
-        def exec_command(self, command, bufsize=-1, timeout=get_config("COMMAND_TIMEOUT")):
+        def exec_command(self, command, bufsize=-1, timeout=get_config("COMMAND_TIMEOUT"), on_start=None):
             """
             Overwritten from SSHClient
+            The output is read as it comes in, so the channel window never fills up,
+            and this returns as soon as the exit status and the end of the output are received.
+            The channel is closed when done, stdout and stderr are in memory file objects.
             @param command: the command to execute
             @param bufsize: the buffersize
             @param timeout: the amount of seconds to wait before considering this command timed out
+            @param on_start: called with a function that stops waiting for the command, from any thread
             """
             chan = self._transport.open_session()
-            chan.settimeout(float(timeout))
-            chan.exec_command(command)
-            stdin = chan.makefile('wb', bufsize)
-            stdout = chan.makefile('rb', bufsize)
-            stderr = chan.makefile_stderr('rb', bufsize)
-            start = datetime.datetime.now()
-            while datetime.datetime.now() - start < datetime.timedelta(seconds=timeout):
-                time.sleep(1)
-                if chan.exit_status_ready():
-                    exitcode = chan.recv_exit_status()
-                    return stdin, stdout, stderr, exitcode
-            # timed out, no chance of getting stderr here, it timed out.
-            buff = StringIO.StringIO()
-            buff.write('ssh command timed out')
-            buff.seek(0)
-            return stdin, stdout, buff, 256
+            waker = ChannelWaker(chan)
+            out = []
+            err = []
+            deadline = time.time() + float(timeout)
+            exitcode = None
+            try:
+                if on_start is not None:
+                    on_start(waker.stop)
+                chan.settimeout(float(timeout))
+                # this raises when the request is refused or the transport drops, the finally still cleans up
+                chan.exec_command(command)
+                stdin = chan.makefile('wb', bufsize)
+                while True:
+                    while chan.recv_ready():
+                        out.append(chan.recv(65536))
+                    while chan.recv_stderr_ready():
+                        err.append(chan.recv_stderr(65536))
+                    if exitcode is None and chan.exit_status_ready():
+                        exitcode = chan.recv_exit_status()
+                    # output can still come in after the exit status, only stop when it's all read
+                    drained = not chan.recv_ready() and not chan.recv_stderr_ready()
+                    if exitcode is not None and (chan.eof_received or chan.closed) and drained:
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or waker.stopped or (chan.closed and drained):
+                        break
+                    if not drained:
+                        continue
+                    if chan.eof_received:
+                        # nothing more to read, only the exit status is missing
+                        chan.status_event.wait(remaining)
+                    else:
+                        # the fileno of a channel becomes readable on new (stdout or stderr) data and on eof
+                        waker.wait(remaining)
+            finally:
+                waker.close()
+            stdout = StringIO.StringIO(''.join(out))
+            if exitcode is None:
+                # timed out, no chance of getting stderr here, it timed out.
+                return stdin, stdout, StringIO.StringIO('ssh command timed out'), 256
+            return stdin, stdout, StringIO.StringIO(''.join(err)), exitcode
 
     def __init__(self, command=None, host=None, user=None, port=22, timeout=get_config("COMMAND_TIMEOUT"),
                  passwd=None):
@@ -265,36 +679,51 @@ class SshCommand(NetWorkCommand):
     def run(self):
         """
         run the command
-        This creates a ssh client, runs the command and parses the output
+        This gets a ssh connection from the pool, runs the command on a new channel and parses the output
         It returns output,errors
         """
         out = None
         err = None
-        # use our inner class
-        ssh = SshCommand.TimeoutSSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        stdin = stdout = stderr = None
+        exitcode = None
+        pool = get_ssh_pool()
         try:
-            if self.passwd:
-                # no need to use the agent or keys, we have the password
-                ssh.connect(self.host, username=self.user, password=self.passwd, allow_agent=False, look_for_keys=False)
-            else:
-                ssh.connect(self.host, username=self.user)
+            # use our inner class
+            connection = pool.get(self.host, self.user, port=self.port, passwd=self.passwd, timeout=self.getTimeout(),
+                                  client_class=SshCommand.TimeoutSSHClient)
         except Exception, ex:
             self.log.info("Problem occured trying to connect to %s error(%s): %s" % (self.host, ex.__class__, ex))
             self.log.debug(traceback.format_exc())
-            ssh.close()
             return "", "Could not connect to %s" % self.host
         self.log.debug("going to run '%s' on '%s' as '%s' (using password: %s, timeout: %s)" %
-                       (self.command, self.host, self.user, bool(self.passwd), self.timeout))
+                       (self.command, self.host, self.user, bool(self.passwd), self.getTimeout()))
         # run the command (with a timeout)
         try:
-            stdin, stdout, stderr, exitcode = ssh.exec_command(self.command, timeout=self.timeout)
+            try:
+                stdin, stdout, stderr, exitcode = connection.exec_command(self.command, timeout=self.getTimeout(),
+                                                                          on_start=self._register)
+            except paramiko.SSHException, ex:
+                if connection.is_active() or self.cancelled:
+                    # only this channel failed (or got closed by cancel), other commands might still be using
+                    # the connection
+                    raise
+                # the shared connection was closed by the other side, retry once on a new one
+                self.log.debug("Could not open a channel to %s (%s), reconnecting" % (self.host, ex))
+                pool.release(connection)
+                pool.discard(connection)
+                connection = None
+                connection = pool.get(self.host, self.user, port=self.port, passwd=self.passwd,
+                                      timeout=self.getTimeout(), client_class=SshCommand.TimeoutSSHClient)
+                stdin, stdout, stderr, exitcode = connection.exec_command(self.command, timeout=self.getTimeout(),
+                                                                          on_start=self._register)
             self.log.debug('ran ssh.exec_command')
         except Exception, ex:
             # catch the stacktrace
             self.log.info("Problem occured trying to run %s on %s: err (%s): %s" %
                           (self.command, self.host, ex.__class__.__name__, ex))
             self.log.debug(traceback.format_exc())
+            err = "%s %s " % (ex.__class__.__name__, str(ex))
+        self._release()
         # catch the output
         try:
             out = stdout.read().strip()
@@ -312,9 +741,12 @@ class SshCommand(NetWorkCommand):
         if not err and exitcode:
             # no error, but something went wrong
             err = "exitcode: %d" % exitcode
+        if self.cancelled:
+            # the channel got closed under the command
+            err = 'ssh command timed out'
 
         try:
-            # close our files
+            # close our files, the connection stays open for the next command
             self.log.debug('closing filehandlers in sshcommand')
             stdin.close()
             stdout.close()
@@ -322,7 +754,8 @@ class SshCommand(NetWorkCommand):
         except:
             pass
         self.log.debug("%s on %s returned out: %s, err: %s" % (self.command, self.host, out, err))
-        ssh.close()
+        if connection is not None:
+            pool.release(connection)
         return out, err
 
 
@@ -345,38 +778,76 @@ class TelnetCommand(NetWorkCommand):
     def run(self):
         """
         Execute telnet commands
-        - login
+        - login, unless there is a session to this host left by an earlier command
         - execute commnads
-        - logout
+        The session is kept open for the next command, see vsc.manage.connections.TelnetSessionPool
         """
         err = None
         out = None
         if not self.host:
             self.log.raiseException("No host set when trying to run %s" % self.command, NetworkCommandException)
 
+        pool = get_telnet_pool()
+        session = None
         try:
-            tn = telnetlib.Telnet(self.host)
-
-            self.log.debug("waiting for %s" % self.logintxt)
-            tn.read_until(self.logintxt)
-            tn.write(self.user + "\n")
-            if self.passwd:
-                self.log.debug("waiting for %s" % self.passwdtxt)
-                tn.read_until(self.passwdtxt)
-                tn.write(self.passwd + "\n")
-            tn.read_until(self.logofftxt)
+            session = pool.get(self.host, self.user, passwd=self.passwd, port=self.port, timeout=self.getTimeout(),
+                               logintxt=self.logintxt, passwdtxt=self.passwdtxt, prompt=self.logofftxt,
+                               logoff=self.logoff)
             self.log.debug("Run going to run %s" % self.command)
-            tn.write(self.command + "\n")
-
-            out = tn.read_until(self.logofftxt)
-            tn.write(self.logoff + "\n")
+            self._register(session.abort)
+            try:
+                out = session.run(self.command, self.getTimeout())
+            except EOFError:
+                if self.cancelled:
+                    raise
+                # the session was closed by the other side since it was last used, log in again
+                self.log.debug("telnet session to %s was closed, retrying" % self.host)
+                pool.discard(session)
+                session = None
+                session = pool.get(self.host, self.user, passwd=self.passwd, port=self.port, timeout=self.getTimeout(),
+                                   logintxt=self.logintxt, passwdtxt=self.passwdtxt, prompt=self.logofftxt,
+                                   logoff=self.logoff)
+                self._register(session.abort)
+                out = session.run(self.command, self.getTimeout())
+            self._release()
+            pool.release(session)
         except Exception, ex:
+            self._release()
+            if session is not None:
+                # don't know what state it is in
+                pool.discard(session)
             err = ex
             self.log.warning("Failed running %s on %s:%s" % (self.command, self.host, ex))
             self.log.debug(traceback.format_exc())
         self.log.debug("cmds %s on host %s ran with output: %s" % (self.command, self.host, out))
 
-        return out, err
+        return self.parseOutput(out, err)
+
+
+def aconnect(host, port, deadline, ttl=None):
+    """
+    coroutine connecting a tcp socket without blocking the event loop
+    returns the connected socket (in blocking mode), raises socket.error when it failed
+    """
+    address = yield Offload(socket.gethostbyname, host)
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if ttl:
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, struct.pack('I', ttl))
+        s.setblocking(0)
+        ec = s.connect_ex((address, port))
+        if ec in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            if not (yield WaitWrite([s.fileno()], deadline)):
+                raise socket.timeout("timed out")
+            ec = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if ec:
+            raise socket.error(ec, os.strerror(ec))
+    except:
+        s.close()
+        raise
+    s.setblocking(1)
+    s.settimeout(max(deadline - time.time(), 0.1))
+    yield Return(s)
 
 
 """ non abstract commands """
@@ -413,14 +884,29 @@ class ServerAliveCommand(NetWorkCommand):
     """
     def __init__(self, host, port=22, timeout=get_config("COMMAND_FAST_TIMEOUT")):
         NetWorkCommand.__init__(self, host=host, port=port, timeout=timeout)
+        self.sweepResult = None  # set when this host was already checked by sweep_alive_commands
+
+    TTL = 3
+
+    def setDeadline(self, deadline):
+        """
+        see Command.setDeadline, a sweep result that was not picked up in the last run is forgotten
+        """
+        NetWorkCommand.setDeadline(self, deadline)
+        self.sweepResult = None
 
     def run(self):
-        ttl = 3
+        if self.sweepResult is not None:
+            result = self.sweepResult
+            self.sweepResult = None
+            return result
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, struct.pack('I', ttl))
-        s.settimeout(self.timeout)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, struct.pack('I', self.TTL))
+        s.settimeout(self.getTimeout())
         ans = True
         err = None
+        # shutdown wakes up a connect that is waiting, close does not
+        self._register(lambda: s.shutdown(socket.SHUT_RDWR))
         try:
             s.connect((self.host, self.port))
         except Exception, ex:
@@ -428,10 +914,83 @@ class ServerAliveCommand(NetWorkCommand):
             self.log.debug(traceback.format_exc())
             ans = False
             err = ex
+        self._release()
         s.close()
         self.log.debug("tcpping host %s port %s returns %s" % (self.host, self.port, ans))
         return ans, err
 
+    def arun(self):
+        """
+        awaitable variant of run, the connect does not block the event loop
+        """
+        if self.sweepResult is not None:
+            yield Return(self.run())
+        ans = True
+        err = None
+        try:
+            s = yield aconnect(self.host, self.port, time.time() + self.getTimeout(), ttl=self.TTL)
+            s.close()
+        except Exception, ex:
+            self.log.info("tcpping on host %s failed with %s" % (self.host, ex))
+            self.log.debug(traceback.format_exc())
+            ans = False
+            err = ex
+        self.log.debug("tcpping host %s port %s returns %s" % (self.host, self.port, ans))
+        yield Return((ans, err))
+
+
+def tcp_sweep(hosts, port=22, timeout=get_config("COMMAND_FAST_TIMEOUT"), ttl=None, executor=None):
+    """
+    connect to port on all hosts at the same time, the connects are multiplexed in one EventLoop,
+    so this takes about timeout seconds no matter how many hosts there are.
+    returns a dict host -> (alive, latency, error), with the latency in seconds (None if not alive)
+    """
+    hosts = sorted(set(hosts))
+    deadline = time.time() + float(timeout)
+    coroutines = run_coroutines([_aprobe(host, port, deadline, ttl) for host in hosts], timeout=float(timeout),
+                                executor=executor)
+    results = {}
+    for host, coroutine in zip(hosts, coroutines):
+        if coroutine.done and not coroutine.error:
+            results[host] = coroutine.result
+        else:
+            results[host] = (False, None, coroutine.error or socket.timeout("timed out"))
+    return results
+
+
+def _aprobe(host, port, deadline, ttl):
+    """
+    coroutine trying to connect to host, returns alive, latency, error
+    """
+    start = time.time()
+    try:
+        s = yield aconnect(host, port, deadline, ttl=ttl)
+        s.close()
+    except Exception, ex:
+        yield Return((False, None, ex))
+    yield Return((True, time.time() - start, None))
+
+
+def sweep_alive_commands(commands, executor=None):
+    """
+    run all ServerAliveCommands in commands (and in the CompositeCommands in there) in a tcp_sweep
+    every ServerAliveCommand gets its result, so running it afterwards returns this instead of connecting again
+    returns the dict host -> (alive, latency, error) of the hosts swept
+    """
+    groups = {}
+    for command in flatten_commands(commands):
+        if isinstance(command, ServerAliveCommand) and command.sweepResult is None:
+            groups.setdefault((command.port, command.timeout, command.TTL), []).append(command)
+    swept = {}
+    for (port, _, ttl), group in groups.items():
+        timeout = min(command.getTimeout() for command in group)
+        results = tcp_sweep([command.host for command in group], port, timeout, ttl, executor)
+        for command in group:
+            alive, _, err = results[command.host]
+            command.sweepResult = (alive, err)
+        swept.update(results)
+    return swept
+
 
 class SoftPoweroffCommand(SshCommand):
     """
@@ -485,14 +1044,19 @@ class PbsmomCleanupCommand(SshCommand):
 class PBSNodeStateCommand(Command):
     def __init__(self, host, masternode):
         self.node = host.split(".")[0]
+        Command.__init__(self, "PBSNodeStateCommand on %s" % self.node, host=None)
         self.masternode = masternode
-        self.command = "PBSNodeStateCommand on %s" % self.node
-        self.host = None
 
     def run(self):
         # TODO: out,err in this
         return self.masternode.getPbsStatusForNode(self.node)
 
+    def arun(self):
+        """
+        the pbs state is cached on the master, this only blocks the first time
+        """
+        yield Return((yield Offload(self.run)))
+
 
 class FixDownOnErrorCommand(SshCommand):
     """
@@ -520,27 +1084,119 @@ class MasterStatusCommand(CompositeCommand):
         self.addCommand(ServerRespondingCommand(host, timeout=timeout))
 
 
+def command_line_limit():
+    """
+    returns the maximum length of a command line run over ssh
+    sshd hands the whole line to the shell as a single argument, so it has to fit in MAX_ARG_STRLEN (32 pages),
+    and in ARG_MAX with room to spare for the environment
+    """
+    try:
+        pagesize = os.sysconf('SC_PAGE_SIZE')
+        argmax = os.sysconf('SC_ARG_MAX')
+    except (ValueError, OSError):
+        pagesize, argmax = 4096, 131072
+    if argmax <= 0:
+        argmax = 131072
+    return min(32 * pagesize, argmax / 2) - 1024
+
+
+def chunk_arguments(template, arguments, limit):
+    """
+    returns the arguments split in lists, so template % ' '.join(chunk) is at most limit characters long
+    an argument that does not fit with any other one gets a list of its own
+    """
+    room = limit - len(template % '')
+    chunks = []
+    chunk = []
+    size = 0
+    for argument in arguments:
+        # one more for the space in front
+        if chunk and size + 1 + len(argument) > room:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        if chunk:
+            size += 1
+        chunk.append(argument)
+        size += len(argument)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def node_errors(nodes, err):
+    """
+    returns a dict with the nodes (as given to pbsnodes) that err, the errors of one pbsnodes run, complains about,
+    and the lines of err about them. When err names none of them, it is taken to be about all of them.
+    """
+    if not err:
+        return {}
+    lines = err.splitlines()
+    errors = {}
+    for node in nodes:
+        regex = re.compile(r"\b%s\b" % re.escape(node.split('.')[0]))
+        about = [line.strip() for line in lines if regex.search(line)]
+        if about:
+            errors[node] = "; ".join(about)
+    if not errors:
+        errors = dict([(node, err.strip()) for node in nodes])
+    return errors
+
+
 class MasterCommand(SshCommand):
     """
     run a commad on the master for a list of nodes
     The command will have to be a template with one string in it
     for interpolation.
-    This command will be run on the master over ssh, with every string in nodelist used once
-    as an argument for string interpolation in the command string.
+    This command will be run on the master over ssh, with the space separated nodelist as the string,
+    so one invocation handles all nodes. When that would make the command line too long (see command_line_limit),
+    the nodes are split over several invocations, each on its own channel.
     """
-    def __init__(self, master, nodelist, commandtpl):
+    def __init__(self, master, nodelist, commandtpl, limit=None):
         """
         constructor
+        limit is the maximum length of the command line, computed by command_line_limit by default
         """
         self.commandtpl = commandtpl
+        if limit is None:
+            limit = command_line_limit()
+        self.limit = limit
+        self.failed = {}  # node: error, for the nodes the last run did not work for
+        SshCommand.__init__(self, None, master)
         self.setNodeList(nodelist)
-        SshCommand.__init__(self, self.command, master)
 
     def setNodeList(self, nodelist):
         """
         Set the NodeList to run this command on
         """
-        self.command = ";".join([self.commandtpl % node for node in nodelist])
+        self.chunks = chunk_arguments(self.commandtpl, nodelist, self.limit)
+        self.command = ";".join([self.commandtpl % " ".join(chunk) for chunk in self.chunks])
+
+    def run(self):
+        """
+        runs the command for every chunk of nodes
+        returns out, the output of all invocations, and err, a line per node the command did not work for,
+        these nodes and their errors are in self.failed as well
+        """
+        command = self.command
+        outs = []
+        self.failed = {}
+        try:
+            for chunk in self.chunks:
+                if self.expired():
+                    self.failed.update([(node, 'command timed out') for node in chunk])
+                    continue
+                self.command = self.commandtpl % " ".join(chunk)
+                out, err = SshCommand.run(self)
+                if out:
+                    outs.append(out)
+                self.failed.update(node_errors(chunk, err))
+        finally:
+            self.command = command
+        if self.failed:
+            self.log.warning("%s failed for %d nodes on %s" % (self.commandtpl, len(self.failed), self.host))
+        err = "\n".join(["%s: %s" % (node, self.failed[node]) for node in sorted(self.failed)])
+        return "\n".join(outs), err
 
 
 class SetOnlineMasterCommand(MasterCommand):
@@ -553,7 +1209,7 @@ class SetOnlineMasterCommand(MasterCommand):
         """
         constructor
         """
-        MasterCommand.__init__(self, master, nodelist, "sudo pbsnodes -c %s ")
+        MasterCommand.__init__(self, master, nodelist, "sudo pbsnodes -c %s")
 
 
 class SetOfflineMasterCommand(MasterCommand):
@@ -566,7 +1222,7 @@ class SetOfflineMasterCommand(MasterCommand):
         """
         constructor
         """
-        MasterCommand.__init__(self, master, nodelist, "sudo pbsnodes -o %s ")
+        MasterCommand.__init__(self, master, nodelist, "sudo pbsnodes -o %s")
 
 
 # custom commands
@@ -586,13 +1242,14 @@ class FullStatusCommand(MasterStatusCommand):
 
 class PBSStateCommand(SshCommand):
     """
-    returns  the full pbsstate of a node
+    returns the full pbsstate of all nodes of a master,
+    as a dict with the short node names as keys and PbsNode records (see vsc.manage.pbsnodes) as values
     """
     def __init__(self, host, timeout=get_config("COMMAND_TIMEOUT")):
         """
         constructor
         """
-        SshCommand.__init__(self, command="sudo pbsnodes | grep -v 'status\|jobs'", host=host, timeout=timeout)
+        SshCommand.__init__(self, command="sudo %s" % PBSNODES_XML, host=host, timeout=timeout)
         self.masternode = host
 
     def run(self):
@@ -600,14 +1257,15 @@ class PBSStateCommand(SshCommand):
         runs the commando
         """
         out, err = SshCommand.run(self)
+        if not out:
+            return {}, err or "no output from pbsnodes on %s" % self.masternode
         try:
-            # no templates here, commands are basically the templates themselves.
-            out = re.findall("(node\d+).*?.vsc\n.*state = (.*?)\n", out)
-            out = dict(out)
+            out = parse_pbsnodes(out)
         except Exception, ex:
             self.log.warning("could not parse pbsnodes output : %s" % ex)
             self.log.debug(traceback.format_exc())
             err = ex
+            out = {}
         return out, err
 
 
@@ -634,6 +1292,22 @@ class MoabRestartCommand(SshCommand):
     def __init__(self, host, timeout=get_config("COMMAND_TIMEOUT")):
         SshCommand.__init__(self, command='sudo mschedctl -R', host=host, timeout=timeout)
 
+
+def is_powered_on(out):
+    """
+    returns True if out, the output of a power state command (ImmStateCommand, BladeStateCommand, DracStatusCommand or
+    IpmiStatusCommand), says the power is on
+    """
+    return bool(out) and re.search(r"\bon$", out.strip(), re.IGNORECASE) is not None
+
+
+def is_powered_off(out):
+    """
+    returns True if out, the output of a power state command, says the power is off (see is_powered_on)
+    """
+    return bool(out) and re.search(r"\boff$", out.strip(), re.IGNORECASE) is not None
+
+
 # IMM's
 
 
@@ -670,8 +1344,7 @@ class ImmSoftRebootCommand(ImmCommand):
 class ImmStateCommand(ImmCommand):
     COMMAND = 'power state'
 
-    def run(self):
-        out, err = ImmCommand.run(self)
+    def parseOutput(self, out, err):
         if err or not out:
             return out, err
         # power state\r\nPower: On\r\nState: Booting OS\r\n\r\nsystem>
@@ -709,6 +1382,24 @@ class BladeCommand(SshCommand):
         real_command = "%s -T system:blade[%s]" % (command, slot)
         SshCommand.__init__(self, command=real_command, host=chassisname, user=get_config("BLADEUSER"),
                             passwd=get_config("BLADEPASSWD"))
+        self.batchResult = None  # set when this command already ran in a BladeBatchCommand
+
+    def setDeadline(self, deadline):
+        """
+        see Command.setDeadline, a batch result that was not picked up in the last run is forgotten
+        """
+        SshCommand.setDeadline(self, deadline)
+        self.batchResult = None
+
+    def run(self):
+        """
+        run the command, or return the result it got from a BladeBatchCommand
+        """
+        if self.batchResult is not None:
+            result = self.batchResult
+            self.batchResult = None
+            return result
+        return SshCommand.run(self)
 
 
 class BladePoweroffCommand(BladeCommand):
@@ -746,6 +1437,130 @@ class BladeStateCommand(BladeCommand):
         return out, err
 
 
+class BladeBatchCommand(SshCommand):
+    """
+    runs the BladeCommands for one chassis one after the other in a single shell on its management module,
+    instead of logging in on it for every slot.
+    The output of each command is handed back to it, so running it afterwards returns this output.
+    """
+    PROMPT = 'system> '
+
+    def __init__(self, chassisname, commands):
+        """
+        constructor
+        commands is a list of BladeCommands for this chassis
+        """
+        SshCommand.__init__(self, command=None, host=chassisname, user=get_config("BLADEUSER"),
+                            passwd=get_config("BLADEPASSWD"))
+        self.commands = commands
+        # the commands are queued in the same run, so they share their deadline
+        self.setDeadline(commands[0].deadline)
+
+    def getCommand(self):
+        """
+        shows what commands would be run
+        """
+        return [command.getCommand() for command in self.commands]
+
+    def run(self):
+        """
+        run all commands in one shell
+        returns a list with out, err for every command that ran,
+        commands that did not run because the session failed are left to run on their own.
+        """
+        results = []
+        pool = get_ssh_pool()
+        try:
+            connection = pool.get(self.host, self.user, port=self.port, passwd=self.passwd,
+                                  timeout=self.getTimeout(), client_class=SshCommand.TimeoutSSHClient)
+        except Exception, ex:
+            self.log.info("Problem occured trying to connect to %s error(%s): %s" % (self.host, ex.__class__, ex))
+            self.log.debug(traceback.format_exc())
+            return results
+        try:
+            waker = ChannelWaker(connection.invoke_shell(self.getTimeout()))
+            self._register(waker.stop)
+            try:
+                self._readUntilPrompt(waker, time.time() + self.getTimeout())
+                for command in self.commands:
+                    if command.expired():
+                        break
+                    self.log.debug("going to run '%s' on '%s'" % (command.command, self.host))
+                    waker.chan.sendall(command.command + "\n")
+                    out = self._readUntilPrompt(waker, time.time() + command.getTimeout())
+                    results.append(self.parseShellOutput(command.command, out))
+                waker.chan.sendall("exit\n")
+            finally:
+                self._release()
+                waker.close()
+        except Exception, ex:
+            self.log.info("Problem occured running %s on %s after %d commands: err (%s): %s" %
+                          (self.getCommand(), self.host, len(results), ex.__class__.__name__, ex))
+            self.log.debug(traceback.format_exc())
+        pool.release(connection)
+        for command, result in zip(self.commands, results):
+            command.batchResult = result
+        self.log.debug("%s on %s returned %s" % (self.getCommand(), self.host, results))
+        return results
+
+    def _readUntilPrompt(self, waker, deadline):
+        """
+        read from the shell on the channel of waker until it shows the prompt again
+        returns everything before the prompt
+        """
+        chan = waker.chan
+        buf = ''
+        while not buf.endswith(self.PROMPT):
+            remaining = deadline - time.time()
+            if remaining <= 0 or waker.stopped:
+                raise NetworkCommandException("timed out waiting for %s on %s, got %s" % (self.PROMPT, self.host, buf))
+            if chan.recv_ready():
+                buf += chan.recv(65536)
+            elif chan.eof_received or chan.closed:
+                raise NetworkCommandException("shell on %s closed, got %s" % (self.host, buf))
+            else:
+                waker.wait(remaining)
+        return buf[:-len(self.PROMPT)]
+
+    def parseShellOutput(self, command, out):
+        """
+        turn what the shell showed after running command into out, err
+        the shell echoes the command, so this is left out
+        """
+        lines = out.replace('\r', '').strip().split('\n')
+        if lines and lines[0].strip() == command:
+            lines = lines[1:]
+        return "\n".join(lines).strip(), ''
+
+
+def batchable_commands(queues):
+    """
+    returns the commands at the start of every queue (a list of commands, f.ex. the queue of a node) that can run in
+    a batch, BladeCommands and IpmiCommands (or CompositeCommands of only those).
+    a node runs its commands in order, so the ones after a command that can't be batched are left to run in their turn
+    """
+    batchable = []
+    for queue in queues:
+        for command in queue:
+            if [sub for sub in flatten_commands([command]) if not isinstance(sub, (BladeCommand, IpmiCommand))]:
+                break
+            batchable.append(command)
+    return batchable
+
+
+def batch_blade_commands(commands):
+    """
+    group the BladeCommands in commands (and in the CompositeCommands in there) per chassis
+    returns a BladeBatchCommand for every chassis with more than one of them,
+    commands that still have the result of an earlier batch are left out
+    """
+    chassis = {}
+    for command in flatten_commands(commands):
+        if isinstance(command, BladeCommand) and command.batchResult is None:
+            chassis.setdefault(command.host, []).append(command)
+    return [BladeBatchCommand(host, chassis[host]) for host in sorted(chassis) if len(chassis[host]) > 1]
+
+
 class FullBladeStatusCommand(FullStatusCommand):
     """
     returns  the full status of a blade node
@@ -788,11 +1603,10 @@ class DracRebootCommand(DracCommand):
 class DracStatusCommand(DracCommand):
     COMMAND = 'powerstatus'
 
-    def run(self):
+    def parseOutput(self, out, err):
         """
         parse the output of the DracStatusCommand
         """
-        out, err = DracCommand.run(self)
         if err:
             return out, err
 
@@ -817,22 +1631,81 @@ class DracFullStatusCommand(FullStatusCommand):
         self.addCommand(DracStatusCommand(adminhost))
 
 
-# ipmitool commands (crappy bmc and HP gen8)
-# TODO: write an python-api for ipmitool.
+# ipmi commands (crappy bmc and HP gen8)
 class IpmiCommand(Command):
     """
     commands for ipmi enabled bmc/dracs
+    these are sent by the ipmi client in vsc.manage.ipmi, without running ipmitool,
+    use batch_ipmi_commands to run the commands for a lot of nodes at the same time.
     """
-    PROTOCOL = 'lanplus'
     COMMAND = 'status'
 
-    def __init__(self, hostname, clustername, command=None):
+    def __init__(self, hostname, clustername, command=None, port=IPMI_PORT):
         if not command:
             command = self.COMMAND
-        real_command = "sudo ipmitool -I %s -H %s -U %s -P '%s' chassis power %s" % (
-            self.PROTOCOL, hostname, get_config('IMM_USER_%s' % clustername.upper()), get_config('IMMPASSWD'), command
-        )
-        Command.__init__(self, real_command)
+        Command.__init__(self, "chassis power %s" % command, host=hostname)
+        self.power = command
+        self.port = port
+        self.user = get_config('IMM_USER_%s' % clustername.upper())
+        self.passwd = get_config('IMMPASSWD')
+        self.batchResult = None  # set when this command already ran in batch_ipmi_commands
+
+    def setDeadline(self, deadline):
+        """
+        see Command.setDeadline, a batch result that was not picked up in the last run is forgotten
+        """
+        Command.setDeadline(self, deadline)
+        self.batchResult = None
+
+    def request(self):
+        """
+        returns the request for IpmiClient.run
+        """
+        return self.host, self.port, self.user, self.passwd, self.power
+
+    def getCommand(self):
+        """
+        shows what commands would be run
+        """
+        return "%s: %s@%s:%s command: %s" % (self.__class__.__name__, self.user, self.host, str(self.port),
+                                             self.command)
+
+    def run(self):
+        """
+        run the command, or return the result it got from batch_ipmi_commands
+        """
+        if self.batchResult is not None:
+            result = self.batchResult
+            self.batchResult = None
+            return result
+        self.log.debug("Run going to run %s on %s" % (self.command, self.host))
+        out, err = get_ipmi_client().run([self.request()], self.getTimeout())[0]
+        if err:
+            self.log.info("Problem occured with cmd %s on %s: out %s, err %s" % (self.command, self.host, out, err))
+        return out, err
+
+    def arun(self):
+        """
+        awaitable variant of run
+        """
+        yield Return((yield Offload(self.run)))
+
+
+def batch_ipmi_commands(commands):
+    """
+    run all IpmiCommands in commands (and in the CompositeCommands in there) at the same time,
+    every command gets its result, so running it afterwards returns this instead of running again
+    returns the number of commands that ran
+    """
+    ipmi = [command for command in flatten_commands(commands)
+            if isinstance(command, IpmiCommand) and command.batchResult is None]
+    if not ipmi:
+        return 0
+    timeout = max(command.getTimeout() for command in ipmi)
+    results = get_ipmi_client().run([command.request() for command in ipmi], timeout)
+    for command, result in zip(ipmi, results):
+        command.batchResult = result
+    return len(ipmi)
 
 
 class IpmiPoweroffCommand(IpmiCommand):
@@ -907,6 +1780,9 @@ class NotSupportedCommand(Command):
         self.log.warning("command not supported (yet) %s" % self.command)
         return self.command, "Not supported yet by manage!"
 
+    def arun(self):
+        yield Return(self.run())
+
 
 # test commands
 class TestCommand(Command):
@@ -918,6 +1794,9 @@ class TestCommand(Command):
         self.log.info("testcommand: %s" % self.command)
         return "running testcommand: %s" % self.command, None
 
+    def arun(self):
+        yield Return(self.run())
+
 
 # Exceptions
 class NetworkCommandException(Exception):
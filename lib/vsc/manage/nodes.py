@@ -27,19 +27,16 @@ Created on Oct 17, 2011
 
 @author: Jens Timmerman
 '''
-try:
-    import json
-except ImportError:
-    import simplejson as json
-
-import gzip
 import os
-import re
-import threading
+import time
 import traceback
 
 from vsc.utils import fancylogger
 from vsc.manage.config import get_config
+from vsc.manage.eventloop import EventLoop, Return
+from vsc.manage.pbsnodes import PbsStateCache, index_states
+from vsc.manage.quattor import extract_many, get_profile_index, read_json_paths
+from vsc.manage.scheduler import LimitedExecutor, ResourceLimits, get_worker_pool
 
 from managecommands import BladeSoftPoweroffCommand, BladePoweronCommand, \
     BladePoweroffCommand, TestCommand, Command, FullStatusCommand, \
@@ -52,7 +49,20 @@ from managecommands import BladeSoftPoweroffCommand, BladePoweronCommand, \
     ImmPoweronCommand, ImmPoweroffCommand, ImmRebootCommand, \
     FullImmStatusCommand, MoabPauseCommand, MoabResumeCommand, MoabRestartCommand, \
     Worker, NotSupportedCommand, DMTFSMASHCLPLEDOnCommand, \
-    DMTFSMASHCLPLEDOffCommand, FixDownOnErrorCommand
+    DMTFSMASHCLPLEDOffCommand, FixDownOnErrorCommand, batch_blade_commands, batch_ipmi_commands, batchable_commands, \
+    sweep_alive_commands, ImmStateCommand, BladeStateCommand, DracStatusCommand, IpmiStatusCommand
+
+# execution backends for threaded operations on compositenodes
+THREADS = 'threads'
+EVENTLOOP = 'eventloop'
+
+# kinds of resources nodes share, the number of nodes using one of these at the same time can be limited
+CHASSIS = 'chassis'
+RACK = 'rack'
+BMC = 'bmc'
+
+# seconds the nodes get after the deadline to hand in what they have, their own commands stop at the deadline
+DEADLINE_GRACE = 1
 
 
 class Node(Worker):
@@ -131,6 +141,8 @@ class Node(Worker):
         # self.ledoncommand = NotSupportedCommand("ledon")
 
         self.statusCommand = None
+        # only asks for the power state, to confirm a poweron
+        self.powerStateCommand = None
 
         self.rebootCommand = None
 
@@ -154,6 +166,34 @@ class Node(Worker):
 
         return self.status
 
+    def agetStatus(self, forced=False):
+        """
+        awaitable variant of getStatus
+        """
+        if not self.status or forced:
+            self.log.debug("getting node %s status by running %s" % (self, self.statusCommand))
+            out = yield self.statusCommand.arun()
+            self.log.info("status for %s: %s" % (self.nodeid, out))
+            self.status = out
+
+        yield Return(self.status)
+
+    def setDeadline(self, deadline):
+        """
+        set the deadline of the queued commands and the status command
+        """
+        Worker.setDeadline(self, deadline)
+        if self.statusCommand:
+            self.statusCommand.setDeadline(deadline)
+
+    def cancel(self):
+        """
+        stop the queued commands and the status command, when they are running in another thread
+        """
+        Worker.cancel(self)
+        if self.statusCommand:
+            self.statusCommand.cancel()
+
     def getPbsStatus(self):
         """
         get the status of this node
@@ -315,37 +355,38 @@ class Node(Worker):
 
     def _getQuattorElementFromJSON(self, jsonpath, path):
         """
-        Get quattor files and parse the json and return the content
-        of a given json path.
+        Get quattor files and return the content of a given json path.
+        only the profile up to the json path is read, see quattor.JsonPathReader
         """
         self.log.debug("jsonpath: %s" % str(jsonpath))
-        if "gz" in path:
-            path = gzip.open(path)
-        out = json.load(path)
-        for x in jsonpath.split(","):
-            out = out[x.strip()]
-        return out
+        out = read_json_paths(path, {'element': jsonpath})
+        if 'element' not in out:
+            raise KeyError(jsonpath)
+        return out['element']
+
+    def _getQuattorFields(self):
+        """
+        returns the commonly used fields of the quattor profile of this node (see vsc.manage.quattor),
+        from the profile index, so the profile is only parsed when it changed
+        """
+        return get_profile_index().get(self._getQuattorPath())
 
     def _getLocation(self):
         """
         find location,chassis of this node using quattor
         """
-        path = self._getQuattorPath()
-        location = self._getQuattorElementFromJSON(get_config("LOCATION_JSON"), path)
+        fields = self._getQuattorFields()
+        location = fields['location']
         self.log.debug("location: %s" % location)
-        content1 = re.search(get_config("QUATTOR_LOCATION_STRING_REGEX"), location)
 
-        if len(location) < 1 or not content1:
+        if 'chassis' not in fields:
             self.log.debug("No chassis and slot location found for node %s in %s" % (self, get_config("QUATTOR_PATH")))
             return location, "None"
 
-        # parse  content
-        values1 = content1.groupdict()
-        chassis = int(values1['chassis'])
-        slot = int(values1['slot'])
-        chassisname = get_config("CHASISNAME_TPL") % {'chassisname': chassis, 'clustername': self.clustername}
+        chassisname = get_config("CHASISNAME_TPL") % {'chassisname': fields['chassis'],
+                                                      'clustername': self.clustername}
 
-        return slot, chassisname
+        return fields['slot'], chassisname
 
     def getSlot(self):
         """
@@ -369,6 +410,12 @@ class Node(Worker):
             _, self.chassisname = self._getLocation()
         return self.chassisname
 
+    def getRack(self):
+        """
+        return the name of the rack of this node, from quattor
+        """
+        return self._getQuattorFields()['rack']
+
     def getMaster(self):
         """
         returns a master of this node
@@ -376,6 +423,31 @@ class Node(Worker):
         self.log.debug("getmaster called on %s" % self)
         return self.masternode
 
+    def getResources(self, kinds):
+        """
+        returns the resources of the given kinds this node uses when it runs its commands, as a dict kind: name
+        CHASSIS is the chassis the node is in, RACK its rack (and power distribution)
+        and BMC the management controller (imm) its power commands go to.
+        """
+        resources = {}
+        if CHASSIS in kinds:
+            try:
+                chassis = self.getChassis()
+            except NodeException, ex:
+                chassis = "None"
+                self.log.debug("No chassis for %s, not limiting it per chassis: %s" % (self, ex))
+            if chassis != "None":
+                # nodes without a known location don't share a chassis
+                resources[CHASSIS] = chassis
+        if RACK in kinds:
+            try:
+                resources[RACK] = self.getRack()
+            except (NodeException, KeyError, TypeError), ex:
+                self.log.debug("No rack for %s, not limiting it per rack: %s" % (self, ex))
+        if BMC in kinds:
+            resources[BMC] = self.immname
+        return resources
+
     def __repr__(self):
         return self.nodeid
 
@@ -386,8 +458,12 @@ class CompositeNode(Node):
     a compositenode can contain multiple nodes and delegate calls to them
     """
 
-    def __init__(self, clustername=None, masternode=None, nodeid=None, timeout=None):
-
+    def __init__(self, clustername=None, masternode=None, nodeid=None, timeout=None, executor=None):
+        """
+        constructor
+        executor is the WorkerPool used for threaded operations,
+        if it is not given the worker pool shared by the whole process is used
+        """
         Node.__init__(self, nodeid, clustername, masternode)  # we're not a real node, so no id
         self.nodes = {}
         self.threads = None
@@ -395,6 +471,7 @@ class CompositeNode(Node):
             # times 2 to give other commands to timeout before we timeout here
             timeout = int(get_config('COMMAND_TIMEOUT')) * 2
         self.timeout = timeout
+        self.executor = executor
 
     def __str__(self):
         """
@@ -405,27 +482,121 @@ class CompositeNode(Node):
         else:
             return "Empty CompositeNode"
 
-    def doIt(self, threaded=True, group_by_chassis=False):
+    def getExecutor(self):
+        """
+        returns the WorkerPool used to run threaded operations on the nodes in this compositenode
+        """
+        if self.executor is None:
+            return get_worker_pool()
+        return self.executor
+
+    def setDeadline(self, deadline):
+        """
+        set the time (in seconds since the epoch) by which everything queued on the nodes in this compositenode
+        should be done, the nodes that are not done by then report they timed out.
+        """
+        self.deadline = deadline
+        for node in self.getNodes():
+            node.setDeadline(deadline)
+
+    def cancel(self):
+        """
+        stop everything running on the nodes in this compositenode
+        """
+        for node in self.getNodes():
+            node.cancel()
+
+    def _getJoinDeadline(self):
+        """
+        returns the time to stop waiting for the nodes, None if there is no deadline
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline + DEADLINE_GRACE
+
+    def _getTimeout(self, timeout):
+        """
+        returns timeout, or the time left to wait for the nodes if that is less
+        """
+        if self.deadline is None:
+            return timeout
+        return max(min(timeout, self._getJoinDeadline() - time.time()), 0)
+
+    def doIt(self, threaded=True, limits=None, backend=THREADS):
         """
         do everything that has been queued now
-        this will start a new thread for every node
+        this will run every node in the worker pool
         unless threaded = False is given
-        or alternatively if group_by_chassis is True only one thread is started per chassis.
+        limits is a dict kind: limit with the maximum number of nodes using the same resource at the same time,
+        f.ex. {CHASSIS: 3, BMC: 1, TOTAL: 40}, see Node.getResources and ResourceLimits.
+        With backend=EVENTLOOP the nodes are handled by an event loop instead of the worker pool.
+        Blade commands queued for the same chassis are run first, in one session per chassis,
+        and all ipmi commands are sent at once.
+        the output is in the same order as the nodes, use iterDoIt to get it as soon as a node is done
+        """
+        out = sorted(self._iterDoIt(threaded, limits, backend), key=lambda result: result[0])
+        return [result for _, result in out]
+
+    def iterDoIt(self, threaded=True, limits=None, backend=THREADS):
+        """
+        same as doIt, but yields the [node, output] of every node as soon as it is done
         """
+        for _, result in self._iterDoIt(threaded, limits, backend):
+            yield result
+
+    def _iterDoIt(self, threaded, limits, backend):
+        """
+        yields (position, [node, output]) for every node as it is done, sorting on position gives the doIt order
+        """
+        # a new run, nodes cancelled in an earlier one can run again
+        self.setDeadline(self.deadline)
+        # only the commands every node would run first, so the order of the commands on a node stays the same
+        self._runBatches(batchable_commands([node.commands for node in self.getNodes()]), threaded, limits)
         # threading here!
-        out = []
-        if threaded:
-            if group_by_chassis:
-                    for node in self._doThreading("doIt", args={'threaded': False}, group_by_chassis=group_by_chassis):
-                        self.log.debug("adding output of doit for %s" % str(node[1]))
-                        out.extend(node[1])
-            else:
-                out = self._doThreading("doIt", group_by_chassis=group_by_chassis)
+        if not threaded:
+            for index, node in enumerate(self.getNodes()):
+                yield index, [node, node.doIt()]
+            return
+        if backend == EVENTLOOP:
+            run = self._iterEventLoop
         else:
-            for node in self.getNodes():
-                out.append([node, node.doIt()])
+            run = self._iterThreading
+        for index, result in run("doIt", limits=limits):
+            yield index, result
+
+    def _runBatches(self, commands, threaded=True, limits=None):
+        """
+        run the blade commands in commands per chassis, and the ipmi commands all at once,
+        every node gets the output of its commands when it runs them.
+        the chassis are handled in the worker pool, unless threaded = False is given,
+        a chassis session counts as one node using the chassis for limits (see doIt)
+        """
+        batches = batch_blade_commands(commands)
+        if batches:
+            self.log.debug("running batches %s" % batches)
+            if threaded:
+                executor = self.getExecutor()
+                if limits:
+                    executor = LimitedExecutor(executor, limits)
+                tasks = [executor.submitUsing({CHASSIS: batch.host}, batch.run) for batch in batches]
+                for batch, task in zip(batches, tasks):
+                    if not task.wait(self.timeout, self._getJoinDeadline()):
+                        executor.abandon(task)
+                        batch.cancel()
+            else:
+                for batch in batches:
+                    batch.run()
+        ran = batch_ipmi_commands(commands)
+        self.log.debug("ran %d ipmi commands at once" % ran)
 
-        return out
+    def adoIt(self):
+        """
+        awaitable variant of doIt, this runs the nodes one by one
+        """
+        out = []
+        for node in self.getNodes():
+            out.append([node, (yield node.adoIt())])
+        yield Return(out)
 
         # avg of 3 runs
         # threaded
@@ -510,74 +681,171 @@ class CompositeNode(Node):
         self.log.debug("sorted keys: %s" % sorted)
         return sortedl
 
-    def getStatus(self, forced=False, threaded=True, group_by_chassis=False):
+    def getStatus(self, forced=False, threaded=True, limits=None, backend=THREADS):
         """
         overwrites getstatus from nodes
+        all nodes are checked for being alive at once first,
+        and the blade and ipmi status commands are batched like in doIt, limits are the same as in doIt
         """
         self.log.debug("getting statuses from %s" % self)
         statusses = []
         if not self.status or forced:
+            # a new run, nodes cancelled in an earlier one can run again
+            self.setDeadline(self.deadline)
+            commands = [node.statusCommand for node in self.getNodes() if node.statusCommand and not node.status]
+            self._runSweep(commands)
+            self._runBatches(commands, threaded, limits)
             if threaded:
-                if group_by_chassis:
-                    for node in self._doThreading("getStatus", args={'threaded': False},
-                                                  group_by_chassis=group_by_chassis):
-                        self.log.debug("adding status for %s" % str(node[1]))
-                        statusses.extend(node[1])
+                if backend == EVENTLOOP:
+                    run = self._doEventLoop
                 else:
-                    statusses = self._doThreading("getStatus", group_by_chassis=group_by_chassis)
-
+                    run = self._doThreading
+                statusses = run("getStatus", limits=limits)
             else:
                 for node in self.getNodes():
                     statusses.append([node, node.getStatus()])
         self.status = statusses
         return self.status
 
-    def _doThreading(self, method, args=None, group_by_chassis=False, timeout=None):
+    def runCommands(self, commands, threaded=True):
+        """
+        run commands (of the nodes in this compositenode) right away, all at the same time,
+        blade and ipmi commands are batched like in doIt.
+        returns the (out, err) of every command, in the same order
+        """
+        for command in commands:
+            command.setDeadline(self.deadline)
+        self._runBatches(commands, threaded)
+        if not threaded:
+            return [_runCommand(command) for command in commands]
+        results = []
+        tasks = self.getExecutor().map(_runCommand, commands, timeout=self.timeout, deadline=self._getJoinDeadline())
+        for command, task in zip(commands, tasks):
+            if not task.done:
+                command.cancel()
+                results.append((None, 'command timed out'))
+            elif task.error:
+                results.append((None, str(task.error)))
+            else:
+                results.append(task.result)
+        return results
+
+    def _runSweep(self, commands):
+        """
+        check if the nodes with the given status commands are alive all at the same time,
+        every node gets this result when it runs its status command
+        """
+        swept = sweep_alive_commands(commands, executor=self.getExecutor())
+        self.log.debug("swept %s: %s" % (self, swept))
+
+    def _doThreading(self, method, args=None, limits=None, timeout=None):
         """
         give this method a methodname and optional arguments
         it will perform it threaded on all
         nodes in this compositenode
-        If group_by_chassis is given only one thread per chassis is started (default False)
+        The nodes are handled by the worker pool, so at most WORKER_POOL_SIZE of them run at the same time,
+        with limits (see doIt) nodes wait for their resources without taking up a worker.
+        the output is in the same order as the nodes.
+        timeout is counted per node, from the moment a worker starts on it.
+        """
+        outputs = sorted(self._iterThreading(method, args, limits, timeout), key=lambda out: out[0])
+        return [out for _, out in outputs]
+
+    def _iterThreading(self, method, args=None, limits=None, timeout=None):
+        """
+        same as _doThreading, but yields (position, output) for every node as soon as it is done
         """
         if self.threads:
             self.log.raiseException("Trying to do 2 threaded operations at the same time,",
                                     " this is not allowed!")
         self.threads = []
-        outputs = []
         if not timeout:
             timeout = self.timeout
-        # creating threads and getting results as discussed here:
-        # http://stackoverflow.com/questions/3239617/how-to-manage-python-threads-results
-        if group_by_chassis:
-            group = self.getNodesPerChassis()
-        else:
-            group = self
-        for node in group.getNodes():
-            # commands are ran in parrallel, but serial on each node
-            # TODO (high): group by chassis to avoid overloading!
-            out = []
-            self.log.debug("running %s on %s with args: %s" % (method, node, args))
-            t, out = _dothreading(node, method, args)
-            # TODO: use a thread pool?
-            self.threads.append([t, out, node])
-            t.start()
-        for t, out, node in self.threads:
-            # TODO: (low) print progress? http://stackoverflow.com/questions/3160699/python-progress-bar
-            t.join(timeout)
-            if t.is_alive():
-                self.log.warning("thread %s on node %s did not complete within timeout, ignoring it", t, str(node))
-                if len(out) < 2:
-                    out.extend([node, [['command timed out', (None, 'command timed out')]], None])
-                outputs.append(out)
-                continue
-            # get result from each thread and append it to the result here
-            self.log.debug("thread %s on node %s completed, result: %s" % (t, out[0], out[1]))
-            if out[2]:
-                self.log.warning("thread %s on node %s completed with an error: %s" %
-                                 (t, out[0], out[2]))
-            outputs.append(out)
-        self.threads = None  # delete threads
-        return outputs
+        executor = self.getExecutor()
+        if limits:
+            executor = LimitedExecutor(executor, limits)
+        try:
+            for node in self.getNodes():
+                # commands are ran in parrallel, but serial on each node
+                self.log.debug("running %s on %s with args: %s" % (method, node, args))
+                resources = {}
+                if limits:
+                    resources = node.getResources(limits.keys())
+                task = executor.submitUsing(resources, _threadingHandler, node, [], method, args)
+                self.threads.append([task, node])
+            positions = dict([(task, [index, node]) for index, (task, node) in enumerate(self.threads)])
+            tasks = [task for task, _ in self.threads]
+            for task in executor.as_completed(tasks, timeout, self._getJoinDeadline()):
+                index, node = positions[task]
+                if not task.done:
+                    self.log.warning("%s on node %s did not complete within timeout, cancelling it", method, str(node))
+                    node.cancel()
+                    yield index, [node, [['command timed out', (None, 'command timed out')]], None]
+                    continue
+                # get result from each task and append it to the result here
+                out = task.result
+                self.log.debug("%s on node %s completed, result: %s" % (method, out[0], out[1]))
+                if out[2]:
+                    self.log.warning("%s on node %s completed with an error: %s" % (method, out[0], out[2]))
+                yield index, out
+        finally:
+            self.threads = None  # delete threads
+
+    def agetStatus(self, forced=False):
+        """
+        awaitable variant of getStatus, this runs the nodes one by one
+        """
+        statusses = []
+        for node in self.getNodes():
+            statusses.append([node, (yield node.agetStatus(forced=forced))])
+        yield Return(statusses)
+
+    def _doEventLoop(self, method, args=None, limits=None, timeout=None):
+        """
+        same as _doThreading, but the nodes are handled as coroutines in an EventLoop
+        the awaitable variant of method (prefixed with 'a') is used, args are ignored here
+        since the awaitable variants of compositenodes always run their nodes one by one.
+        commands without an event driven implementation (ssh) are offloaded to the worker pool.
+        with limits, a node is only started in the loop once there is room on its resources.
+        """
+        outputs = sorted(self._iterEventLoop(method, args, limits, timeout), key=lambda out: out[0])
+        return [out for _, out in outputs]
+
+    def _iterEventLoop(self, method, args=None, limits=None, timeout=None):
+        """
+        same as _doEventLoop, but yields (position, output) for every node as soon as it is done
+        """
+        if not timeout:
+            timeout = self.timeout
+        nodes = self.getNodes()
+        self.log.debug("running %s in an event loop on %s" % (method, nodes))
+        generators = [getattr(node, "a%s" % method)() for node in nodes]
+        positions = dict([(generator, index) for index, generator in enumerate(generators)])
+        held = ResourceLimits(limits or {})
+        loop = EventLoop(self.getExecutor())
+        try:
+            for node, generator in zip(nodes, generators):
+                resources = {}
+                if limits:
+                    resources = node.getResources(limits.keys())
+                for started in held.add(generator, resources):
+                    loop.spawn(started, self._getTimeout(timeout))
+            for coroutine in loop.iterate():
+                for started in held.done(coroutine.generator):
+                    loop.spawn(started, self._getTimeout(timeout))
+                index = positions[coroutine.generator]
+                node = nodes[index]
+                if coroutine.timedout:
+                    self.log.warning("%s on node %s did not complete within timeout, cancelling it", method, str(node))
+                    # the event loop stopped the coroutine, this stops what it offloaded to the worker pool
+                    node.cancel()
+                    yield index, [node, [['command timed out', (None, 'command timed out')]], None]
+                    continue
+                if coroutine.error:
+                    self.log.warning("%s on node %s completed with an error: %s" % (method, node, coroutine.error))
+                yield index, [node, coroutine.result, coroutine.error]
+        finally:
+            loop.close()
 
     def ledOn(self):
         """
@@ -765,24 +1033,40 @@ class CompositeNode(Node):
         return new
     _filterdict = staticmethod(_filterdict)
 
+    def getNodesInStates(self, states):
+        """
+        returns a compositenode with all the nodes in this one that are in any of the given pbs states,
+        f.ex. [Node.DOWN, Node.OFFLINE]
+        the nodes are looked up in the state index of their master, not one by one
+        """
+        new = CompositeNode()
+        nodeids = {}
+        for node in self.nodes.values():
+            master = node.getMaster()
+            if master not in nodeids:
+                nodeids[master] = master.getNodeIdsInStates(states)
+            if node.nodeid in nodeids[master]:
+                new.add(node)
+        return new
+
     def getDownNodes(self):
         """
         returns a compositenode with all the nodes in this one
         that are down
         """
-        return CompositeNode._filterdict(self.nodes, Node.isdown)
+        return self.getNodesInStates([Node.DOWN])
 
     def getOfflineNodes(self):
         """
         returns a compositenode with all offline nodes from this compositenode in it
         """
-        return CompositeNode._filterdict(self.nodes, Node.isoffline)
+        return self.getNodesInStates([Node.OFFLINE])
 
     def getIdleNodes(self):
         """
         returns a compositenode with all idle nodes from this compositenode in it
         """
-        return CompositeNode._filterdict(self.nodes, Node.isidle)
+        return self.getNodesInStates([Node.FREE])
 
     def getNodesPerChassis(self):
         """
@@ -796,15 +1080,76 @@ class CompositeNode(Node):
             if not groups.contains(chassis):
                 groups.add(CompositeNode(nodeid=chassis))
             groups.get(chassis).add(node)
+        if self.deadline is not None:
+            groups.setDeadline(self.deadline)
 
         self.log.debug("getting nodes per chassis %s" % (groups))
         return groups
 
+    def getQuattorFields(self, jsonpaths=None):
+        """
+        returns a dict nodeid: fields with the fields of the quattor profiles of the nodes in this compositenode,
+        jsonpaths is a dict name: json path, f.ex. {'serial': 'hardware,serialnumber'}
+        without jsonpaths, the fields in the profile index are returned (and the index is brought up to date)
+        the profiles that need parsing are parsed together, in parallel (see quattor.extract_many)
+        nodes without a profile are left out
+        """
+        paths = {}
+        for node in self.getNodes():
+            try:
+                paths[os.path.abspath(node._getQuattorPath())] = node.getid()
+            except NodeException, err:
+                self.log.debug("no quattor profile for %s: %s" % (node, err))
+        if jsonpaths is None:
+            fields = get_profile_index().getMany(paths.keys())
+        else:
+            fields = extract_many(paths.keys(), jsonpaths)
+        return dict([(paths[path], value) for path, value in fields.items()])
+
+    def getQuattorColumn(self, jsonpath):
+        """
+        returns a dict nodeid: value with the value at jsonpath (f.ex. 'hardware,serialnumber') in the quattor
+        profile of every node in this compositenode, nodes without a profile or without the json path are left out
+        the fields in the profile index come from there, other json paths are read from the profiles in parallel
+        """
+        keys = [key.strip() for key in jsonpath.split(",")]
+        indexed = [name for name, path in get_profile_index().jsonpaths.items()
+                   if [key.strip() for key in path.split(",")] == keys]
+        if indexed:
+            name = indexed[0]
+            fields = self.getQuattorFields()
+        else:
+            name = 'value'
+            fields = self.getQuattorFields({name: jsonpath})
+        return dict([(nodeid, values[name]) for nodeid, values in fields.items() if name in values])
+
+    def diffQuattorColumn(self, jsonpath, command, threaded=True):
+        """
+        runs command (f.ex. 'dmidecode -s system-serial-number') on all nodes in this compositenode at the same time,
+        and compares its output with the value at jsonpath in their quattor profile (see getQuattorColumn)
+        returns [node, quattor value, output, error] for every node where they differ or the command failed,
+        in the same order as the nodes
+        """
+        column = self.getQuattorColumn(jsonpath)
+        nodes = self.getNodes()
+        results = self.runCommands([node._createCustomCommand(command) for node in nodes], threaded)
+        diffs = []
+        for node, (out, err) in zip(nodes, results):
+            expected = column.get(node.getid())
+            if out is not None:
+                out = out.strip()
+            if err or expected is None or out != ("%s" % expected).strip():
+                diffs.append([node, expected, out, err])
+        self.log.debug("%d of %d nodes differ from %s in quattor" % (len(diffs), len(nodes), jsonpath))
+        return diffs
+
     def getNodesFromChassis(self, chassis):
         """
         returns a compositenode with all nodes from a certain chassis in it
         """
         self.log.debug("getNodesFromChassis called on %s" % (self))
+        # parse the profiles that are not in the index yet all at once, not one by one in getChassis
+        self.getQuattorFields()
         new = CompositeNode()
         for node in self.getNodes():
             self.log.debug("getNodesFromChassis: calling getchassis")
@@ -822,6 +1167,16 @@ class CompositeNode(Node):
 
 
 # helper methods for multithreading
+def _runCommand(command):
+    """
+    run a command, unless its deadline passed
+    returns out, err
+    """
+    if command.expired():
+        return None, 'command timed out'
+    return command.run()
+
+
 def _threadingHandler(node, result, method, args):
     """
     calls a method on all nodes, in a threaded way
@@ -831,7 +1186,7 @@ def _threadingHandler(node, result, method, args):
      - output of the method on the node
      - possibly errors
 
-    This is intended to be run in a new thread
+    This is intended to be run in the worker pool
     """
     # Modify existing object result
     status = None
@@ -853,21 +1208,6 @@ def _threadingHandler(node, result, method, args):
     return result
 
 
-def _dothreading(node, method, args):
-    """
-    static function to be used for threading of nodestatusses
-    give this method a node, a function and arguments,
-     and it will run it as a new thread and return the results
-    this will the output like in _threadingNodeHandler
-
-    as explained here
-    http://stackoverflow.com/questions/3239617/how-to-manage-python-threads-results
-    """
-    result = []
-    thread = threading.Thread(target=_threadingHandler, args=(node, result, method, args))
-    return thread, result
-
-
 class WorkerNode(Node):
     """
     default implementation of a worker node
@@ -920,7 +1260,8 @@ class MasterNode(SpecialNode):
         SpecialNode.__init__(self, nodeid, clustername, None)
         self.nodestates = None
         self.PBSStateCommand = PBSStateCommand(self.hostname)
-        self.nodestates = None
+        self.stateCache = PbsStateCache(clustername)
+        self.stateIndex = None  # (nodestates, index of nodestates)
         self.statusCommand = MasterStatusCommand(self.hostname)
 
         self.customCommandClass = SshCommand  # this is a class, the others should be real commands
@@ -961,13 +1302,63 @@ class MasterNode(SpecialNode):
 
     def getNodeStates(self):
         """
-        returns the states of all nodes owned by this masternode
+        returns the states of all nodes owned by this masternode,
+        a dict with the node ids as keys and PbsNode records as values
         """
         if not self.nodestates:
-            self.nodestates, err = self.PBSStateCommand.run()
-            self.log.debug("got pbsStatuses:%s" % self.nodestates)
+            nodestates, err = self.PBSStateCommand.run()
+            self.log.debug("got pbsStatuses:%s" % nodestates)
+            if err:
+                self.nodestates = nodestates
+            else:
+                self.setNodeStates(nodestates)
         return self.nodestates
 
+    def setNodeStates(self, nodestates):
+        """
+        use nodestates, the output of a PBSStateCommand on this master, as the states of the nodes it owns
+        they are saved in the state cache for the next runs
+        """
+        self.nodestates = nodestates
+        self.stateCache.save(nodestates)
+
+    def loadNodeStates(self, max_age):
+        """
+        use the node states saved in the state cache by an earlier run, if they are at most max_age seconds old
+        returns True if they were
+        """
+        nodestates = self.stateCache.load(max_age)
+        if nodestates is None:
+            return False
+        self.nodestates = nodestates
+        return True
+
+    def getProbeCommand(self):
+        """
+        returns a PBSStateCommand with a short timeout, to check if pbs works on this master
+        """
+        return PBSStateCommand(self.hostname, get_config("COMMAND_FAST_TIMEOUT"))
+
+    def getStateIndex(self):
+        """
+        returns a dict with every pbs state as key, and the set of ids of the nodes in that state as value
+        this is built once for the node states
+        """
+        nodestates = self.getNodeStates() or {}
+        if self.stateIndex is None or self.stateIndex[0] is not nodestates:
+            self.stateIndex = (nodestates, index_states(nodestates))
+        return self.stateIndex[1]
+
+    def getNodeIdsInStates(self, states):
+        """
+        returns the set of ids of the nodes owned by this masternode that are in any of the given pbs states
+        """
+        index = self.getStateIndex()
+        nodeids = set()
+        for state in states:
+            nodeids.update(index.get(state, ()))
+        return nodeids
+
     def getPbsStatusForNode(self, nodeid):
         """
         get the status of this node
@@ -977,7 +1368,7 @@ class MasterNode(SpecialNode):
         out = None
         err = None
         try:
-            out = self.getNodeStates()[nodeid]
+            out = self.getNodeStates()[nodeid].state
         except KeyError:  # node not found in pbsStats
             self.log.warning("unable to get PBSStatus for %s from %s" % (nodeid, self.nodeid))
             self.log.debug(traceback.format_exc())
@@ -1051,6 +1442,7 @@ class BladeNode(Node):
         self.poweroffCommand = BladePoweroffCommand(chassisname=self.shassishost, slot=self.slot)
         self.poweronCommand = BladePoweronCommand(chassisname=self.shassishost, slot=self.slot)
         self.rebootCommand = BladeRebootCommand(chassisname=self.shassishost, slot=self.slot)
+        self.powerStateCommand = BladeStateCommand(chassisname=self.shassishost, slot=self.slot)
         self.statusCommand = FullBladeStatusCommand(host=self.hostname,
                                                     masternode=self.getMaster(),
                                                     chassisname=self.shassishost,
@@ -1098,6 +1490,7 @@ class ImmNode(Node):
         self.poweronCommand = ImmPoweronCommand(adminhost, clustername)
         self.poweroffCommand = ImmPoweroffCommand(adminhost, clustername)
         self.rebootCommand = ImmRebootCommand(adminhost, clustername)
+        self.powerStateCommand = ImmStateCommand(adminhost, clustername)
         self.ledoffcommand = NotSupportedCommand("ledoff")
         self.ledoncommand = NotSupportedCommand("ledon")
 
@@ -1165,6 +1558,7 @@ class DracNode(Node):
         self.poweronCommand = DracPoweronCommand(adminhost)
         self.poweroffCommand = DracPoweroffCommand(adminhost)
         self.rebootCommand = DracRebootCommand(adminhost)
+        self.powerStateCommand = DracStatusCommand(adminhost)
         self.ledoffcommand = NotSupportedCommand("ledoff")
         self.ledoncommand = NotSupportedCommand("ledon")
 
@@ -1203,6 +1597,7 @@ class IpmiNode(Node):
         self.poweroffCommand = IpmiPoweroffCommand(adminhost, clustername)
         self.softpoweroffCommand = IpmiSoftPoweroffCommand(adminhost, clustername)
         self.rebootCommand = IpmiRebootCommand(adminhost, clustername)
+        self.powerStateCommand = IpmiStatusCommand(adminhost, clustername)
         self.ledoffcommand = NotSupportedCommand("ledoff")
         self.ledoncommand = NotSupportedCommand("ledon")
 
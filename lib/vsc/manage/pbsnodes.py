@@ -0,0 +1,276 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module parses the xml output of pbsnodes -x.
+
+The output is parsed incrementally, every Node element is turned into a small PbsNode record and dropped
+from the tree right away, so a dump of a large cluster is parsed in linear time without holding the tree
+(and the long status fields) in memory.
+The parsed states can be kept on disk with a PbsStateCache, so other runs don't have to ask the master again.
+
+@author: Jens Timmerman
+"""
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+import errno
+import json
+import os
+import StringIO
+import tempfile
+import time
+
+from vsc.manage.config import get_config
+from vsc.utils import fancylogger
+
+# the pbsnodes -x command
+PBSNODES_XML = "pbsnodes -x"
+
+
+class PbsNode(object):
+    """
+    what pbsnodes knows about a node
+
+    name is the full name of the node, state the comma separated pbs state (f.ex. 'down,offline'),
+    np the number of slots, properties and jobs are tuples, jobs holds every job id once
+    """
+    __slots__ = ('name', 'state', 'np', 'properties', 'ntype', 'jobs', 'note')
+
+    def __init__(self, name, state=None, np=None, properties=(), ntype=None, jobs=(), note=None):
+        self.name = name
+        self.state = state
+        self.np = np
+        self.properties = properties
+        self.ntype = ntype
+        self.jobs = jobs
+        self.note = note
+
+    def getStates(self):
+        """
+        returns the list of states of this node, f.ex. ['down', 'offline']
+        """
+        if not self.state:
+            return []
+        return self.state.split(',')
+
+    def __eq__(self, other):
+        if not isinstance(other, PbsNode):
+            return NotImplemented
+        return [getattr(self, slot) for slot in self.__slots__] == [getattr(other, slot) for slot in other.__slots__]
+
+    def __ne__(self, other):
+        return not self == other
+
+    def toDict(self):
+        """
+        returns the fields of this node as a dict
+        """
+        return dict([(slot, getattr(self, slot)) for slot in self.__slots__])
+
+    def fromDict(cls, fields):
+        """
+        returns a PbsNode with the fields from a dict made by toDict
+        """
+        def _str(value):
+            # json gives unicode back
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            return value
+
+        node = cls(_str(fields['name']))
+        for slot in cls.__slots__:
+            value = fields.get(slot)
+            if isinstance(value, list):
+                value = tuple([_str(item) for item in value])
+            else:
+                value = _str(value)
+            if slot in ('state', 'ntype') and value is not None:
+                value = intern(value)
+            setattr(node, slot, value)
+        return node
+    fromDict = classmethod(fromDict)
+
+    def __repr__(self):
+        return "PbsNode(%s)" % ", ".join(["%s=%r" % (slot, getattr(self, slot)) for slot in self.__slots__])
+
+
+def _parse_jobs(jobs):
+    """
+    returns a tuple with every job id in the jobs field once, in order
+    the field looks like '0/123.master,1/123.master' or '0-15/123.master'
+    """
+    seen = set()
+    ids = []
+    for job in jobs.split(','):
+        jobid = job.split('/', 1)[-1].strip()
+        if jobid and jobid not in seen:
+            seen.add(jobid)
+            ids.append(jobid)
+    return tuple(ids)
+
+
+def _make_node(fields):
+    """
+    returns a PbsNode from a dict with the text of the fields of a Node element
+    """
+    np = fields.get('np')
+    if np is not None:
+        try:
+            np = int(np)
+        except ValueError:
+            pass
+    # states, properties and types repeat over all nodes, intern them to keep the records small
+    state = fields.get('state')
+    if state is not None:
+        state = intern(state)
+    properties = fields.get('properties')
+    if properties:
+        properties = tuple([intern(prop) for prop in properties.split(',')])
+    else:
+        properties = ()
+    ntype = fields.get('ntype')
+    if ntype is not None:
+        ntype = intern(ntype)
+    jobs = fields.get('jobs')
+    if jobs:
+        jobs = _parse_jobs(jobs)
+    else:
+        jobs = ()
+    return PbsNode(fields['name'], state=state, np=np, properties=properties, ntype=ntype, jobs=jobs,
+                   note=fields.get('note'))
+
+
+def iter_pbsnodes(source):
+    """
+    yields a PbsNode for every node in source, a file like object or a string with the output of pbsnodes -x
+    raises SyntaxError (ElementTree.ParseError) when source is not valid xml
+    """
+    if isinstance(source, basestring):
+        source = StringIO.StringIO(source)
+    root = None
+    fields = {}
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        if elem.tag == 'Node':
+            if 'name' in fields:
+                yield _make_node(fields)
+            fields = {}
+            # drop the parsed nodes, the tree never grows beyond one node
+            root.clear()
+        elif elem is not root:
+            # status is huge and not kept, the other fields are
+            if elem.tag != 'status':
+                fields[elem.tag] = (elem.text or '').strip()
+            elem.clear()
+
+
+def parse_pbsnodes(source):
+    """
+    returns a dict with the short name of every node in source (see iter_pbsnodes) as key and its PbsNode as value
+    """
+    return dict([(node.name.split('.')[0], node) for node in iter_pbsnodes(source)])
+
+
+def index_states(nodes):
+    """
+    returns a dict with every state of the nodes in nodes (as returned by parse_pbsnodes) as key,
+    and the set of ids of the nodes in that state as value, f.ex. {'down': set(['node1', 'node2']), ...}
+    """
+    index = {}
+    for nodeid, node in nodes.items():
+        for state in node.getStates():
+            index.setdefault(state, set()).add(nodeid)
+    return index
+
+
+class PbsStateCache(object):
+    """
+    Keeps the pbs state of the nodes of a cluster in a file, for the next runs
+
+    The file is replaced atomically, so concurrent runs always read a complete snapshot.
+    """
+    def __init__(self, clustername, path=None):
+        """
+        constructor
+        path is the directory with the files, PBS_CACHE_PATH in the config by default
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        if path is None:
+            path = get_config("PBS_CACHE_PATH")
+        self.path = path
+        self.filename = os.path.join(path, "%s.json" % clustername)
+
+    def save(self, nodes):
+        """
+        save nodes, a dict as returned by parse_pbsnodes
+        failures are only logged, the cache is not needed to work
+        """
+        data = {
+            'time': time.time(),
+            'nodes': dict([(nodeid, node.toDict()) for nodeid, node in nodes.items()]),
+        }
+        try:
+            try:
+                os.makedirs(self.path)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+            handle, tmpname = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.path)
+            try:
+                with os.fdopen(handle, 'w') as tmpfile:
+                    json.dump(data, tmpfile)
+                os.chmod(tmpname, 0644)
+                os.rename(tmpname, self.filename)
+            except Exception:
+                os.unlink(tmpname)
+                raise
+        except (IOError, OSError, TypeError, ValueError), err:
+            self.log.warning("could not save the pbs state to %s: %s" % (self.filename, err))
+            return False
+        self.log.debug("saved the pbs state of %d nodes to %s" % (len(nodes), self.filename))
+        return True
+
+    def load(self, max_age):
+        """
+        returns the nodes that were saved, if they are at most max_age seconds old, otherwise None
+        """
+        try:
+            with open(self.filename) as cachefile:
+                data = json.load(cachefile)
+            age = time.time() - data['time']
+            nodes = data['nodes']
+        except (IOError, OSError, KeyError, TypeError, ValueError), err:
+            self.log.debug("no pbs state in %s: %s" % (self.filename, err))
+            return None
+        if age < 0 or age > max_age:
+            self.log.debug("pbs state in %s is %d seconds old, more than %s" % (self.filename, age, max_age))
+            return None
+        self.log.debug("using the pbs state in %s of %d seconds ago" % (self.filename, age))
+        return dict([(str(nodeid), PbsNode.fromDict(fields)) for nodeid, fields in nodes.items()])
@@ -0,0 +1,320 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module powers on a lot of nodes without tripping the power distribution or overloading their management
+controllers.
+
+The nodes are powered on in waves, a wave holds at most a number of nodes per chassis, per rack and in total.
+The next wave only starts when the power state of the nodes in the current one confirms they are on,
+and the size of the waves adapts to how fast these confirmations come back.
+After any power action, a PowerStateWaiter can wait until all nodes got to the power state.
+
+@author: Jens Timmerman
+"""
+import time
+
+from vsc.manage.config import get_config
+from vsc.manage.managecommands import is_powered_off, is_powered_on
+from vsc.manage.nodes import CHASSIS, RACK
+from vsc.manage.scheduler import TOTAL
+from vsc.utils import fancylogger
+
+# the first wave gets this part of the maximum wave size
+START_SCALE = 0.25
+# waves never get smaller than this part of the maximum wave size (but always hold at least one node)
+MIN_SCALE = 0.01
+
+
+class PowerOnSequencer(object):
+    """
+    Powers on the nodes of a compositenode in waves
+
+    rates is a dict kind: number with the maximum number of nodes in a wave per resource of that kind,
+    f.ex. {CHASSIS: 4, RACK: 8, TOTAL: 32} (see Node.getResources), the POWERON_WAVE_* config values by default.
+    A wave confirmed within half of confirm_timeout makes the next one twice as big (up to these rates),
+    a wave with nodes that were not confirmed in time makes it half as big.
+    """
+    def __init__(self, nodes, rates=None, confirm_timeout=None, interval=None):
+        """
+        constructor
+        nodes is the compositenode with the nodes to power on, it runs the commands
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.nodes = nodes
+        self.todo = nodes.getNodes()
+        if rates is None:
+            rates = {
+                CHASSIS: get_config("POWERON_WAVE_CHASSIS"),
+                RACK: get_config("POWERON_WAVE_RACK"),
+                TOTAL: get_config("POWERON_WAVE_TOTAL"),
+            }
+        self.rates = dict([(kind, int(rate)) for kind, rate in rates.items()])
+        if confirm_timeout is None:
+            confirm_timeout = get_config("POWERON_CONFIRM_TIMEOUT")
+        self.confirm_timeout = float(confirm_timeout)
+        if interval is None:
+            interval = get_config("POWERON_POLL_INTERVAL")
+        self.interval = float(interval)
+        self.scale = START_SCALE
+
+    def showCommands(self):
+        """
+        shows the commands that will be run when poweron is called
+        """
+        return ["%s (staggered)" % node.poweronCommand.getCommand() for node in self.todo]
+
+    def poweron(self, threaded=True):
+        """
+        power on the nodes, wave by wave
+        returns [node, output, None] for every node, in the same order as the nodes,
+        output holds the result of the poweron command and of the last power state check
+        """
+        positions = dict([(node, index) for index, node in enumerate(self.todo)])
+        return sorted(self.iterPoweron(threaded), key=lambda out: positions[out[0]])
+
+    def iterPoweron(self, threaded=True):
+        """
+        same as poweron, but yields the [node, output, None] of the nodes in a wave as soon as the wave is done
+        """
+        pending = list(self.todo)
+        resources = dict([(node, node.getResources(self.rates.keys())) for node in pending])
+        waves = 0
+        while pending:
+            if self.nodes.deadline is not None and time.time() >= self.nodes.deadline:
+                self.log.warning("deadline passed, not powering on %s" % pending)
+                for node in pending:
+                    yield [node, [[node.poweronCommand, (None, 'command timed out')]], None]
+                return
+            wave = self._nextWave(pending, resources)
+            waves += 1
+            self.log.info("powering on wave %d: %s" % (waves, wave))
+            inwave = set(wave)
+            pending = [node for node in pending if node not in inwave]
+            for out in self._runWave(wave, threaded):
+                yield out
+
+    def _limits(self):
+        """
+        returns the maximum number of nodes in the next wave, per kind of resource
+        """
+        return dict([(kind, max(1, int(rate * self.scale))) for kind, rate in self.rates.items()])
+
+    def _nextWave(self, pending, resources):
+        """
+        returns the nodes for the next wave, the first ones in pending that fit in the limits
+        """
+        limits = self._limits()
+        used = {}
+        wave = []
+        for node in pending:
+            if TOTAL in limits and len(wave) >= limits[TOTAL]:
+                break
+            keys = [(kind, name) for kind, name in resources[node].items() if kind in limits]
+            if [key for key in keys if used.get(key, 0) >= limits[key[0]]]:
+                continue
+            for key in keys:
+                used[key] = used.get(key, 0) + 1
+            wave.append(node)
+        return wave
+
+    def _runWave(self, wave, threaded):
+        """
+        power on the nodes in wave, and wait until their power state confirms this
+        yields [node, output, None] for every node in the wave
+        """
+        start = time.time()
+        results = self.nodes.runCommands([node.poweronCommand for node in wave], threaded)
+        outputs = dict([(node, [[node.poweronCommand, result]]) for node, result in zip(wave, results)])
+        # nodes without a power state command are taken to be on when the poweron went fine
+        waiting = [node for node, result in zip(wave, results) if not result[1] and node.powerStateCommand]
+        states = {}
+        end = start + self.confirm_timeout
+        if self.nodes.deadline is not None:
+            end = min(end, self.nodes.deadline)
+        while waiting:
+            results = self.nodes.runCommands([node.powerStateCommand for node in waiting], threaded)
+            for node, result in zip(waiting, results):
+                states[node] = result
+            waiting = [node for node in waiting if not is_powered_on(states[node][0])]
+            if not waiting or time.time() >= end:
+                break
+            # the last check is at the end
+            time.sleep(max(min(self.interval, end - time.time()), 0))
+
+        elapsed = time.time() - start
+        for node in waiting:
+            self.log.warning("power state of %s does not confirm it is on after %d seconds: %s" %
+                             (node, elapsed, states[node]))
+            states[node] = (states[node][0], "not confirmed on within %d seconds" % elapsed)
+        for node, state in states.items():
+            outputs[node].append([node.powerStateCommand, state])
+        self._adapt(len(waiting), elapsed)
+        for node in wave:
+            yield [node, outputs[node], None]
+
+    def _adapt(self, unconfirmed, elapsed):
+        """
+        adapt the size of the next wave to how the last one went
+        """
+        if unconfirmed:
+            self.scale = max(self.scale / 2, MIN_SCALE)
+        elif elapsed <= self.confirm_timeout / 2:
+            self.scale = min(self.scale * 2, 1.0)
+        self.log.debug("waves are now %s of the maximum size: %s" % (self.scale, self._limits()))
+
+
+class PowerStateWaiter(object):
+    """
+    Waits until the power state of the nodes of a compositenode is on (or off), after a power action
+
+    The power state commands of the nodes that are not there yet are run together on every check.
+    The time between two checks starts at interval, and doubles (up to max_interval) as long as no node gets there,
+    so a long wait does not keep loading the bmcs. The POWER_WAIT_* config values are used by default.
+    After a power cycle (cycle=True) a node that was seen off gets there when it is on again. Most bmcs keep saying
+    the power is on during a cycle (or the cycle was over before the first check), so a node that is on but was never
+    seen off gets there after grace seconds (POWER_WAIT_CYCLE_GRACE by default), with a warning that the cycle
+    was not seen. Until then the checks stay at interval, so a short off is not missed.
+    """
+    def __init__(self, nodes, on=True, timeout=None, interval=None, max_interval=None, cycle=False, grace=None):
+        """
+        constructor
+        nodes is the compositenode with the nodes to wait for, it runs the commands
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.nodes = nodes
+        self.todo = nodes.getNodes()
+        self.on = on or cycle
+        self.cycle = cycle
+        self.seenOff = set()  # nodes seen off during a power cycle
+        if timeout is None:
+            timeout = get_config("POWER_WAIT_TIMEOUT")
+        self.timeout = float(timeout)
+        if interval is None:
+            interval = get_config("POWER_WAIT_INTERVAL")
+        self.interval = float(interval)
+        if max_interval is None:
+            max_interval = get_config("POWER_WAIT_MAX_INTERVAL")
+        self.max_interval = float(max_interval)
+        if grace is None:
+            grace = get_config("POWER_WAIT_CYCLE_GRACE")
+        self.grace = float(grace)
+        self.times = {}  # node -> seconds it took to get to the power state
+        self.stragglers = []  # nodes that did not get there in time
+        self.unseen = []  # nodes that were on after a power cycle without being seen off
+
+    def _target(self):
+        """
+        returns the power state that is waited for, as text
+        """
+        if self.cycle:
+            return "off and on again"
+        if self.on:
+            return "on"
+        return "off"
+
+    def _reached(self, node, out, elapsed):
+        """
+        returns True if out, the output of the power state command of node, is the power state that is waited for
+        """
+        if self.cycle:
+            if is_powered_off(out):
+                self.seenOff.add(node)
+                return False
+            return is_powered_on(out) and (node in self.seenOff or elapsed >= self.grace)
+        if self.on:
+            return is_powered_on(out)
+        return is_powered_off(out)
+
+    def wait(self, threaded=True):
+        """
+        wait for the nodes
+        returns [node, output, None] for every node, in the same order as the nodes,
+        output holds the last power state and how long it took to get there
+        """
+        positions = dict([(node, index) for index, node in enumerate(self.todo)])
+        return sorted(self.iterWait(threaded), key=lambda out: positions[out[0]])
+
+    def iterWait(self, threaded=True):
+        """
+        same as wait, but yields the [node, output, None] of every node as soon as it got to the power state,
+        the stragglers come last
+        """
+        start = time.time()
+        end = start + self.timeout
+        if self.nodes.deadline is not None:
+            end = min(end, self.nodes.deadline)
+        pending = []
+        for node in self.todo:
+            if node.powerStateCommand:
+                pending.append(node)
+            else:
+                self.stragglers.append(node)
+                yield [node, [[None, (None, "power state of %s can't be checked" % node)]], None]
+        interval = self.interval
+        states = {}
+        while pending:
+            results = self.nodes.runCommands([node.powerStateCommand for node in pending], threaded)
+            elapsed = time.time() - start
+            waiting = []
+            seen = len(self.seenOff)
+            for node, result in zip(pending, results):
+                states[node] = result
+                if self._reached(node, result[0], elapsed):
+                    self.times[node] = elapsed
+                    out = "%s after %.1f seconds" % (result[0], elapsed)
+                    if self.cycle and node not in self.seenOff:
+                        self.unseen.append(node)
+                        out += ", the power cycle was not seen"
+                    yield [node, [[node.powerStateCommand, (out, None)]], None]
+                else:
+                    waiting.append(node)
+            if len(waiting) < len(pending) or len(self.seenOff) > seen:
+                # things are moving, check again soon
+                interval = self.interval
+            elif self.cycle and elapsed < self.grace:
+                # the power can be off for a few seconds only, don't miss it
+                interval = self.interval
+            else:
+                interval = min(interval * 2, self.max_interval)
+            pending = waiting
+            if not pending or time.time() >= end:
+                break
+            self.log.debug("%d nodes not %s yet, checking again in %s seconds" % (len(pending), self._target(),
+                                                                                 interval))
+            # the last check is at the end
+            time.sleep(max(min(interval, end - time.time()), 0))
+
+        elapsed = time.time() - start
+        for node in pending:
+            self.stragglers.append(node)
+            err = "not %s after %d seconds" % (self._target(), elapsed)
+            yield [node, [[node.powerStateCommand, (states[node][0], err)]], None]
+        if self.times:
+            self.log.info("%d nodes %s after at most %.1f seconds" % (len(self.times), self._target(),
+                                                                      max(self.times.values())))
+        if self.unseen:
+            self.log.warning("on, but not seen off during the power cycle: %s" % self.unseen)
+        if self.stragglers:
+            self.log.warning("not %s after %d seconds: %s" % (self._target(), elapsed, self.stragglers))
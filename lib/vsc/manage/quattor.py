@@ -0,0 +1,605 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module keeps an index of the fields manage uses from the quattor profiles.
+
+Getting a field straight from a profile means decompressing and parsing all of it. The index keeps the commonly
+used fields (location, chassis, slot, rack, serial and model) of the profiles in a file, with the mtime and size
+of the profile they came from, so a profile is only parsed again when it changed.
+When a lot of profiles have to be parsed, they are parsed in parallel by a pool of processes (see extract_many).
+A profile is not parsed as a whole, the JsonPathReader reads it as a stream up to the fields that are asked for.
+The names of the profiles in the quattor directory tell which hosts are workers, masters or storage of which
+cluster, scan_profiles sorts them all out in one go and keeps that as long as the directory doesn't change.
+
+@author: Jens Timmerman
+"""
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import atexit
+import errno
+import gzip
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+
+from vsc.manage.config import get_config
+from vsc.utils import fancylogger
+
+# the fields in the index, with the config value holding their json path
+INDEX_FIELDS = {
+    'location': 'LOCATION_JSON',
+    'rack': 'RACK_JSON',
+    'serial': 'SERIAL_JSON',
+    'model': 'MODEL_JSON',
+}
+
+# the json profiles are read in blocks of this size
+READ_SIZE = 16 * 1024
+WHITESPACE = re.compile(r'\s*')
+# a json token: punctuation, a string or a literal (number, true, false, null)
+JSON_TOKEN = re.compile(r'\s*(?:([{}\[\],:])|("(?:[^"\\]|\\.)*")|([^\s{}\[\],:"]+))')
+
+# the roles of the hosts in the quattor directory, with the config value holding the regex for their ids
+WORKER = 'worker'
+MASTER = 'master'
+STORAGE = 'storage'
+ROLE_REGEXES = {
+    WORKER: 'QUATTOR_NODEID_REGEX',
+    MASTER: 'QUATTOR_MASTERID_REGEX',
+    STORAGE: 'QUATTOR_STORAGEID_REGEX',
+}
+
+# less profiles than this are parsed in this process, starting a pool of processes would take longer
+MIN_PARALLEL = 8
+
+_PROFILE_INDEX = None
+_PROFILE_INDEX_LOCK = threading.Lock()
+_SCANS = {}  # quattor directory -> (mtime, hosts in it by cluster and role)
+_SCANS_LOCK = threading.Lock()
+
+
+def read_profile(path):
+    """
+    returns the parsed json of the quattor profile in path, gzipped or not
+    """
+    if path.endswith('.gz'):
+        profile = gzip.open(path)
+    else:
+        profile = open(path)
+    try:
+        return json.load(profile)
+    finally:
+        profile.close()
+
+
+class _Done(Exception):
+    """all paths are read, stop reading"""
+    pass
+
+
+class JsonPathReader(object):
+    """
+    Reads the values at some json paths from a json stream, without parsing all of it
+
+    The stream is tokenized block by block, only the objects on the way to the paths are walked into,
+    everything else is skipped without building it. Reading stops as soon as every path is read, or known
+    not to be there because the object that should hold it was closed, so only the values that are asked for are
+    ever in memory, however big the stream is.
+    """
+    def __init__(self, stream, jsonpaths):
+        """
+        constructor
+        jsonpaths is a dict name: json path, a comma separated list of keys (f.ex. 'hardware,location')
+        """
+        self.stream = stream
+        self.names = {}
+        for name, jsonpath in jsonpaths.items():
+            self.names.setdefault(tuple([key.strip() for key in jsonpath.split(",")]), []).append(name)
+        self.prefixes = set([path[:end] for path in self.names for end in range(1, len(path))])
+        self.todo = set(self.names)
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.read = 0  # number of bytes read from the stream
+        self.decoder = json.JSONDecoder()
+
+    def _more(self, size=None):
+        """
+        read the next block (of size bytes, READ_SIZE by default) from the stream, returns False at the end of it
+        """
+        if self.eof:
+            return False
+        block = self.stream.read(max(size, READ_SIZE))
+        if not block:
+            self.eof = True
+            return False
+        self.read += len(block)
+        self.buffer = self.buffer[self.pos:] + block
+        self.pos = 0
+        return True
+
+    def _token(self, peek=False):
+        """
+        returns the next token, the end of the buffer can be in the middle of one, so read on until it's not
+        """
+        while True:
+            match = JSON_TOKEN.match(self.buffer, self.pos)
+            if match and (match.end() < len(self.buffer) or self.eof):
+                break
+            if not self._more():
+                if match:
+                    break
+                raise ValueError("unexpected end of json after %d bytes" % self.read)
+        if not peek:
+            self.pos = match.end()
+        return match.group(1) or match.group(2) or match.group(3)
+
+    def _expect(self, expected):
+        token = self._token()
+        if token not in expected:
+            raise ValueError("expected one of %s in json, got %s" % (expected, token))
+        return token
+
+    def _value(self):
+        """
+        returns the value starting at the current position, it's read completely in the buffer first
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self._more():
+                break
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # a big value, read as much again as there is, not block by block
+                if self._more(len(self.buffer) - self.pos):
+                    continue
+                raise
+            # a number can go on in the next block
+            if end == len(self.buffer) and self._more():
+                continue
+            self.pos = end
+            return value
+
+    def _skip(self):
+        """
+        skip the value starting at the current position
+        """
+        depth = 0
+        while True:
+            token = self._token()
+            if token in ('{', '['):
+                depth += 1
+            elif token in ('}', ']'):
+                depth -= 1
+            elif token in (',', ':'):
+                continue
+            if depth <= 0:
+                return
+
+    def _object(self, path, values):
+        """
+        walk the object starting after its {, at path
+        """
+        token = self._token()
+        while token != '}':
+            key = json.loads(token)
+            self._expect(':')
+            subpath = path + (key,)
+            if subpath in self.todo:
+                value = self._value()
+                # paths in this value are taken from it
+                for todo in [todo for todo in self.todo if todo[:len(subpath)] == subpath]:
+                    self.todo.discard(todo)
+                    try:
+                        values[todo] = get_json_path(value, ",".join(todo[len(subpath):])) if todo != subpath else value
+                    except (KeyError, TypeError):
+                        pass
+                if not self.todo:
+                    raise _Done()
+            elif subpath in self.prefixes and self._token(peek=True) == '{':
+                self._token()
+                self._object(subpath, values)
+            else:
+                self._skip()
+            token = self._expect((',', '}'))
+            if token == ',':
+                token = self._token()
+        # whatever was not in this object is not there
+        self.todo = set([todo for todo in self.todo if todo[:len(path)] != path])
+        if not self.todo:
+            raise _Done()
+
+    def read_paths(self):
+        """
+        returns a dict name: value with every path that is in the stream, the ones that aren't are left out
+        """
+        values = {}
+        try:
+            self._expect('{')
+            self._object((), values)
+        except _Done:
+            pass
+        result = {}
+        for path, value in values.items():
+            for name in self.names[path]:
+                result[name] = value
+        return result
+
+
+def read_json_paths(path, jsonpaths):
+    """
+    returns a dict with the value of every json path in jsonpaths (a dict name: json path) in the quattor profile
+    in path, gzipped or not, without parsing all of it (see JsonPathReader)
+    paths that are not in the profile are left out
+    """
+    if path.endswith('.gz'):
+        profile = gzip.open(path)
+    else:
+        profile = open(path)
+    try:
+        return JsonPathReader(profile, jsonpaths).read_paths()
+    finally:
+        profile.close()
+
+
+def get_json_path(tree, jsonpath):
+    """
+    returns the element at jsonpath, a comma separated list of keys (f.ex. 'hardware,location'), in tree
+    raises KeyError when it's not there
+    """
+    for key in jsonpath.split(","):
+        tree = tree[key.strip()]
+    return tree
+
+
+def parse_location(location):
+    """
+    returns the chassis and slot numbers in a location like 'mmodule01 - slot 3' (see QUATTOR_LOCATION_STRING_REGEX),
+    or None, None if location has none
+    """
+    match = re.search(get_config("QUATTOR_LOCATION_STRING_REGEX"), location or '')
+    if not match:
+        return None, None
+    return int(match.group('chassis')), int(match.group('slot'))
+
+
+def extract_fields(path, jsonpaths):
+    """
+    returns a dict with the value of every field in jsonpaths (a dict name: json path) in the profile in path,
+    fields that are not in the profile are left out.
+    the chassis and slot are added when the location has them
+    """
+    fields = read_json_paths(path, jsonpaths)
+    chassis, slot = parse_location(fields.get('location'))
+    if chassis is not None:
+        fields['chassis'] = chassis
+        fields['slot'] = slot
+    return fields
+
+
+def _extract(args):
+    """
+    extract_fields for a process in the pool of extract_many
+    returns the path, the fields and an error, the fields only go back to the parent, not the whole profile
+    """
+    path, jsonpaths = args
+    try:
+        return path, extract_fields(path, jsonpaths), None
+    except (IOError, OSError, ValueError), err:
+        return path, None, "%s: %s" % (err.__class__.__name__, err)
+
+
+def extract_many(paths, jsonpaths, processes=None):
+    """
+    returns a dict with every profile in paths that could be read as key and its fields (see extract_fields) as value
+    the profiles are decompressed and parsed in parallel by a pool of processes (QUATTOR_PARSE_PROCESSES in the
+    config, 0 for one per cpu), so they are not all parsed one by one under the GIL
+    """
+    log = fancylogger.getLogger('extract_many')
+    paths = list(paths)
+    if processes is None:
+        processes = int(get_config("QUATTOR_PARSE_PROCESSES")) or multiprocessing.cpu_count()
+    work = [(path, jsonpaths) for path in paths]
+    if processes < 2 or len(paths) < MIN_PARALLEL:
+        results = [_extract(item) for item in work]
+    else:
+        pool = multiprocessing.Pool(min(processes, len(paths)))
+        try:
+            results = pool.map(_extract, work, max(1, len(work) / (processes * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    fields = {}
+    for path, result, err in results:
+        if err:
+            log.warning("could not read quattor profile %s: %s" % (path, err))
+        else:
+            fields[path] = result
+    log.debug("parsed %d quattor profiles with %d processes" % (len(paths), processes))
+    return fields
+
+
+def is_profile(filename):
+    """
+    returns True if filename is the name of a json quattor profile
+    """
+    return filename.endswith('.json.gz') or filename.endswith('.json')
+
+
+class ProfileIndex(object):
+    """
+    The fields of INDEX_FIELDS for the quattor profiles, kept in a file (QUATTOR_INDEX_PATH by default)
+
+    Every profile is stored with its mtime and size, a profile that changed is parsed again the next time
+    it is asked for. When the index changed, it is written (atomically) at exit, or when save is called.
+    """
+    def __init__(self, filename=None):
+        """
+        constructor
+        filename is the file the index is kept in, an empty one keeps it in memory only
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        if filename is None:
+            filename = get_config("QUATTOR_INDEX_PATH")
+        self.filename = filename
+        self.jsonpaths = dict([(name, get_config(key)) for name, key in INDEX_FIELDS.items()])
+        self.entries = None  # absolute path of the profile: [mtime, size, fields]
+        self.changed = False
+        self.registered = False
+        self.lock = threading.RLock()
+
+    def _load(self):
+        """
+        read the index file, the first time it is needed
+        an index made for other json paths is not used
+        """
+        if self.entries is not None:
+            return
+        self.entries = {}
+        if not self.filename:
+            return
+        try:
+            with open(self.filename) as indexfile:
+                data = json.load(indexfile)
+            if data['fields'] == self.jsonpaths:
+                self.entries = data['profiles']
+            else:
+                self.log.debug("%s was made for other fields: %s" % (self.filename, data['fields']))
+        except (IOError, OSError, KeyError, TypeError, ValueError), err:
+            self.log.debug("could not read the profile index %s: %s" % (self.filename, err))
+
+    def _isCurrent(self, path, stat):
+        """
+        returns True if the index has the profile in path, with stat the os.stat of its file
+        """
+        entry = self.entries.get(path)
+        return bool(entry) and entry[0] == stat.st_mtime and entry[1] == stat.st_size
+
+    def _store(self, path, stat, fields):
+        """
+        put the fields of the profile in path in the index
+        """
+        self.entries[path] = [stat.st_mtime, stat.st_size, fields]
+        self._changed()
+
+    def _changed(self):
+        """
+        mark the index as changed, it is saved at exit
+        """
+        self.changed = True
+        if not self.registered and self.filename:
+            atexit.register(self.save)
+            self.registered = True
+
+    def get(self, path):
+        """
+        returns a dict with the fields of the profile in path (see extract_fields)
+        the profile is only parsed when it is not in the index, or changed since
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self.lock.acquire()
+        try:
+            self._load()
+            if self._isCurrent(path, stat):
+                return self.entries[path][2]
+        finally:
+            self.lock.release()
+        fields = extract_fields(path, self.jsonpaths)
+        self.lock.acquire()
+        try:
+            self._store(path, stat, fields)
+        finally:
+            self.lock.release()
+        return fields
+
+    def getMany(self, paths):
+        """
+        returns a dict with the fields of every profile in paths that can be read
+        the profiles that are not in the index or changed since are parsed together (see extract_many)
+        """
+        stats = {}
+        for path in paths:
+            try:
+                stats[os.path.abspath(path)] = os.stat(path)
+            except OSError, err:
+                self.log.debug("no quattor profile %s: %s" % (path, err))
+        self.lock.acquire()
+        try:
+            self._load()
+            stale = [path for path, stat in stats.items() if not self._isCurrent(path, stat)]
+        finally:
+            self.lock.release()
+        self._parse(stale, stats)
+        self.lock.acquire()
+        try:
+            return dict([(path, self.entries[path][2]) for path in stats if path in self.entries])
+        finally:
+            self.lock.release()
+
+    def _parse(self, paths, stats):
+        """
+        parse the profiles in paths and put them in the index, stats has the os.stat of their files
+        """
+        if not paths:
+            return
+        fields = extract_many(paths, self.jsonpaths)
+        self.lock.acquire()
+        try:
+            for path, result in fields.items():
+                self._store(path, stats[path], result)
+        finally:
+            self.lock.release()
+
+    def update(self, path=None):
+        """
+        bring the index up to date for all profiles in the directory path (QUATTOR_PATH by default):
+        profiles that are new or changed are parsed, profiles that are gone are dropped
+        returns the number of profiles that were parsed
+        """
+        if path is None:
+            path = get_config("QUATTOR_PATH")
+        path = os.path.abspath(path)
+        stats = {}
+        for filename in os.listdir(path):
+            if is_profile(filename):
+                profile = os.path.join(path, filename)
+                try:
+                    stats[profile] = os.stat(profile)
+                except OSError:
+                    continue
+        self.lock.acquire()
+        try:
+            self._load()
+            for profile in [profile for profile in self.entries if os.path.dirname(profile) == path]:
+                if profile not in stats:
+                    del self.entries[profile]
+                    self._changed()
+            stale = [profile for profile, stat in stats.items() if not self._isCurrent(profile, stat)]
+        finally:
+            self.lock.release()
+        self._parse(stale, stats)
+        self.log.debug("updated the profile index for %s: %d profiles parsed" % (path, len(stale)))
+        return len(stale)
+
+    def save(self):
+        """
+        write the index to its file, if it changed
+        failures are only logged, the index is not needed to work
+        """
+        self.lock.acquire()
+        try:
+            if not self.changed or not self.filename:
+                return True
+            directory = os.path.dirname(self.filename)
+            try:
+                try:
+                    os.makedirs(directory)
+                except OSError, err:
+                    if err.errno != errno.EEXIST:
+                        raise
+                handle, tmpname = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=directory)
+                try:
+                    with os.fdopen(handle, 'w') as tmpfile:
+                        json.dump({'fields': self.jsonpaths, 'profiles': self.entries}, tmpfile)
+                    os.chmod(tmpname, 0644)
+                    os.rename(tmpname, self.filename)
+                except Exception:
+                    os.unlink(tmpname)
+                    raise
+            except (IOError, OSError, TypeError, ValueError), err:
+                self.log.warning("could not save the profile index to %s: %s" % (self.filename, err))
+                return False
+            self.changed = False
+            self.log.debug("saved the profile index of %d profiles to %s" % (len(self.entries), self.filename))
+            return True
+        finally:
+            self.lock.release()
+
+
+def classify_profiles(filenames):
+    """
+    returns a dict clustername: {role: sorted list of ids} for the profiles in filenames,
+    see QUATTOR_FILES_TPL and ROLE_REGEXES, the ones that don't match are left out
+    """
+    # one regex for all roles, the id group of a role is named after it
+    nodeid = '|'.join([get_config(key).replace('(?P<id>', '(?P<%s>' % role) for role, key in ROLE_REGEXES.items()])
+    profile = re.compile(get_config("QUATTOR_FILES_TPL") % {'nodeid': '(?:%s)' % nodeid,
+                                                            'clustername': r'(?P<cluster>[^.]+)'})
+    hosts = {}
+    for match in map(profile.match, filenames):
+        if not match:
+            continue
+        for role in ROLE_REGEXES:
+            if match.group(role):
+                hosts.setdefault(match.group('cluster'), {}).setdefault(role, set()).add(match.group(role))
+                break
+    for cluster in hosts.values():
+        for role, ids in cluster.items():
+            cluster[role] = sorted(ids)
+    return hosts
+
+
+def scan_profiles(path=None):
+    """
+    returns a dict clustername: {role: sorted list of ids} for all profiles in the quattor directory path
+    (QUATTOR_PATH by default), see classify_profiles
+    the directory is listed only once, and again when its mtime changes (a profile was added or removed)
+    """
+    if path is None:
+        path = get_config("QUATTOR_PATH")
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime
+    _SCANS_LOCK.acquire()
+    try:
+        if path in _SCANS and _SCANS[path][0] == mtime:
+            return _SCANS[path][1]
+        hosts = classify_profiles(os.listdir(path))
+        _SCANS[path] = (mtime, hosts)
+        fancylogger.getLogger('scan_profiles').debug("scanned %s: %d clusters" % (path, len(hosts)))
+        return hosts
+    finally:
+        _SCANS_LOCK.release()
+
+
+def get_profile_index():
+    """
+    returns the ProfileIndex shared by all nodes in this process
+    """
+    global _PROFILE_INDEX
+    _PROFILE_INDEX_LOCK.acquire()
+    try:
+        if _PROFILE_INDEX is None:
+            _PROFILE_INDEX = ProfileIndex()
+        return _PROFILE_INDEX
+    finally:
+        _PROFILE_INDEX_LOCK.release()
@@ -0,0 +1,507 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This module contains the worker pool used to run operations on a lot of nodes in parallel.
+
+Instead of starting a thread per node, work is put in a FIFO queue and handled by a bounded
+number of worker threads. Results are handed back through Task objects, so the caller can
+collect them in the order they were submitted.
+A LimitedExecutor adds limits on the number of tasks using the same resource (f.ex. a chassis) at the same time.
+
+@author: Jens Timmerman
+"""
+import Queue
+import threading
+import time
+import traceback
+
+from vsc.manage.config import get_config
+from vsc.utils import fancylogger
+
+# the resource kind that limits the number of tasks in total
+TOTAL = 'total'
+
+
+class Task(object):
+    """
+    A function call submitted to a WorkerPool
+    after it ran, result holds the return value and error the exception it raised (if any)
+    """
+    def __init__(self, function, args=None, kwargs=None):
+        """
+        constructor
+        """
+        self.function = function
+        self.args = args or ()
+        self.kwargs = kwargs or {}
+        self.result = None
+        self.error = None
+        self.started = None  # time the task started running
+        self.done = False
+        self.abandoned = False
+        self.condition = threading.Condition()
+        self.listeners = []  # queues this task is put on when it is done
+
+    def run(self):
+        """
+        run the function of this task and store its result
+        returns False if the task was abandoned before it got to run
+        """
+        self.condition.acquire()
+        try:
+            if self.abandoned:
+                return False
+            self.started = time.time()
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+        result = None
+        error = None
+        try:
+            result = self.function(*self.args, **self.kwargs)
+        except Exception, ex:
+            error = ex
+            fancylogger.getLogger(self.__class__.__name__).debug(traceback.format_exc())
+
+        self.condition.acquire()
+        self.result = result
+        self.error = error
+        self.done = True
+        self.condition.notifyAll()
+        listeners = self.listeners
+        self.condition.release()
+        for listener in listeners:
+            listener.put(self)
+        return True
+
+    def notify(self, queue):
+        """
+        put this task on queue when it is done, right away if it is done already
+        """
+        self.condition.acquire()
+        try:
+            if not self.done:
+                self.listeners.append(queue)
+                return
+        finally:
+            self.condition.release()
+        queue.put(self)
+
+    def wait(self, timeout=None, deadline=None):
+        """
+        wait until this task is done
+        timeout is counted from the moment the task started running, not from the moment
+        it was queued, so a task waiting for a free worker does not time out.
+        deadline (in seconds since the epoch) is when to stop waiting, whether the task started or not.
+        returns True if the task is done, False when it timed out
+        """
+        self.condition.acquire()
+        try:
+            while not self.done:
+                remaining = self.remaining(timeout, deadline)
+                if remaining is None:
+                    # wake up now and then, a condition wait without timeout can't be interrupted
+                    self.condition.wait(1)
+                    continue
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+        finally:
+            self.condition.release()
+
+    def remaining(self, timeout=None, deadline=None):
+        """
+        returns the number of seconds left before this task times out, see wait
+        None if there is no limit (yet)
+        """
+        remaining = None
+        if self.started is not None and timeout is not None:
+            remaining = self.started + timeout - time.time()
+        if deadline is not None:
+            left = deadline - time.time()
+            if remaining is None or left < remaining:
+                remaining = left
+        return remaining
+
+    def abandon(self):
+        """
+        give up on this task, the result will be ignored
+        returns None if the task is already done, True if it is running
+        and False if it did not start yet (it will not run anymore)
+        """
+        self.condition.acquire()
+        try:
+            if self.done:
+                return None
+            self.abandoned = True
+            return self.started is not None
+        finally:
+            self.condition.release()
+
+
+class Executor(object):
+    """
+    Runs submitted functions as Tasks, the interface shared by WorkerPool and LimitedExecutor
+    """
+    def submit(self, function, *args, **kwargs):
+        """
+        queue function(*args, **kwargs) to be run
+        returns a Task
+        """
+        raise NotImplementedError
+
+    def submitUsing(self, resources, function, *args, **kwargs):
+        """
+        same as submit, for a function that uses resources (a dict kind: name, f.ex. {'chassis': 'chassis01'})
+        only executors with limits on these resources take them into account
+        """
+        return self.submit(function, *args, **kwargs)
+
+    def abandon(self, task):
+        """
+        give up on a task
+        """
+        raise NotImplementedError
+
+    def map(self, function, items, timeout=None, deadline=None):
+        """
+        run function on every item in items
+        returns a list of tasks, in the same order as the items.
+        tasks that did not complete within timeout, or by deadline, are abandoned.
+        """
+        tasks = [self.submit(function, item) for item in items]
+        for task in tasks:
+            if not task.wait(timeout, deadline):
+                self.abandon(task)
+        return tasks
+
+    def as_completed(self, tasks, timeout=None, deadline=None):
+        """
+        yields the tasks as they are done, whatever order they were submitted in
+        tasks that did not complete within timeout (counted from the moment they started) or by deadline
+        are abandoned and yielded when they time out, with done still False.
+        """
+        finished = Queue.Queue()
+        pending = set(tasks)
+        for task in tasks:
+            task.notify(finished)
+        while pending:
+            # tasks that did not start yet have no timeout, wake up now and then to check on them
+            wait = 1
+            for task in [task for task in pending if not task.done]:
+                remaining = task.remaining(timeout, deadline)
+                if remaining is None:
+                    continue
+                if remaining > 0:
+                    wait = min(wait, remaining)
+                    continue
+                self.abandon(task)
+                pending.discard(task)
+                yield task
+            if not pending:
+                return
+            try:
+                task = finished.get(True, wait)
+            except Queue.Empty:
+                continue
+            if task in pending:
+                pending.discard(task)
+                yield task
+
+
+class WorkerPool(Executor):
+    """
+    A pool of at most size worker threads, handling submitted tasks in FIFO order
+
+    Workers are started when there is work queued and no idle worker to take it.
+    A worker stuck on an abandoned task no longer counts towards the size of the pool,
+    so a few hanging nodes don't starve the rest of the queue.
+    The stuck workers are still threads though, so no more than limit worker threads are started in total,
+    the queue waits for stuck tasks to return when they are all in use.
+    """
+    def __init__(self, size, limit=None):
+        """
+        constructor
+        size is the maximum amount of tasks running at the same time,
+        limit the maximum number of worker threads, including the stuck ones (twice size by default)
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.size = int(size)
+        if self.size < 1:
+            self.log.raiseException("Size of the worker pool should be at least 1, got %s" % size, SchedulerException)
+        if limit is None:
+            limit = 2 * self.size
+        self.limit = int(limit)
+        if self.limit < self.size:
+            self.log.raiseException("Thread limit of the worker pool should be at least its size %s, got %s" %
+                                    (self.size, limit), SchedulerException)
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.running = 0  # worker threads not stuck on an abandoned task
+        self.threads = 0  # all worker threads, also the ones stuck on an abandoned task
+        self.idle = 0  # worker threads waiting for a task
+        self.full = False  # set when a worker could not be replaced because of the limit
+
+    def submit(self, function, *args, **kwargs):
+        """
+        queue function(*args, **kwargs) to be run by one of the workers
+        returns a Task
+        """
+        task = Task(function, args, kwargs)
+        self.put(task)
+        return task
+
+    def put(self, task):
+        """
+        queue a Task to be run by one of the workers
+        """
+        self.queue.put(task)
+        self._grow()
+
+    def abandon(self, task):
+        """
+        give up on a task, its worker is replaced so the pool keeps its size (as long as the limit allows it)
+        """
+        if task.abandon():
+            # the worker running it is lost until the task returns
+            self.lock.acquire()
+            self.running -= 1
+            self.lock.release()
+            self._grow()
+
+    def _grow(self):
+        """
+        start an extra worker if there is more work queued than idle workers to do it
+        """
+        self.lock.acquire()
+        try:
+            if self.running < self.size and self.queue.qsize() > self.idle:
+                if self.threads >= self.limit:
+                    if not self.full:
+                        self.full = True
+                        self.log.warning("%d worker threads are stuck on abandoned tasks, waiting for them to return "
+                                         "before starting more than %d threads" % (self.threads - self.running,
+                                                                                   self.limit))
+                    return
+                self.running += 1
+                self.threads += 1
+                if self.threads > self.size:
+                    self.log.info("worker pool grew to %d threads, %d of them stuck on abandoned tasks" %
+                                  (self.threads, self.threads - self.running))
+                worker = threading.Thread(target=self._work, name="manage-worker")
+                worker.setDaemon(True)
+                worker.start()
+        finally:
+            self.lock.release()
+
+    def _work(self):
+        """
+        worker thread main loop
+        """
+        while True:
+            self.lock.acquire()
+            self.idle += 1
+            self.lock.release()
+            task = self.queue.get()
+            self.lock.acquire()
+            self.idle -= 1
+            self.lock.release()
+
+            if task.run() and task.abandoned:
+                # we were replaced while running this task, only continue if there is room left
+                self.lock.acquire()
+                try:
+                    if self.running >= self.size:
+                        self.threads -= 1
+                        self.full = False
+                        return
+                    self.running += 1
+                finally:
+                    self.lock.release()
+
+
+class ResourceLimits(object):
+    """
+    Limits on the number of items (tasks, coroutines) using the same resource at the same time
+
+    limits maps a kind of resource (f.ex. 'chassis') on the number of items that may use one resource of that kind
+    at the same time, the kind TOTAL limits the number of items in total.
+    Items that don't fit are held back in the order they were added, an item only waits for the resources it uses,
+    so items using other resources can go first.
+    """
+    def __init__(self, limits):
+        """
+        constructor
+        """
+        self.log = fancylogger.getLogger(self.__class__.__name__)
+        self.limits = {}
+        for kind, limit in limits.items():
+            if int(limit) < 1:
+                self.log.raiseException("Limit on %s should be at least 1, got %s" % (kind, limit), SchedulerException)
+            self.limits[kind] = int(limit)
+        self.using = {}  # (kind, name) -> number of started items using it
+        self.started = {}  # item -> the (kind, name) keys it uses
+        self.held = []  # [item, keys] of the items waiting for their resources
+        self.lock = threading.Lock()
+
+    def add(self, item, resources):
+        """
+        add an item that uses resources (a dict kind: name), resources of a kind without a limit are ignored
+        returns the items that can start now, item itself if there is room for it
+        """
+        keys = [(kind, name) for kind, name in resources.items() if kind in self.limits]
+        if TOTAL in self.limits:
+            keys.append((TOTAL, None))
+        self.lock.acquire()
+        try:
+            self.held.append([item, keys])
+            return self._start()
+        finally:
+            self.lock.release()
+
+    def done(self, item):
+        """
+        the item is done with its resources, or won't be started anymore
+        returns the items that can start now
+        """
+        self.lock.acquire()
+        try:
+            if item in self.started:
+                for key in self.started.pop(item):
+                    self.using[key] -= 1
+            else:
+                self.held = [entry for entry in self.held if entry[0] is not item]
+            return self._start()
+        finally:
+            self.lock.release()
+
+    def _start(self):
+        """
+        start the held items there is room for, with the lock held
+        returns these items
+        """
+        started = []
+        held = []
+        for index, (item, keys) in enumerate(self.held):
+            if TOTAL in self.limits and self.using.get((TOTAL, None), 0) >= self.limits[TOTAL]:
+                # nothing else fits
+                held.extend(self.held[index:])
+                break
+            if [key for key in keys if self.using.get(key, 0) >= self.limits[key[0]]]:
+                held.append([item, keys])
+            else:
+                for key in keys:
+                    self.using[key] = self.using.get(key, 0) + 1
+                self.started[item] = keys
+                started.append(item)
+        self.held = held
+        return started
+
+
+class LimitedExecutor(Executor):
+    """
+    Runs tasks in a WorkerPool, within ResourceLimits on the resources they use
+
+    Tasks that have to wait for a resource are not handed to the pool yet, so they don't take up a worker,
+    and they don't time out while they wait (timeouts count from the moment a task starts).
+    """
+    def __init__(self, pool, limits):
+        """
+        constructor
+        pool is the WorkerPool running the tasks, limits is a dict kind: limit (see ResourceLimits)
+        """
+        self.pool = pool
+        self.limits = ResourceLimits(limits)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        queue function(*args, **kwargs), it only counts towards the TOTAL limit
+        returns a Task
+        """
+        return self.submitUsing({}, function, *args, **kwargs)
+
+    def submitUsing(self, resources, function, *args, **kwargs):
+        """
+        queue function(*args, **kwargs), it is handed to the pool as soon as there is room on all its resources
+        returns a Task
+        """
+        task = Task(self._run, kwargs={'function': function, 'args': args, 'kwargs': kwargs})
+        task.args = (task,)
+        self._put(self.limits.add(task, resources))
+        return task
+
+    def abandon(self, task):
+        """
+        give up on a task, a task that did not start yet frees its place right away
+        """
+        self.pool.abandon(task)
+        if task.started is None:
+            # it won't run anymore, so it won't free its resources itself
+            self._put(self.limits.done(task))
+
+    def _run(self, task, function, args, kwargs):
+        """
+        run the function of task, and start the tasks waiting for its resources when it's done
+        """
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._put(self.limits.done(task))
+
+    def _put(self, tasks):
+        """
+        hand tasks to the pool
+        """
+        for task in tasks:
+            self.pool.put(task)
+
+
+_WORKER_POOL = None
+_WORKER_POOL_LOCK = threading.Lock()
+
+
+def get_worker_pool():
+    """
+    returns the worker pool shared by all operations in this process
+    it is created on first use, with WORKER_POOL_SIZE workers and at most WORKER_POOL_MAX_THREADS threads
+    """
+    global _WORKER_POOL
+    _WORKER_POOL_LOCK.acquire()
+    try:
+        if _WORKER_POOL is None:
+            _WORKER_POOL = WorkerPool(get_config("WORKER_POOL_SIZE"), get_config("WORKER_POOL_MAX_THREADS"))
+        return _WORKER_POOL
+    finally:
+        _WORKER_POOL_LOCK.release()
+
+
+class SchedulerException(Exception):
+    """
+    SchedulerException
+    thrown when the worker pool is used in a wrong way
+    """
+    pass
@@ -0,0 +1,208 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Tests for the connection pools in vsc.manage.connections
+
+@author: Jens Timmerman
+'''
+import os
+import socket
+import sys
+import threading
+import time
+from vsc.install.testing import TestCase
+
+# use the default shipped configfile
+from vsc.manage import config
+config.DEFAULT_CONFIGFILE = os.path.join(os.path.dirname(sys.argv[0]), 'config/manage_defaults.cfg')
+# get_options will initialize
+config.get_options()
+
+from vsc.manage.connections import get_ssh_pool, get_telnet_pool
+from vsc.manage.managecommands import SshCommand, TelnetCommand
+from vsc.manage.scheduler import WorkerPool
+from test.sshserver import SshServer, USER, PASSWD
+
+
+class SshConnectionPoolTest(TestCase):
+
+    def setUp(self):
+        """start an ssh server"""
+        self.server = SshServer()
+
+    def tearDown(self):
+        """stop the ssh server and forget its connections"""
+        get_ssh_pool().closeAll()
+        self.server.close()
+
+    def command(self, cmd):
+        """an SshCommand to the test server"""
+        return SshCommand(cmd, host='127.0.0.1', user=USER, passwd=PASSWD, port=self.server.port, timeout=10)
+
+    def testReuse(self):
+        """
+        consecutive and concurrent commands to the same host share one connection
+        """
+        self.assertEqual(self.command('echo 1').run(), ('1', ''))
+        self.assertEqual(self.command('echo 2 >&2; exit 1').run(), ('', '2'))
+        tasks = WorkerPool(5).map(lambda i: self.command('echo %s' % i).run(), range(10), timeout=10)
+        self.assertEqual([t.result for t in tasks], [(str(i), '') for i in range(10)])
+        self.assertEqual(self.server.connections, 1)
+
+    def testReconnect(self):
+        """
+        a connection closed by the server is replaced
+        """
+        self.assertEqual(self.command('echo 1').run(), ('1', ''))
+        self.server.dropConnections()
+        time.sleep(0.2)
+        self.assertEqual(self.command('echo 2').run(), ('2', ''))
+        self.assertEqual(self.server.connections, 2)
+
+    def testIdle(self):
+        """
+        idle connections are evicted
+        """
+        pool = get_ssh_pool()
+        idle_timeout = pool.idle_timeout
+        pool.idle_timeout = 0.1
+        try:
+            self.command('echo 1').run()
+            time.sleep(0.3)
+            self.command('echo 2').run()
+        finally:
+            pool.idle_timeout = idle_timeout
+        self.assertEqual(self.server.connections, 2)
+
+
+class ImmServer(object):
+    """
+    telnet server behaving like an imm: a login, then commands answered with the power state
+    logins counts the successful logins
+    """
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(50)
+        self.port = self.sock.getsockname()[1]
+        self.logins = 0
+        self.clients = []
+        thread = threading.Thread(target=self._accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except Exception:
+                return
+            self.clients.append(client)
+            thread = threading.Thread(target=self._session, args=(client,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def _session(self, client):
+        lines = client.makefile('r')
+        try:
+            client.sendall("login :")
+            if lines.readline().strip() != 'USERID':
+                return
+            client.sendall("Password:")
+            if lines.readline().strip() != 'secret':
+                return
+            self.logins += 1
+            client.sendall("\r\nsystem>")
+            while True:
+                line = lines.readline().strip()
+                if not line or line == 'exit':
+                    return
+                time.sleep(0.01)
+                client.sendall("%s\r\nPower: On\r\n\r\nsystem>" % line)
+        except Exception:
+            pass
+        finally:
+            client.close()
+
+    def dropConnections(self):
+        """close all sessions from the server side"""
+        for client in self.clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+        self.clients = []
+
+    def close(self):
+        self.dropConnections()
+        self.sock.close()
+
+
+class TelnetSessionPoolTest(TestCase):
+
+    def setUp(self):
+        """start an imm"""
+        self.server = ImmServer()
+
+    def tearDown(self):
+        """stop the imm and forget the sessions"""
+        get_telnet_pool().closeAll()
+        self.server.close()
+
+    def command(self, cmd):
+        """a TelnetCommand to the test imm"""
+        return TelnetCommand(cmd, '127.0.0.1', user='USERID', passwd='secret', port=self.server.port, timeout=5)
+
+    def testReuse(self):
+        """
+        consecutive and concurrent commands to the same imm use one session
+        """
+        self.assertEqual(self.command('power state').run(), ('power state\r\nPower: On\r\n\r\nsystem>', None))
+        tasks = WorkerPool(5).map(lambda i: self.command('power %s' % i).run(), range(10), timeout=10)
+        self.assertEqual([t.result[0].split('\r\n')[0] for t in tasks], ['power %s' % i for i in range(10)])
+        self.assertEqual(self.server.logins, 1)
+
+    def testReconnect(self):
+        """
+        a session closed by the imm is replaced
+        """
+        self.assertEqual(self.command('power state').run()[1], None)
+        self.server.dropConnections()
+        time.sleep(0.1)
+        self.assertEqual(self.command('power on').run()[0].split('\r\n')[0], 'power on')
+        self.assertEqual(self.server.logins, 2)
+
+    def testLoginFailure(self):
+        """
+        a failed login is reported as the error of the command
+        """
+        command = self.command('power state')
+        command.passwd = 'wrong'
+        command.timeout = 1
+        out, err = command.run()
+        self.assertEqual(out, None)
+        self.assertTrue(err)
+        self.assertEqual(get_telnet_pool().sessions, {})
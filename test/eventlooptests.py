@@ -0,0 +1,187 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Tests for the event loop in vsc.manage.eventloop and the awaitable variants of the commands
+
+@author: Jens Timmerman
+'''
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from vsc.install.testing import TestCase
+
+# use the default shipped configfile
+from vsc.manage import config
+config.DEFAULT_CONFIGFILE = os.path.join(os.path.dirname(sys.argv[0]), 'config/manage_defaults.cfg')
+# get_options will initialize
+config.get_options()
+
+from vsc.manage.eventloop import Offload, Return, Sleep, iter_coroutines, run_coroutines
+from vsc.manage.managecommands import Command, CompositeCommand, ServerAliveCommand
+
+
+def double(value):
+    """coroutine returning twice value, after a short sleep"""
+    yield Sleep(0.01)
+    yield Return(value * 2)
+
+
+def fails():
+    """coroutine raising an exception"""
+    yield Sleep(0)
+    raise ValueError("failed")
+
+
+class EventLoopTest(TestCase):
+
+    def testCoroutines(self):
+        """
+        sub coroutines, offloading and exceptions
+        """
+        def main():
+            total = yield double(2)
+            total += yield Offload(sum, [1, 2, 3])
+            try:
+                yield fails()
+            except ValueError:
+                total += 100
+            yield Return(total)
+
+        coroutine = run_coroutines([main()])[0]
+        self.assertEqual(coroutine.error, None)
+        self.assertEqual(coroutine.result, 110)
+
+    def testTimeout(self):
+        """
+        coroutines running over their timeout are cancelled, the others are not
+        """
+        cleaned = []
+
+        def hang():
+            try:
+                yield Sleep(10)
+            finally:
+                cleaned.append(True)
+
+        start = time.time()
+        hanging, fast = run_coroutines([hang(), double(1)], timeout=0.2)
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(hanging.timedout)
+        self.assertEqual(cleaned, [True])
+        self.assertFalse(fast.timedout)
+        self.assertEqual(fast.result, 2)
+
+    def testIterate(self):
+        """
+        coroutines are yielded as soon as they are done, timed out ones when they are cancelled
+        """
+        def sleep(seconds):
+            yield Sleep(seconds)
+            yield Return(seconds)
+
+        start = time.time()
+        results = []
+        for coroutine in iter_coroutines([sleep(10), sleep(0.2), sleep(0)], timeout=0.5):
+            results.append((coroutine.result, coroutine.timedout, round(time.time() - start, 1)))
+        self.assertEqual(results, [(0, False, 0), (0.2, False, 0.2), (None, True, 0.5)])
+
+    def testCommands(self):
+        """
+        local commands run concurrently from a single thread
+        """
+        commands = [Command('sleep 0.5; echo %s' % i, timeout=5) for i in range(20)]
+        start = time.time()
+        coroutines = run_coroutines([command.arun() for command in commands])
+        self.assertTrue(time.time() - start < 3)
+        self.assertEqual([c.result for c in coroutines], [(str(i), '') for i in range(20)])
+
+        out, err = run_coroutines([Command('sleep 10', timeout=1).arun()])[0].result
+        self.assertEqual(err, 'command timed out')
+
+    def testCancelCommand(self):
+        """
+        a cancelled command that ignores SIGTERM is killed anyway
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            pidfile = os.path.join(tmpdir, 'pid')
+            command = Command('trap "" TERM; echo $$ > %s; sleep 30' % pidfile, timeout=20)
+            start = time.time()
+            coroutine = run_coroutines([command.arun()], timeout=0.5)[0]
+            self.assertTrue(coroutine.timedout)
+            self.assertTrue(time.time() - start < 1)
+            pid = int(open(pidfile).read())
+            while time.time() - start < 5:
+                try:
+                    os.kill(pid, 0)
+                except OSError:
+                    break
+                time.sleep(0.1)
+            self.assertRaises(OSError, os.kill, pid, 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testUnreadOutput(self):
+        """
+        a command that exited, but whose output was not read to the end by the deadline, timed out, like in run
+        """
+        # the background sleep keeps the pipes open after the shell exited
+        command = Command('echo first; (sleep 3; echo late) &', timeout=1)
+        start = time.time()
+        result = run_coroutines([command.arun()])[0].result
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(result, ('first', 'command timed out'))
+        self.assertEqual(command.run(), result)
+
+    def testCompositeCommand(self):
+        """
+        composite commands run their commands one by one
+        """
+        command = CompositeCommand()
+        command.addCommand(Command('echo 1'))
+        command.addCommand(Command('echo 2 >&2'))
+        self.assertEqual(run_coroutines([command.arun()])[0].result, [('1', ''), ('', '2')])
+
+    def testServerAlive(self):
+        """
+        tcp connects without blocking the event loop
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        port = server.getsockname()[1]
+        alive = ServerAliveCommand('127.0.0.1', port=port, timeout=2)
+        # nothing is listening on the port of a closed socket
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(('127.0.0.1', 0))
+        dead = ServerAliveCommand('127.0.0.1', port=closed.getsockname()[1], timeout=2)
+        closed.close()
+        results = [c.result for c in run_coroutines([alive.arun(), dead.arun()])]
+        server.close()
+        self.assertEqual(results[0], (True, None))
+        self.assertEqual(results[1][0], False)
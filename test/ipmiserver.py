@@ -0,0 +1,185 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+A simulated BMC to test the ipmi client against, it speaks RMCP+ on a udp port on localhost
+and knows about the chassis power commands.
+
+@author: Jens Timmerman
+'''
+import hashlib
+import hmac
+import os
+import socket
+import struct
+import threading
+
+from vsc.manage.ipmi import AES, ipmi_message, parse_ipmi_message
+
+USER = 'ADMIN'
+PASSWD = 'secret'
+GUID = '0123456789abcdef'
+RMCP = '\x06\x00\xff\x07'
+
+
+def _hmac(key, data):
+    return hmac.new(key, data, hashlib.sha1).digest()
+
+
+class Bmc(object):
+    """
+    answers RMCP+ packets in a thread
+    opened counts the sessions that were set up, power is the chassis power state,
+    with duplicate set every answer is sent twice
+    """
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.power = False
+        self.duplicate = False
+        self.opened = 0
+        self.controls = []
+        self.sessions = {}
+        thread = threading.Thread(target=self._serve)
+        thread.setDaemon(True)
+        thread.start()
+
+    def forget(self):
+        """drop all sessions, like a BMC does when they time out"""
+        self.sessions = {}
+
+    def close(self):
+        """stop answering, this wakes up the thread"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65536)
+            except Exception:
+                return
+            if not data:
+                return
+            try:
+                answer = self._handle(data)
+            except Exception:
+                answer = None
+            if answer:
+                try:
+                    self.sock.sendto(RMCP + answer, address)
+                    if self.duplicate:
+                        self.sock.sendto(RMCP + answer, address)
+                except Exception:
+                    return
+
+    def _handle(self, data):
+        ptype, sid, _, length = struct.unpack('<BIIH', data[5:16])
+        payload = data[16:16 + length]
+        kind = ptype & 0x3f
+        if kind == 0x10:
+            tag = ord(payload[0])
+            console_sid = struct.unpack('<I', payload[4:8])[0]
+            algorithms = (ord(payload[12]), ord(payload[20]), ord(payload[28]))
+            bmc_sid = struct.unpack('<I', os.urandom(4))[0] | 1
+            self.sessions[bmc_sid] = {'console': console_sid, 'algorithms': algorithms, 'active': False}
+            answer = struct.pack('<BBBBII', tag, 0, 4, 0, console_sid, bmc_sid) + payload[8:32]
+            return self._header(0x11, 0, answer)
+        if kind == 0x12:
+            tag, bmc_sid = struct.unpack('<B3xI', payload[:8])
+            session = self.sessions[bmc_sid]
+            session['rm'] = payload[8:24]
+            session['name'] = payload[24] + payload[27:28 + ord(payload[27])]
+            if payload[28:] != USER:
+                return self._header(0x13, 0, struct.pack('<BB2xI', tag, 0x0d, session['console']))
+            session['rc'] = os.urandom(16)
+            authcode = _hmac(PASSWD, struct.pack('<II', session['console'], bmc_sid) + session['rm'] + session['rc'] +
+                             GUID + session['name'])
+            answer = struct.pack('<BB2xI', tag, 0, session['console']) + session['rc'] + GUID + authcode
+            return self._header(0x13, 0, answer)
+        if kind == 0x14:
+            tag, _, bmc_sid = struct.unpack('<BB2xI', payload[:8])
+            session = self.sessions[bmc_sid]
+            expected = _hmac(PASSWD, session['rc'] + struct.pack('<I', session['console']) + session['name'])
+            if payload[8:28] != expected:
+                return self._header(0x15, 0, struct.pack('<BB2xI', tag, 0x0f, session['console']))
+            sik = _hmac(PASSWD, session['rm'] + session['rc'] + session['name'])
+            session['k1'] = _hmac(sik, '\x01' * 20)
+            session['k2'] = _hmac(sik, '\x02' * 20)
+            session['active'] = True
+            self.opened += 1
+            icv = _hmac(sik, session['rm'] + struct.pack('<I', bmc_sid) + GUID)[:12]
+            return self._header(0x15, 0, struct.pack('<BB2xI', tag, 0, session['console']) + icv)
+        if kind == 0x00:
+            session = self.sessions.get(sid)
+            if session is None or not session['active']:
+                return None
+            if ptype & 0x40 and _hmac(session['k1'], data[4:-12])[:12] != data[-12:]:
+                return None
+            if ptype & 0x80:
+                plain = AES.new(session['k2'][:16], AES.MODE_CBC, payload[:16]).decrypt(payload[16:])
+                payload = plain[:-1 - ord(plain[-1])]
+            netfn, rqseq, cmd, request = parse_ipmi_message(payload)
+            if (netfn, cmd) == (0x06, 0x3b):
+                response = '\x00' + request[0]
+            elif (netfn, cmd) == (0x06, 0x3c):
+                del self.sessions[sid]
+                response = '\x00'
+            elif (netfn, cmd) == (0x00, 0x01):
+                response = '\x00' + chr(int(self.power)) + '\x00\x00'
+            elif (netfn, cmd) == (0x00, 0x02):
+                self.controls.append(ord(request[0]))
+                self.power = ord(request[0]) in (1, 2, 3)
+                response = '\x00'
+            else:
+                response = '\xc1'  # invalid command
+            message = ipmi_message(netfn + 1, cmd, response, rqseq, source=0x20, target=0x81)
+            return self._session(session, message)
+        return None
+
+    def _header(self, ptype, sid, payload, seq=0):
+        return struct.pack('<BBIIH', 0x06, ptype, sid, seq, len(payload)) + payload
+
+    def _session(self, session, message):
+        """a packet with an ipmi message on an active session"""
+        _, integrity, confidentiality = session['algorithms']
+        ptype = 0x00
+        if confidentiality:
+            iv = os.urandom(16)
+            pad = (16 - (len(message) + 1) % 16) % 16
+            plain = message + ''.join([chr(i) for i in range(1, pad + 1)]) + chr(pad)
+            message = iv + AES.new(session['k2'][:16], AES.MODE_CBC, iv).encrypt(plain)
+            ptype |= 0x80
+        if integrity:
+            ptype |= 0x40
+        packet = self._header(ptype, session['console'], message, seq=1)
+        if integrity:
+            pad = (4 - (len(packet) + 2) % 4) % 4
+            packet += '\xff' * pad + chr(pad) + '\x07'
+            packet += _hmac(session['k1'], packet)[:12]
+        return packet
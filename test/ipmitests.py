@@ -0,0 +1,226 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Tests for the ipmi client in vsc.manage.ipmi
+
+@author: Jens Timmerman
+'''
+import os
+import socket
+import sys
+import threading
+import time
+from vsc.install.testing import TestCase
+
+# use the default shipped configfile
+from vsc.manage import config
+config.DEFAULT_CONFIGFILE = os.path.join(os.path.dirname(sys.argv[0]), 'config/manage_defaults.cfg')
+# get_options will initialize
+config.get_options()
+
+from vsc.manage.ipmi import AES, IpmiClient
+from vsc.manage.managecommands import IpmiStatusCommand, IpmiPoweronCommand, batch_ipmi_commands
+from test.ipmiserver import Bmc, USER, PASSWD
+
+if AES is None:
+    # without pycrypto, the shared client can't do the default cipher suite
+    config.get_config()['ipmi_cipher_suite'] = '2'
+
+
+class IpmiClientTest(TestCase):
+
+    def setUp(self):
+        """start some BMCs"""
+        self.bmcs = [Bmc() for _ in range(10)]
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for bmc in self.bmcs:
+            bmc.close()
+
+    def client(self, suite=2):
+        """an IpmiClient, closed after the test"""
+        client = IpmiClient(suite=suite, retry=0.2)
+        self.clients.append(client)
+        return client
+
+    def run_all(self, client, command, passwd=PASSWD, timeout=5):
+        """run a command on all BMCs at once"""
+        return client.run([('127.0.0.1', bmc.port, USER, passwd, command) for bmc in self.bmcs], timeout)
+
+    def _power(self, suite):
+        """
+        power on all nodes in one run, sessions are set up once
+        """
+        client = self.client(suite)
+        self.assertEqual(self.run_all(client, 'status'), [('Chassis Power is off', '')] * 10)
+        self.assertEqual(self.run_all(client, 'on'), [('Chassis Power Control: Up/On', '')] * 10)
+        self.assertEqual(self.run_all(client, 'status'), [('Chassis Power is on', '')] * 10)
+        self.assertEqual([bmc.opened for bmc in self.bmcs], [1] * 10)
+        self.assertEqual([bmc.controls for bmc in self.bmcs], [[1]] * 10)
+
+    def testSuite1(self):
+        """no integrity, no confidentiality"""
+        self._power(1)
+
+    def testSuite2(self):
+        """HMAC-SHA1-96 integrity"""
+        self._power(2)
+
+    def testSuite3(self):
+        """HMAC-SHA1-96 integrity and AES-CBC-128 confidentiality"""
+        if AES is None:
+            self.skipTest("pycrypto is not available")
+        self._power(3)
+
+    def testAllCommands(self):
+        """
+        the power commands map on the chassis control codes, several commands for one BMC run in order
+        """
+        client = self.client()
+        commands = ['off', 'on', 'cycle', 'reset', 'soft']
+        results = client.run([('127.0.0.1', self.bmcs[0].port, USER, PASSWD, c) for c in commands], 5)
+        self.assertEqual([out for out, _ in results], ['Chassis Power Control: Down/Off', 'Chassis Power Control: Up/On',
+                                                      'Chassis Power Control: Cycle', 'Chassis Power Control: Reset',
+                                                      'Chassis Power Control: Soft'])
+        self.assertEqual(self.bmcs[0].controls, [0, 1, 2, 3, 5])
+
+    def testDuplicates(self):
+        """
+        BMCs that send every answer twice, the second one is dropped
+        """
+        for bmc in self.bmcs:
+            bmc.duplicate = True
+        self._power(2)
+
+    def testMixedCredentials(self):
+        """
+        sessions with other credentials to the same BMC in one run get their own answers
+        """
+        port = self.bmcs[0].port
+        results = self.client().run([('127.0.0.1', port, USER, PASSWD, 'status'),
+                                     ('127.0.0.1', port, 'other', PASSWD, 'status'),
+                                     ('127.0.0.1', port, USER, 'other', 'status'),
+                                     ('127.0.0.1', port, USER, PASSWD, 'on')], 5)
+        self.assertEqual(results[0], ('Chassis Power is off', ''))
+        self.assertEqual(results[3], ('Chassis Power Control: Up/On', ''))
+        self.assertEqual(results[1], (None, 'RAKP 2 from 127.0.0.1 failed with status 0x0d'))
+        self.assertEqual(results[2], (None, 'Wrong user or password for 127.0.0.1'))
+        self.assertEqual(self.bmcs[0].opened, 1)
+
+    def testConcurrentRuns(self):
+        """
+        runs in other threads share the client, one waiting on a BMC that doesn't answer holds up no other run
+        """
+        client = self.client()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        results = {}
+
+        def dead():
+            results['dead'] = client.run([('127.0.0.1', sock.getsockname()[1], USER, PASSWD, 'status')], 3)
+
+        def live(index):
+            results[index] = client.run([('127.0.0.1', self.bmcs[index].port, USER, PASSWD, 'on')], 3)
+
+        threads = [threading.Thread(target=dead)]
+        threads[0].start()
+        time.sleep(0.1)
+        try:
+            start = time.time()
+            threads.extend([threading.Thread(target=live, args=(index,)) for index in range(10)])
+            for thread in threads[1:]:
+                thread.start()
+            for thread in threads[1:]:
+                thread.join(5)
+            self.assertTrue(time.time() - start < 1)
+            threads[0].join(5)
+        finally:
+            sock.close()
+        self.assertEqual(results['dead'][0][0], None)
+        self.assertEqual([results[index] for index in range(10)], [[('Chassis Power Control: Up/On', '')]] * 10)
+        self.assertEqual([bmc.controls for bmc in self.bmcs], [[1]] * 10)
+
+    def testWrongPassword(self):
+        """
+        a wrong password is reported
+        """
+        out, err = self.run_all(self.client(), 'status', passwd='wrong')[0]
+        self.assertEqual(out, None)
+        self.assertTrue('Wrong user or password' in err)
+
+    def testNoAnswer(self):
+        """
+        a BMC that does not answer times out, without holding up the others
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        try:
+            start = time.time()
+            results = self.client().run([('127.0.0.1', sock.getsockname()[1], USER, PASSWD, 'status'),
+                                         ('127.0.0.1', self.bmcs[0].port, USER, PASSWD, 'status')], 1)
+            self.assertTrue(time.time() - start < 1.5)
+        finally:
+            sock.close()
+        self.assertEqual(results[0][0], None)
+        self.assertEqual(results[1], ('Chassis Power is off', ''))
+
+    def testExpiredSession(self):
+        """
+        a session the BMC forgot about is set up again
+        """
+        client = self.client()
+        self.run_all(client, 'status')
+        for bmc in self.bmcs:
+            bmc.forget()
+        self.assertEqual(self.run_all(client, 'status'), [('Chassis Power is off', '')] * 10)
+        self.assertEqual([bmc.opened for bmc in self.bmcs], [2] * 10)
+
+    def testCommands(self):
+        """
+        IpmiCommands for several nodes run in one batch
+        """
+        commands = []
+        for bmc in self.bmcs:
+            command = IpmiPoweronCommand('127.0.0.1', 'shuppet')
+            command.port = bmc.port
+            command.user = USER
+            commands.append(command)
+        batch_ipmi_commands(commands)
+        self.assertEqual([bmc.controls for bmc in self.bmcs], [[1]] * 10)
+        self.assertEqual([command.run() for command in commands], [('Chassis Power Control: Up/On', '')] * 10)
+        command = IpmiStatusCommand('127.0.0.1', 'shuppet')
+        command.port = self.bmcs[0].port
+        command.user = USER
+        self.assertEqual(command.run(), ('Chassis Power is on', ''))
+        # a result that was not picked up is forgotten in a new run
+        batch_ipmi_commands([command])
+        command.setDeadline(None)
+        self.assertEqual(command.batchResult, None)
+        self.assertEqual(batch_ipmi_commands([command]), 1)
+        self.assertEqual(command.getCommand(), "IpmiStatusCommand: %s@127.0.0.1:%s command: chassis power status" %
+                         (USER, command.port))
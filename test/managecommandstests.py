@@ -0,0 +1,410 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Tests for the commands in vsc.manage.managecommands
+
+@author: Jens Timmerman
+'''
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from vsc.install.testing import TestCase
+
+# use the default shipped configfile
+from vsc.manage import config
+config.DEFAULT_CONFIGFILE = os.path.join(os.path.dirname(sys.argv[0]), 'config/manage_defaults.cfg')
+# get_options will initialize
+config.get_options()
+
+from vsc.manage.connections import get_ssh_pool
+from vsc.manage.managecommands import Command, SshCommand, BladeBatchCommand, BladePoweronCommand, \
+    BladeStateCommand, batch_blade_commands, batchable_commands, CompositeCommand, ServerAliveCommand, tcp_sweep, sweep_alive_commands, \
+    MasterCommand, SetOfflineMasterCommand, chunk_arguments, command_line_limit
+from test.sshserver import SshServer, USER, PASSWD
+
+
+class CommandTest(TestCase):
+
+    def testFastCommand(self):
+        """
+        a local command should return as soon as the process exits, not after a polling interval
+        """
+        start = time.time()
+        out, err = Command('echo hello', timeout=5).run()
+        self.assertEqual(out, 'hello')
+        self.assertEqual(err, '')
+        self.assertTrue(time.time() - start < 0.5)
+
+    def testExitcode(self):
+        """
+        stderr and the exitcode should be reported
+        """
+        out, err = Command('echo out; echo err >&2; exit 3', timeout=5).run()
+        self.assertEqual(out, 'out')
+        self.assertEqual(err, 'err exitcode: 3')
+
+    def testLargeOutput(self):
+        """
+        output larger than the pipe buffer should not block the process
+        """
+        out, err = Command('head -c 1000000 /dev/zero | tr "\\\\0" x; head -c 200000 /dev/zero >&2',
+                           timeout=5).run()
+        self.assertEqual(len(out), 1000000)
+        self.assertEqual(len(err), 200000)
+
+    def testTimeout(self):
+        """
+        a command running over its timeout is killed right at the timeout
+        """
+        start = time.time()
+        out, err = Command('echo started; sleep 10', timeout=1).run()
+        took = time.time() - start
+        self.assertEqual(out, 'started')
+        self.assertEqual(err, 'command timed out')
+        self.assertTrue(1 <= took < 3)
+
+    def testCancel(self):
+        """
+        a cancelled command is killed with everything it started, and does not start anymore
+        """
+        command = Command('echo started; sleep 10; echo done', timeout=20)
+        threading.Timer(0.3, command.cancel).start()
+        start = time.time()
+        self.assertEqual(command.run(), ('started', 'command timed out'))
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(command.expired())
+        composite = CompositeCommand()
+        composite.addCommand(command)
+        self.assertEqual(composite.run(), [(None, 'command timed out')])
+        # a new deadline starts a new run
+        command.setDeadline(None)
+        self.assertFalse(command.expired())
+
+
+class SshCommandTest(TestCase):
+
+    def setUp(self):
+        """start an ssh server"""
+        self.server = SshServer()
+
+    def tearDown(self):
+        """stop the ssh server and forget its connections"""
+        get_ssh_pool().closeAll()
+        self.server.close()
+
+    def command(self, cmd, timeout=10):
+        """an SshCommand to the test server"""
+        return SshCommand(cmd, host='127.0.0.1', user=USER, passwd=PASSWD, port=self.server.port, timeout=timeout)
+
+    def testFastCommand(self):
+        """
+        a remote command returns as soon as its exit status is in
+        """
+        self.command('true').run()  # set up the connection
+        start = time.time()
+        self.assertEqual(self.command('uname').run(), (os.uname()[0], ''))
+        self.assertTrue(time.time() - start < 0.5)
+
+    def testLargeOutput(self):
+        """
+        output larger than the channel window is read while the command runs
+        """
+        out, err = self.command('head -c 3000000 /dev/zero | tr "\\\\0" x; echo err >&2').run()
+        self.assertEqual(len(out), 3000000)
+        self.assertEqual(err, 'err')
+
+    def testOutputAfterStatus(self):
+        """
+        output that comes in after the exit status is read too
+        """
+        self.server.status_first = True
+        self.assertEqual(self.command('echo out; echo more; echo err >&2').run(), ('out\nmore', 'err'))
+
+    def testRefused(self):
+        """
+        a command the server refuses to run leaves no file descriptors open
+        """
+        self.command('true').run()  # set up the connection
+        self.server.refuse_exec = True
+        fds = len(os.listdir('/proc/self/fd'))
+        for _ in range(5):
+            out, err = self.command('true').run()
+            self.assertTrue(err)
+        self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+
+    def testTimeout(self):
+        """
+        a remote command running over its timeout is given up on at the timeout
+        """
+        start = time.time()
+        out, err = self.command('sleep 5', timeout=1).run()
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(out, '')
+        self.assertEqual(err, 'ssh command timed out')
+
+    def testCancel(self):
+        """
+        cancelling closes the channel, the connection can still be used
+        """
+        command = self.command('sleep 10')
+        threading.Timer(0.5, command.cancel).start()
+        start = time.time()
+        out, err = command.run()
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(err, 'ssh command timed out')
+        self.assertEqual(self.command('echo again').run(), ('again', ''))
+
+
+class BladeBatchCommandTest(TestCase):
+
+    def setUp(self):
+        """start an ssh server showing the prompt of a management module, with a fake power command"""
+        self.server = SshServer(prompt=BladeBatchCommand.PROMPT)
+        self.bindir = tempfile.mkdtemp()
+        power = os.path.join(self.bindir, 'power')
+        with open(power, 'w') as script:
+            script.write('#!/bin/sh\necho "$3"\necho "$1"\n')
+        os.chmod(power, 0755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = "%s:%s" % (self.bindir, self.path)
+
+    def tearDown(self):
+        """stop the ssh server and forget its connections"""
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.bindir)
+        get_ssh_pool().closeAll()
+        self.server.close()
+
+    def testBatch(self):
+        """
+        the commands for one chassis run in a single shell session and get their own output back
+        """
+        commands = [BladePoweronCommand('127.0.0.1', 1), BladeStateCommand('127.0.0.1', 2),
+                    BladePoweronCommand('otherchassis', 3), BladeStateCommand('127.0.0.1', 4)]
+        batches = batch_blade_commands(commands)
+        self.assertEqual([[command.command for command in batch.commands] for batch in batches],
+                         [['power -on -T system:blade[1]', 'power -state -T system:blade[2]',
+                           'power -state -T system:blade[4]']])
+        batch = batches[0]
+        batch.user = USER
+        batch.passwd = PASSWD
+        batch.port = self.server.port
+        batch.run()
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.shells, 1)
+        # commands waiting for their output to be picked up are not batched again
+        self.assertEqual(batch_blade_commands(commands), [])
+        self.assertEqual(commands[0].run(), ('system:blade[1]\n-on', ''))
+        self.assertEqual(commands[1].run(), ('-state', ''))
+        self.assertEqual(commands[3].run(), ('-state', ''))
+        self.assertEqual(commands[0].batchResult, None)
+
+    def testNewRun(self):
+        """
+        a result that was not picked up, f.ex. because the node timed out, is not used in a new run
+        """
+        commands = [BladePoweronCommand('127.0.0.1', 1), BladeStateCommand('127.0.0.1', 2)]
+        batch = batch_blade_commands(commands)[0]
+        batch.user = USER
+        batch.passwd = PASSWD
+        batch.port = self.server.port
+        batch.run()
+        for command in commands:
+            command.setDeadline(None)
+        self.assertEqual([command.batchResult for command in commands], [None, None])
+        self.assertEqual([command.command for command in batch_blade_commands(commands)[0].commands],
+                         ['power -on -T system:blade[1]', 'power -state -T system:blade[2]'])
+
+    def testQueueOrder(self):
+        """
+        only the blade commands at the start of a queue are batched, the others run after what comes before them
+        """
+        queues = [[SshCommand('echo first'), BladePoweronCommand('127.0.0.1', 1)],
+                  [BladePoweronCommand('127.0.0.1', 2), SshCommand('echo'), BladeStateCommand('127.0.0.1', 3)],
+                  [BladePoweronCommand('127.0.0.1', 4), BladeStateCommand('127.0.0.1', 4)]]
+        commands = batchable_commands(queues)
+        self.assertEqual(commands, [queues[1][0], queues[2][0], queues[2][1]])
+        self.assertEqual([command.command for command in batch_blade_commands(commands)[0].commands],
+                         ['power -on -T system:blade[2]', 'power -on -T system:blade[4]',
+                          'power -state -T system:blade[4]'])
+
+    def testFailedBatch(self):
+        """
+        when the session fails, the commands keep running on their own
+        """
+        commands = [BladePoweronCommand('127.0.0.1', 1), BladePoweronCommand('127.0.0.1', 2)]
+        batch = batch_blade_commands(commands)[0]
+        batch.port = self.server.port  # the default blade user is refused
+        self.assertEqual(batch.run(), [])
+        self.assertEqual([command.batchResult for command in commands], [None, None])
+
+
+class TcpSweepTest(TestCase):
+
+    def setUp(self):
+        """listen on all loopback addresses"""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('', 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+
+    def tearDown(self):
+        self.sock.close()
+
+    def testSweep(self):
+        """
+        all hosts are checked at the same time
+        """
+        hosts = ['127.0.0.%d' % i for i in range(1, 101)]
+        start = time.time()
+        results = tcp_sweep(hosts, self.port, timeout=2)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(sorted(results.keys()), sorted(hosts))
+        for alive, latency, err in results.values():
+            self.assertTrue(alive)
+            self.assertTrue(latency >= 0)
+            self.assertEqual(err, None)
+
+    def testDead(self):
+        """
+        refused connections and unknown hosts are reported as not alive
+        """
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        results = tcp_sweep(['127.0.0.1', 'nosuchhost.invalid'], port, timeout=2)
+        for host in ['127.0.0.1', 'nosuchhost.invalid']:
+            alive, latency, err = results[host]
+            self.assertFalse(alive)
+            self.assertEqual(latency, None)
+            self.assertTrue(err)
+
+    def testSweepCommands(self):
+        """
+        the ServerAliveCommands in composite commands get the result of the sweep
+        """
+        composite = CompositeCommand()
+        composite.addCommand(ServerAliveCommand('127.0.0.1', port=self.port))
+        composite.addCommand(Command('true'))
+        other = ServerAliveCommand('127.0.0.2', port=self.port)
+        swept = sweep_alive_commands([composite, other])
+        self.assertEqual(sorted(swept.keys()), ['127.0.0.1', '127.0.0.2'])
+        self.sock.close()
+        # the results are used once, without connecting again
+        self.assertEqual(other.run(), (True, None))
+        self.assertEqual(composite.run(), [(True, None), ('', '')])
+        self.assertFalse(other.run()[0])
+
+    def testSweepNewRun(self):
+        """
+        a sweep result that was not picked up, f.ex. because the node timed out, is not used in a new run
+        """
+        command = ServerAliveCommand('127.0.0.1', port=self.port)
+        sweep_alive_commands([command])
+        self.sock.close()
+        command.setDeadline(None)
+        self.assertEqual(command.sweepResult, None)
+        self.assertFalse(command.run()[0])
+
+
+class MasterCommandTest(TestCase):
+
+    def setUp(self):
+        """start an ssh server, with a fake sudo and a pbsnodes that logs its arguments and knows no node 'bad'"""
+        self.server = SshServer()
+        self.bindir = tempfile.mkdtemp()
+        self.calls = os.path.join(self.bindir, 'calls')
+        scripts = [
+            ('sudo', '#!/bin/sh\nexec "$@"\n'),
+            ('pbsnodes', '#!/bin/sh\necho "$@" >> %s\nrc=0\nfor node in "$@"; do\n  case $node in\n'
+                         '    bad*) echo "pbsnodes: Unknown node  MSG=cannot locate specified node $node" >&2; rc=1;;\n'
+                         '  esac\ndone\nexit $rc\n' % self.calls),
+        ]
+        for name, script in scripts:
+            with open(os.path.join(self.bindir, name), 'w') as fake:
+                fake.write(script)
+            os.chmod(os.path.join(self.bindir, name), 0755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = "%s:%s" % (self.bindir, self.path)
+
+    def tearDown(self):
+        """stop the ssh server and forget its connections"""
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.bindir)
+        get_ssh_pool().closeAll()
+        self.server.close()
+
+    def connect(self, command):
+        """point command to the test server"""
+        command.host = '127.0.0.1'
+        command.user = USER
+        command.passwd = PASSWD
+        command.port = self.server.port
+        return command
+
+    def testChunks(self):
+        """arguments are split so the command lines stay under the limit"""
+        self.assertEqual(chunk_arguments('cmd -o %s', ['node1', 'node2', 'node3'], 20), [['node1', 'node2'], ['node3']])
+        self.assertEqual(chunk_arguments('cmd -o %s', ['node1', 'node2', 'node3'], 100), [['node1', 'node2', 'node3']])
+        self.assertEqual(chunk_arguments('cmd -o %s', ['averylongnodename', 'node2'], 10),
+                         [['averylongnodename'], ['node2']])
+        self.assertEqual(chunk_arguments('cmd -o %s', [], 10), [])
+        self.assertTrue(command_line_limit() >= 16384)
+
+    def testOneInvocation(self):
+        """all nodes are set offline with one pbsnodes"""
+        nodes = ['node%d.cluster.gent.vsc' % i for i in range(800)]
+        command = self.connect(SetOfflineMasterCommand('master'))
+        command.setNodeList(nodes)
+        self.assertEqual(command.run(), ('', ''))
+        self.assertEqual(open(self.calls).read().splitlines(), ['-o %s' % ' '.join(nodes)])
+        self.assertEqual(command.failed, {})
+
+    def testFailures(self):
+        """every chunk gets its own pbsnodes, failures are found per node"""
+        nodes = ['node1.cluster', 'bad2.cluster', 'node3.cluster', 'node4.cluster', 'bad5.cluster']
+        command = self.connect(MasterCommand('master', nodes, 'sudo pbsnodes -c %s', limit=50))
+        self.assertEqual(command.command, 'sudo pbsnodes -c node1.cluster bad2.cluster;'
+                                          'sudo pbsnodes -c node3.cluster node4.cluster;'
+                                          'sudo pbsnodes -c bad5.cluster')
+        out, err = command.run()
+        self.assertEqual(open(self.calls).read().splitlines(), ['-c node1.cluster bad2.cluster',
+                                                                '-c node3.cluster node4.cluster',
+                                                                '-c bad5.cluster'])
+        self.assertEqual(sorted(command.failed.keys()), ['bad2.cluster', 'bad5.cluster'])
+        self.assertEqual(err.splitlines(), [
+            'bad2.cluster: pbsnodes: Unknown node  MSG=cannot locate specified node bad2.cluster',
+            'bad5.cluster: pbsnodes: Unknown node  MSG=cannot locate specified node bad5.cluster',
+        ])
+        # an error about none of the nodes is about all of them
+        command.commandtpl = 'sudo pbsnodes -c %s; false'
+        command.setNodeList(['node6.cluster', 'node7.cluster'])
+        out, err = command.run()
+        self.assertEqual(command.failed, {'node6.cluster': 'exitcode: 1', 'node7.cluster': 'exitcode: 1'})
@@ -28,7 +28,10 @@ Created on Oct 18, 2011
 @author: Jens Timmerman
 '''
 import os
+import socket
 import sys
+import threading
+import time
 import traceback
 from vsc.install.testing import TestCase
 
@@ -42,8 +45,9 @@ config.get_options()
 from vsc.manage.config import Options, get_config
 from vsc.manage.manage import Manager
 from vsc.manage.clusters import Cluster, NoSuchClusterException
-from vsc.manage.managecommands import Command
-from vsc.manage.nodes import NodeException, TestNode, CompositeNode
+from vsc.manage.managecommands import BladeBatchCommand, BladePoweronCommand, Command
+from vsc.manage.nodes import BMC, CHASSIS, NodeException, TestNode, CompositeNode
+from vsc.manage.scheduler import WorkerPool, TOTAL
 
 
 TEST_CLUSTER = 'shuppet'
@@ -54,6 +58,8 @@ if not os.path.isdir(QUATTOR_PATH):
     raise Exception('Cannot find QUATTOR_PATH in %s (set VSC_MANAGE_QUATTOR_PATH envvar)' % QUATTOR_PATH)
 config.CONFIG['QUATTOR_PATH'] = QUATTOR_PATH
 config.CONFIG['QUATTOR_PATH'.lower()] = QUATTOR_PATH
+# keep the profile index in memory
+config.CONFIG['quattor_index_path'] = ''
 
 
 class ManageTest(TestCase):
@@ -327,8 +333,17 @@ class ManageTest(TestCase):
 
     def testdoitOutput(self):
         """Test the consistency of the output of manager.doit"""
+        self._doitOutput('threads')
+
+    def testdoitOutputEventLoop(self):
+        """Test the consistency of the output of manager.doit with the event loop backend"""
+        self._doitOutput('eventloop')
+
+    def _doitOutput(self, backend):
+        """Check the output of manager.doit with timing out commands"""
         opts = Options()  # default options object
         opts.cluster = TEST_CLUSTER
+        opts.backend = backend
         opts.quattor_nodes = True
         opts.ledon = True
         manager = Manager(opts)
@@ -361,6 +376,133 @@ class ManageTest(TestCase):
         self.assertTrue(testnode in errors)
         self.assertTrue(testnode2 in errors)
 
+    def testIterDoIt(self):
+        """The output of a node is yielded as soon as it is done, doIt keeps the order of the nodes"""
+        for backend in ('threads', 'eventloop'):
+            nodes = CompositeNode(timeout=1)
+            for nodeid, command in [('node111', 'sleep 0.5 ; echo slow'), ('node112', 'echo fast'),
+                                    ('node113', 'sleep 3')]:
+                node = TestNode(nodeid, 'localhost', None)
+                node.ledoncommand = Command(command, timeout=1)
+                node.ledOn()
+                nodes.add(node)
+            order = [out[0].nodeid for out in nodes.iterDoIt(backend=backend)]
+            self.assertEqual(order, ['node112', 'node111', 'node113'])
+
+            for node in nodes.getNodes():
+                node.ledOn()
+            out = nodes.doIt(backend=backend)
+            self.assertEqual([i[0].nodeid for i in out], ['node111', 'node112', 'node113'])
+            self.assertEqual(out[2][1][0][1], (None, 'command timed out'))
+
+    def testBatchOrder(self):
+        """Blade commands are only batched when nothing else comes before them on their node"""
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        closed = sock.getsockname()[1]
+        sock.close()
+        nodes = CompositeNode(timeout=5)
+        first = TestNode('node111', 'localhost', None)
+        first.commands = [Command('echo before'), BladePoweronCommand('127.0.0.1', 1)]
+        # nothing listens here, the command fails right away when it runs on its own
+        first.commands[1].port = closed
+        second = TestNode('node112', 'localhost', None)
+        second.commands = [BladePoweronCommand('127.0.0.1', 2), Command('echo after')]
+        nodes.add(first)
+        nodes.add(second)
+        batched = []
+
+        def runBatches(commands, threaded=True, limits=None):
+            for command in commands:
+                command.batchResult = ('batched', '')
+                batched.append(command)
+        nodes._runBatches = runBatches
+        out = nodes.doIt(threaded=False)
+        self.assertEqual(batched, [second.commands[0]])
+        self.assertEqual(out[0][1][0][1], ('before', ''))
+        self.assertTrue('Could not connect' in out[0][1][1][1][1])
+        self.assertEqual([result for _, result in out[1][1]], [('batched', ''), ('after', '')])
+
+    def testDeadline(self):
+        """Everything stops at the deadline, what did not finish by then is reported as timed out"""
+        for threaded, backend in ((True, 'threads'), (True, 'eventloop'), (False, 'threads')):
+            nodes = CompositeNode(timeout=10)
+            for nodeid in ('node111', 'node112', 'node113'):
+                node = TestNode(nodeid, 'localhost', None)
+                node.commands = [Command('sleep 1 ; echo first', timeout=10), Command('sleep 1 ; echo second', timeout=10)]
+                nodes.add(node)
+            start = time.time()
+            nodes.setDeadline(start + 1.5)
+            out = nodes.doIt(threaded, backend=backend)
+            self.assertTrue(time.time() - start < 2.5)
+            results = [[result for _, result in i[1]] for i in out]
+            if threaded:
+                self.assertEqual(results, [[('first', ''), (None, 'command timed out')]] * 3)
+            else:
+                self.assertEqual(results, [[('first', ''), (None, 'command timed out')]] +
+                                 [[(None, 'command timed out')] * 2] * 2)
+
+    def testCancel(self):
+        """Nodes that time out are cancelled, their workers are free again right away"""
+        threads = set(threading.enumerate())
+        nodes = CompositeNode(timeout=0.5, executor=WorkerPool(2))
+        for nodeid in ('node111', 'node112', 'node113', 'node114'):
+            node = TestNode(nodeid, 'localhost', None)
+            node.commands = [Command('sleep 10', timeout=20), Command('echo never', timeout=20)]
+            nodes.add(node)
+        start = time.time()
+        out = nodes.doIt()
+        self.assertTrue(time.time() - start < 3)
+        self.assertEqual([i[1] for i in out], [[['command timed out', (None, 'command timed out')]]] * 4)
+        time.sleep(0.5)
+        # only the 2 workers of the pool are left (threads of earlier tests may have stopped meanwhile)
+        self.assertEqual(len(set(threading.enumerate()) - threads), 2)
+        # the next run is not affected by the cancel
+        for node in nodes.getNodes():
+            node.commands = [Command('echo again', timeout=5)]
+        self.assertEqual([i[1][0][1] for i in nodes.doIt()], [('again', '')] * 4)
+
+    def testLimits(self):
+        """Nodes using the same bmc wait for each other, the others run in parallel"""
+        for backend in ('threads', 'eventloop'):
+            nodes = CompositeNode(timeout=5)
+            for nodeid, imm in [('node111', 'imm1'), ('node112', 'imm1'), ('node113', 'imm2'), ('node114', 'imm3')]:
+                node = TestNode(nodeid, 'localhost', None)
+                node.immname = imm
+                node.commands = [Command('sleep 0.3 ; echo %s' % nodeid, timeout=5)]
+                nodes.add(node)
+            start = time.time()
+            order = [out[0].nodeid for out in nodes.iterDoIt(limits={BMC: 1, CHASSIS: 2, TOTAL: 3}, backend=backend)]
+            self.assertTrue(0.55 < time.time() - start < 1.5)
+            self.assertEqual(order[-1], 'node112')
+            # the test nodes have no location, so they are not limited per chassis
+            self.assertEqual(nodes.get('node111').getResources([CHASSIS, BMC]), {BMC: 'imm1'})
+
+    def testBatchLimits(self):
+        """The chassis sessions of blade commands stay within the limits"""
+        nodes = CompositeNode(timeout=5, executor=WorkerPool(8))
+        commands = [BladePoweronCommand('chassis%d' % index, slot) for index in range(6) for slot in (1, 2)]
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def run(batch):
+            with lock:
+                running.append(batch)
+                most.append(len(running))
+            time.sleep(0.2)
+            with lock:
+                running.remove(batch)
+            return []
+        original = BladeBatchCommand.run
+        BladeBatchCommand.run = run
+        try:
+            nodes._runBatches(commands, limits={CHASSIS: 3, TOTAL: 2})
+        finally:
+            BladeBatchCommand.run = original
+        self.assertEqual(len(most), 6)
+        self.assertEqual(max(most), 2)
+
     def testManagerCreatorActionOptions(self):
         """
         test the manager constructor
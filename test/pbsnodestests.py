@@ -0,0 +1,330 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Tests for the pbsnodes -x parser in vsc.manage.pbsnodes, with a benchmark against the regex it replaced
+
+@author: Jens Timmerman
+'''
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from vsc.install.testing import TestCase
+
+# use the default shipped configfile
+from vsc.manage import config
+config.DEFAULT_CONFIGFILE = os.path.join(os.path.dirname(sys.argv[0]), 'config/manage_defaults.cfg')
+# get_options will initialize
+config.get_options()
+
+from vsc.manage.connections import get_ssh_pool
+from vsc.manage.clusters import Cluster
+from vsc.manage.managecommands import PBSStateCommand
+from vsc.manage.nodes import CompositeNode, MasterNode, Node, TestNode
+from vsc.manage.pbsnodes import PbsNode, PbsStateCache, index_states, iter_pbsnodes, parse_pbsnodes
+from vsc.utils import fancylogger
+from test.sshserver import SshServer, USER, PASSWD
+
+# the regex on the output of sudo pbsnodes | grep -v 'status\|jobs' that PBSStateCommand used
+OLD_REGEX = "(node\\d+).*?.vsc\\n.*state = (.*?)\\n"
+
+XML = """<?xml version="1.0"?>
+<Data><Node><name>node2101.delcatty.gent.vsc</name><state>free</state><power_state>Running</power_state><np>16</np>\
+<properties>delcatty,ib</properties><ntype>cluster</ntype><jobs>0-7/123.master15.delcatty.gent.vsc,\
+8/124.master15.delcatty.gent.vsc,9/124.master15.delcatty.gent.vsc</jobs>\
+<status>rectime=1476,state=free,netload=12,gres=,loadave=0.00</status><mom_service_port>15002</mom_service_port>\
+</Node><Node><name>node2102.delcatty.gent.vsc</name><state>down,offline</state><np>16</np>\
+<properties>delcatty</properties><ntype>cluster</ntype><note>bad dimm &amp; disk</note></Node>\
+<Node><name>gpu01</name><state>job-exclusive</state><np>8</np><ntype>cluster</ntype></Node></Data>
+"""
+
+
+def synthetic(count):
+    """
+    returns the output of pbsnodes -x and of sudo pbsnodes | grep -v 'status\|jobs' for count nodes,
+    as pbs_server on a large cluster prints it
+    """
+    states = ['free', 'job-exclusive', 'down', 'offline', 'down,offline']
+    xml = ['<?xml version="1.0"?>\n<Data>']
+    text = []
+    for i in range(count):
+        name = 'node%d.cluster.gent.vsc' % (1000 + i)
+        state = states[i % len(states)]
+        jobs = ','.join(['%d/%d.master.cluster.gent.vsc' % (slot, 1000 + i / 4) for slot in range(16)])
+        status = ','.join(['rectime=1476,varattr=,jobs=%s' % jobs, 'state=%s' % state, 'size=123456kb:654321kb'] +
+                          ['gres%d=%d' % (j, j) for j in range(20)])
+        xml.append('<Node><name>%s</name><state>%s</state><power_state>Running</power_state><np>16</np>'
+                   '<properties>cluster,ib</properties><ntype>cluster</ntype><jobs>%s</jobs><status>%s</status>'
+                   '<mom_service_port>15002</mom_service_port></Node>' % (name, state, jobs, status))
+        text.append('%s\n     state = %s\n     power_state = Running\n     np = 16\n     properties = cluster,ib\n'
+                    '     ntype = cluster\n     mom_service_port = 15002\n\n' % (name, state))
+    xml.append('</Data>\n')
+    return ''.join(xml), ''.join(text)
+
+
+class PbsNodesTest(TestCase):
+
+    def testParse(self):
+        """all fields are kept, nodes are known by their short name"""
+        nodes = parse_pbsnodes(XML)
+        self.assertEqual(sorted(nodes.keys()), ['gpu01', 'node2101', 'node2102'])
+        self.assertEqual(nodes['node2101'], PbsNode('node2101.delcatty.gent.vsc', state='free', np=16,
+                                                    properties=('delcatty', 'ib'), ntype='cluster',
+                                                    jobs=('123.master15.delcatty.gent.vsc',
+                                                          '124.master15.delcatty.gent.vsc')))
+        self.assertEqual(nodes['node2102'].getStates(), ['down', 'offline'])
+        self.assertEqual(nodes['node2102'].note, 'bad dimm & disk')
+        self.assertEqual(nodes['node2102'].jobs, ())
+        self.assertEqual(nodes['gpu01'].properties, ())
+        self.assertEqual(PbsNode('node1').getStates(), [])
+        self.assertEqual(PbsNode.fromDict(nodes['node2101'].toDict()), nodes['node2101'])
+
+    def testIncremental(self):
+        """nodes are parsed from a file object, one by one"""
+        source = open(os.devnull)
+        self.assertRaises(SyntaxError, list, iter_pbsnodes(source))
+        nodes = iter_pbsnodes(XML)
+        self.assertEqual(nodes.next().name, 'node2101.delcatty.gent.vsc')
+        self.assertEqual([node.name for node in nodes], ['node2102.delcatty.gent.vsc', 'gpu01'])
+
+
+class StateIndexTest(TestCase):
+
+    def testIndex(self):
+        """every state maps to the nodes in it"""
+        self.assertEqual(index_states(parse_pbsnodes(XML)), {
+            'free': set(['node2101']),
+            'down': set(['node2102']),
+            'offline': set(['node2102']),
+            'job-exclusive': set(['gpu01']),
+        })
+
+    def testSelection(self):
+        """nodes are selected on their state with one index for all of them"""
+        master = MasterNode('master1', 'testcluster')
+        master.nodestates = parse_pbsnodes(XML)
+        master.getPbsStatusForNode = None
+        nodes = CompositeNode()
+        for nodeid in ['node2101', 'node2102', 'gpu01', 'node2103']:
+            nodes.add(TestNode(nodeid, 'testcluster', master))
+        self.assertEqual(nodes.getDownNodes().nodes.keys(), ['node2102'])
+        self.assertEqual(nodes.getIdleNodes().nodes.keys(), ['node2101'])
+        self.assertEqual(sorted(nodes.getNodesInStates([Node.DOWN, Node.OFFLINE, Node.BUSY]).nodes.keys()),
+                         ['gpu01', 'node2102'])
+        self.assertEqual(nodes.getNodesInStates([]).nodes.keys(), [])
+        index = master.getStateIndex()
+        self.assertTrue(master.getStateIndex() is index)
+        # new node states get a new index
+        master.nodestates = {'node2103': PbsNode('node2103', state='free')}
+        self.assertEqual(nodes.getIdleNodes().nodes.keys(), ['node2103'])
+
+
+class PbsStateCacheTest(TestCase):
+
+    def setUp(self):
+        """a directory for the cache"""
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testCache(self):
+        """saved node states come back, as long as they are fresh enough"""
+        cache = PbsStateCache('testcluster', os.path.join(self.path, 'cache'))
+        self.assertEqual(cache.load(60), None)
+        nodes = parse_pbsnodes(XML)
+        self.assertTrue(cache.save(nodes))
+        self.assertEqual(os.listdir(cache.path), ['testcluster.json'])
+        other = PbsStateCache('testcluster', cache.path)
+        loaded = other.load(60)
+        self.assertEqual(loaded, nodes)
+        self.assertEqual(type(loaded['node2101'].name), str)
+        self.assertEqual(other.load(0), None)
+        self.assertEqual(PbsStateCache('othercluster', cache.path).load(60), None)
+
+    def testBroken(self):
+        """a cache that can't be written or read is not used"""
+        with open(os.path.join(self.path, 'testcluster.json'), 'w') as cachefile:
+            cachefile.write('{"time": 1')
+        self.assertEqual(PbsStateCache('testcluster', self.path).load(60), None)
+        cache = PbsStateCache('testcluster', os.path.join(self.path, 'testcluster.json'))
+        self.assertFalse(cache.save(parse_pbsnodes(XML)))
+
+
+class PbsServerTestCase(TestCase):
+
+    def setUp(self):
+        """start an ssh server, with a fake sudo and pbsnodes"""
+        self.server = SshServer()
+        self.bindir = tempfile.mkdtemp()
+        self.output = os.path.join(self.bindir, 'output.xml')
+        with open(self.output, 'w') as output:
+            output.write(XML)
+        for name, script in [('sudo', '#!/bin/sh\nexec "$@"\n'),
+                             ('pbsnodes', '#!/bin/sh\n[ "$1" = "-x" ] && cat %s\n' % self.output)]:
+            with open(os.path.join(self.bindir, name), 'w') as fake:
+                fake.write(script)
+            os.chmod(os.path.join(self.bindir, name), 0755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = "%s:%s" % (self.bindir, self.path)
+
+    def tearDown(self):
+        """stop the ssh server and forget its connections"""
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.bindir)
+        get_ssh_pool().closeAll()
+        self.server.close()
+
+
+class PBSStateCommandTest(PbsServerTestCase):
+
+    def command(self):
+        """a PBSStateCommand to the test server"""
+        command = PBSStateCommand('127.0.0.1', timeout=10)
+        command.user = USER
+        command.passwd = PASSWD
+        command.port = self.server.port
+        return command
+
+    def testCommand(self):
+        """PBSStateCommand parses the xml, and reports what it can't parse"""
+        out, err = self.command().run()
+        self.assertEqual(err, '')
+        self.assertEqual(sorted(out.keys()), ['gpu01', 'node2101', 'node2102'])
+        self.assertEqual(out['gpu01'].state, 'job-exclusive')
+        with open(self.output, 'w') as output:
+            output.write('pbsnodes: Server has no node list')
+        out, err = self.command().run()
+        self.assertEqual(out, {})
+        self.assertTrue(isinstance(err, SyntaxError))
+
+
+class ProbedMaster(MasterNode):
+    """a master that is probed by running command on the test ssh server"""
+
+    def __init__(self, nodeid, server, command):
+        MasterNode.__init__(self, nodeid, 'testcluster')
+        self.server = server
+        self.command = command
+        self.probes = []
+        self.stateCache = PbsStateCache('testcluster', server.cachepath)
+
+    def getProbeCommand(self):
+        probe = MasterNode.getProbeCommand(self)
+        probe.host = '127.0.0.1'
+        probe.user = USER
+        probe.passwd = PASSWD
+        probe.port = self.server.port
+        probe.command = self.command
+        self.probes.append(probe)
+        return probe
+
+
+class MasterProbeTest(PbsServerTestCase):
+
+    def setUp(self):
+        """a directory for the state cache"""
+        PbsServerTestCase.setUp(self)
+        self.server.cachepath = os.path.join(self.bindir, 'cache')
+
+    def cluster(self, *commands):
+        """a cluster with a master per command, that is run to probe it"""
+        cluster = Cluster()
+        cluster.masters = CompositeNode()
+        for index, command in enumerate(commands):
+            cluster.masters.add(ProbedMaster('master%d' % (index + 1), self.server, command))
+        return cluster
+
+    def testFirstAnswer(self):
+        """all masters are probed at once, the first answer is used for the node states"""
+        cluster = self.cluster('sleep 5; sudo pbsnodes -x', 'false', 'sudo pbsnodes -x')
+        start = time.time()
+        master = cluster.getMaster()
+        self.assertTrue(time.time() - start < 3)
+        self.assertEqual(master.nodeid, 'master3')
+        self.assertEqual(cluster.getMaster(), master)
+        self.assertEqual([len(m.probes) for m in cluster.masters.getNodes()], [1, 1, 1])
+        # the node states are not asked for again
+        master.PBSStateCommand = None
+        self.assertEqual(sorted(master.getWorkerNodeIds()), ['gpu01', 'node2101', 'node2102'])
+        self.assertEqual(master.getPbsStatusForNode('node2102'), ('down,offline', None))
+
+    def testNoAnswer(self):
+        """without a working master, the first one is used"""
+        cluster = self.cluster('false', 'echo nothing')
+        master = cluster.getMaster()
+        self.assertEqual(master.nodeid, 'master1')
+        self.assertEqual(master.nodestates, None)
+
+
+    def testStaleness(self):
+        """with max_staleness, the node states saved by the master that answered are used"""
+        self.cluster('sudo pbsnodes -x').getMaster()
+        cluster = self.cluster('false', 'false')
+        cluster.max_staleness = 60
+        master = cluster.getMaster()
+        self.assertEqual(master.nodeid, 'master1')
+        self.assertEqual([len(m.probes) for m in cluster.masters.getNodes()], [0, 0])
+        self.assertEqual(master.getPbsStatusForNode('node2102'), ('down,offline', None))
+        # saved too long ago, the masters are asked again
+        with open(master.stateCache.filename) as cachefile:
+            data = json.load(cachefile)
+        data['time'] -= 100
+        with open(master.stateCache.filename, 'w') as cachefile:
+            json.dump(data, cachefile)
+        cluster = self.cluster('false', 'sudo pbsnodes -x')
+        cluster.max_staleness = 60
+        self.assertEqual(cluster.getMaster().nodeid, 'master2')
+
+
+class PbsNodesBenchmark(TestCase):
+
+    def testBenchmark(self):
+        """the parser against the old regex, on 5000 nodes, and the parser on 4 times as many"""
+        log = fancylogger.getLogger(self.__class__.__name__)
+        xml, text = synthetic(5000)
+
+        start = time.time()
+        old = dict(re.findall(OLD_REGEX, text))
+        regex_time = time.time() - start
+        start = time.time()
+        nodes = parse_pbsnodes(xml)
+        parse_time = time.time() - start
+
+        self.assertEqual(len(nodes), 5000)
+        self.assertEqual(dict([(nodeid, node.state) for nodeid, node in nodes.items()]), old)
+        self.assertEqual(len(nodes['node1004'].jobs), 1)
+
+        bigxml = synthetic(20000)[0]
+        start = time.time()
+        self.assertEqual(len(parse_pbsnodes(bigxml)), 20000)
+        big_time = time.time() - start
+        log.info("5000 nodes: regex %.3fs on %d bytes, parser %.3fs on %d bytes; 20000 nodes: parser %.3fs" %
+                 (regex_time, len(text), parse_time, len(xml), big_time))
+        # linear, with a lot of room for a busy machine
+        self.assertTrue(big_time < parse_time * 4 * 3)
@@ -0,0 +1,243 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Tests for the staggered poweron and waiting for the power state in vsc.manage.power
+
+@author: Jens Timmerman
+'''
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from vsc.install.testing import TestCase
+
+# use the default shipped configfile
+from vsc.manage import config
+config.DEFAULT_CONFIGFILE = os.path.join(os.path.dirname(sys.argv[0]), 'config/manage_defaults.cfg')
+# get_options will initialize
+config.get_options()
+
+from vsc.manage.managecommands import Command, is_powered_off, is_powered_on
+from vsc.manage.nodes import BMC, CompositeNode, TestNode
+from vsc.manage.power import PowerOnSequencer, PowerStateWaiter
+from vsc.manage.scheduler import TOTAL
+
+
+class PowerTestCase(TestCase):
+
+    def setUp(self):
+        """a directory with a file per node that is on"""
+        self.powered = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.powered)
+
+    def nodes(self, nodeids, stays_off=()):
+        """
+        a compositenode with test nodes that power on by creating their file,
+        the nodes in stays_off never come on
+        """
+        nodes = CompositeNode(timeout=5)
+        for nodeid in nodeids:
+            node = TestNode(nodeid, 'localhost', None)
+            path = os.path.join(self.powered, nodeid)
+            if nodeid not in stays_off:
+                node.poweronCommand = Command('touch %s' % path, timeout=5)
+            else:
+                node.poweronCommand = Command('true', timeout=5)
+            node.powerStateCommand = Command('test -e %s && echo On || echo Off' % path, timeout=5)
+            nodes.add(node)
+        return nodes
+
+
+class PowerOnSequencerTest(PowerTestCase):
+
+    def sequencer(self, nodes, rates, **kwargs):
+        """a sequencer that keeps track of its waves in self.waves"""
+        sequencer = PowerOnSequencer(nodes, rates, **kwargs)
+        self.waves = []
+        run_wave = sequencer._runWave
+
+        def record(wave, threaded):
+            self.waves.append([node.nodeid for node in wave])
+            return run_wave(wave, threaded)
+        sequencer._runWave = record
+        return sequencer
+
+    def testIsPoweredOn(self):
+        """the outputs of the different power state commands"""
+        for out in ['On', 'ON', 'Chassis Power is on', 'system> power -state\nOn']:
+            self.assertTrue(is_powered_on(out))
+        for out in [None, '', 'Off', 'Chassis Power is off', 'running testcommand: powerstate on node1.localhost']:
+            self.assertFalse(is_powered_on(out))
+
+    def testWaves(self):
+        """waves grow while they are confirmed fast, nodes sharing a bmc are never in the same wave"""
+        nodeids = ['node11%s' % i for i in range(8)]
+        nodes = self.nodes(nodeids)
+        nodes.get('node111').immname = nodes.get('node110').immname
+        sequencer = self.sequencer(nodes, {BMC: 1, TOTAL: 4}, confirm_timeout=10, interval=0.1)
+        out = sequencer.poweron()
+        self.assertEqual([i[0].nodeid for i in out], nodeids)
+        self.assertEqual([i[1][0][1] for i in out], [('', '')] * 8)
+        self.assertEqual([i[1][1][1] for i in out], [('On', '')] * 8)
+        # 1, 2 and then 4 nodes, node111 can't go with node110
+        self.assertEqual(self.waves, [['node110'], ['node111', 'node112'], ['node113', 'node114', 'node115', 'node116'],
+                                      ['node117']])
+        self.assertEqual(sequencer.scale, 1.0)
+
+    def testUnconfirmed(self):
+        """nodes that don't come on are reported, and make the next wave smaller"""
+        nodes = self.nodes(['node111', 'node112', 'node113', 'node114'], stays_off=['node111'])
+        sequencer = self.sequencer(nodes, {TOTAL: 4}, confirm_timeout=0.5, interval=0.1)
+        sequencer.scale = 0.5
+        start = time.time()
+        out = list(sequencer.iterPoweron())
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(self.waves, [['node111', 'node112'], ['node113'], ['node114']])
+        self.assertEqual(out[0][1][1][1][0], 'Off')
+        self.assertTrue(out[0][1][1][1][1].startswith('not confirmed on within'))
+        self.assertEqual([i[1][1][1] for i in out[1:]], [('On', '')] * 3)
+        self.assertEqual(sequencer.showCommands(), ['true (staggered)'] +
+                         ['touch %s (staggered)' % os.path.join(self.powered, n) for n in ['node112', 'node113',
+                                                                                          'node114']])
+
+    def testDeadline(self):
+        """nodes that did not get a wave by the deadline are reported as timed out"""
+        nodes = self.nodes(['node111', 'node112'], stays_off=['node111', 'node112'])
+        nodes.setDeadline(time.time() + 0.5)
+        sequencer = self.sequencer(nodes, {TOTAL: 1}, confirm_timeout=10, interval=0.1)
+        start = time.time()
+        out = sequencer.poweron(threaded=False)
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertEqual(self.waves, [['node111']])
+        self.assertEqual(out[1][1], [[nodes.get('node112').poweronCommand, (None, 'command timed out')]])
+
+
+class PowerStateWaiterTest(PowerTestCase):
+
+    def power(self, nodeid, delay):
+        """power on nodeid after delay seconds"""
+        timer = threading.Timer(delay, lambda: open(os.path.join(self.powered, nodeid), 'w').close())
+        timer.start()
+        return timer
+
+    def testIsPoweredOff(self):
+        """the outputs of the different power state commands"""
+        for out in ['Off', 'OFF', 'Chassis Power is off', 'system> power -state\nOff']:
+            self.assertTrue(is_powered_off(out))
+        for out in [None, '', 'On', 'Chassis Power is on', 'running testcommand: powerstate off node1.localhost']:
+            self.assertFalse(is_powered_off(out))
+
+    def testWait(self):
+        """nodes are reported as they come on, with the time it took"""
+        nodes = self.nodes(['node111', 'node112', 'node113'])
+        self.power('node111', 0)
+        timer = self.power('node112', 0.5)
+        waiter = PowerStateWaiter(nodes, timeout=1, interval=0.1, max_interval=0.2)
+        start = time.time()
+        out = list(waiter.iterWait())
+        timer.join()
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual([i[0].nodeid for i in out], ['node111', 'node112', 'node113'])
+        self.assertTrue(out[0][1][0][1][0].startswith('On after'))
+        self.assertEqual(out[0][1][0][1][1], None)
+        self.assertTrue(waiter.times[nodes.get('node112')] >= 0.5)
+        # node113 never comes on
+        self.assertEqual(out[2][1][0][1][0], 'Off')
+        self.assertTrue(out[2][1][0][1][1].startswith('not on after'))
+        self.assertEqual(waiter.stragglers, [nodes.get('node113')])
+        self.assertEqual(sorted([node.nodeid for node in waiter.times]), ['node111', 'node112'])
+
+    def testBackoff(self):
+        """the state is checked less often while no node gets there"""
+        nodes = self.nodes(['node111'])
+        waiter = PowerStateWaiter(nodes, on=False, timeout=5, interval=0.1, max_interval=0.4)
+        checks = []
+        run_commands = nodes.runCommands
+
+        def record(commands, threaded=True):
+            checks.append(time.time())
+            if len(checks) == 5:
+                os.remove(os.path.join(self.powered, 'node111'))
+            return run_commands(commands, threaded)
+        nodes.runCommands = record
+        open(os.path.join(self.powered, 'node111'), 'w').close()
+        out = waiter.wait()
+        # 0.2, 0.4 and 0.4 seconds between the checks, the node went off before the 5th
+        self.assertEqual(len(checks), 5)
+        self.assertTrue(checks[-1] - checks[0] >= 1.0)
+        self.assertTrue(out[0][1][0][1][0].startswith('Off after'))
+
+    def testCycle(self):
+        """after a power cycle, a node seen off has to be on again, one that stays on is done after the grace"""
+        nodes = self.nodes(['node111', 'node112', 'node113'])
+        for nodeid in ['node111', 'node112', 'node113']:
+            self.power(nodeid, 0).join()
+        powered = self.powered
+        timers = [threading.Timer(0.3, lambda: os.remove(os.path.join(powered, 'node111'))),
+                  threading.Timer(0.3, lambda: os.remove(os.path.join(powered, 'node113'))),
+                  self.power('node111', 0.6)]
+        for timer in timers[:2]:
+            timer.start()
+        waiter = PowerStateWaiter(nodes, timeout=1.5, interval=0.1, max_interval=0.4, cycle=True, grace=0.5)
+        out = waiter.wait()
+        for timer in timers:
+            timer.join()
+        self.assertTrue(out[0][1][0][1][0].startswith('On after'))
+        self.assertEqual(out[0][1][0][1][1], None)
+        self.assertTrue(waiter.times[nodes.get('node111')] >= 0.6)
+        # node112 stayed on, like a bmc that does not show the cycle
+        self.assertTrue(out[1][1][0][1][0].endswith('the power cycle was not seen'))
+        self.assertEqual(out[1][1][0][1][1], None)
+        self.assertTrue(0.5 <= waiter.times[nodes.get('node112')] < 1.0)
+        self.assertEqual(waiter.unseen, [nodes.get('node112')])
+        self.assertEqual(out[2][1][0][1][0], 'Off')
+        self.assertTrue(out[2][1][0][1][1].startswith('not off and on again after'))
+        self.assertEqual(waiter.stragglers, [nodes.get('node113')])
+
+    def testCycleUnseen(self):
+        """nodes that stay on during a power cycle don't wait for the full timeout"""
+        nodes = self.nodes(['node111', 'node112'])
+        for nodeid in ['node111', 'node112']:
+            self.power(nodeid, 0).join()
+        waiter = PowerStateWaiter(nodes, timeout=10, interval=0.1, max_interval=0.4, cycle=True, grace=0.3)
+        start = time.time()
+        out = waiter.wait()
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual([node for node, _, _ in out], waiter.unseen)
+        self.assertEqual(waiter.stragglers, [])
+
+    def testDeadline(self):
+        """the deadline of the compositenode ends the wait"""
+        nodes = self.nodes(['node111'])
+        nodes.setDeadline(time.time() + 0.5)
+        waiter = PowerStateWaiter(nodes, timeout=10, interval=0.1, max_interval=0.1)
+        start = time.time()
+        out = waiter.wait(threaded=False)
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertTrue(out[0][1][0][1][1].startswith('not on after'))
@@ -0,0 +1,350 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Tests for the quattor profile index and json path reader in vsc.manage.quattor
+
+@author: Jens Timmerman
+'''
+import glob
+import gzip
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+from vsc.install.testing import TestCase
+
+# use the default shipped configfile
+from vsc.manage import config
+config.DEFAULT_CONFIGFILE = os.path.join(os.path.dirname(sys.argv[0]), 'config/manage_defaults.cfg')
+# get_options will initialize
+config.get_options()
+
+from vsc.manage import quattor
+from vsc.manage.clusters import Cluster
+from vsc.manage.managecommands import Command
+from vsc.manage.nodes import CompositeNode, TestNode
+from vsc.manage.quattor import MASTER, MIN_PARALLEL, ROLE_REGEXES, STORAGE, WORKER, JsonPathReader, ProfileIndex, \
+    classify_profiles, extract_fields, extract_many, get_json_path, parse_location, read_json_paths, read_profile, \
+    scan_profiles
+from vsc.utils import fancylogger
+
+PROFILES = os.path.join(os.path.dirname(sys.argv[0]), 'test/profiles')
+
+
+def write_profile(path, location, serial='SERIAL1'):
+    """write a small gzipped profile"""
+    profile = gzip.open(path, 'w')
+    json.dump({'hardware': {'location': location, 'serialnumber': serial, 'model': 'SL 230s Gen8',
+                            'rack': {'name': 'rack1'}}}, profile)
+    profile.close()
+
+
+class ProfileIndexTest(TestCase):
+
+    def setUp(self):
+        """a directory with profiles, and one for the index"""
+        self.profiles = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.index = os.path.join(self.cache, 'profiles.json')
+        for nodeid in ['node2201', 'node2301']:
+            write_profile(os.path.join(self.profiles, '%s.shuppet.os.json.gz' % nodeid), 'mmodule02 - slot 1%s' %
+                          nodeid[-1])
+        self.parsed = []
+        self.extract = quattor.extract_fields
+
+        def extract(path, jsonpaths):
+            self.parsed.append(os.path.basename(path))
+            return self.extract(path, jsonpaths)
+        quattor.extract_fields = extract
+
+    def tearDown(self):
+        quattor.extract_fields = self.extract
+        shutil.rmtree(self.profiles)
+        shutil.rmtree(self.cache)
+
+    def profile(self, nodeid):
+        return os.path.join(self.profiles, '%s.shuppet.os.json.gz' % nodeid)
+
+    def testFields(self):
+        """the commonly used fields of a real profile, this one has no rack"""
+        fields = extract_fields(os.path.join(PROFILES, 'node2201.shuppet.os.json.gz'), ProfileIndex('').jsonpaths)
+        self.assertEqual(fields, {'location': 'shuppet hyp', 'serial': 'one/shuppet_2201',
+                                  'model': 'ONE Virtual Machine'})
+        self.assertEqual(parse_location('mmodule03 - slot 12'), (3, 12))
+        self.assertEqual(parse_location(None), (None, None))
+
+    def testGet(self):
+        """profiles are parsed once, and again when they change"""
+        index = ProfileIndex(self.index)
+        fields = index.get(self.profile('node2201'))
+        self.assertEqual((fields['chassis'], fields['slot'], fields['serial']), (2, 11, 'SERIAL1'))
+        self.assertEqual(index.get(self.profile('node2201')), fields)
+        self.assertEqual(self.parsed, ['node2201.shuppet.os.json.gz'])
+        write_profile(self.profile('node2201'), 'mmodule02 - slot 11', serial='SERIAL22')
+        os.utime(self.profile('node2201'), (1, 1))
+        self.assertEqual(index.get(self.profile('node2201'))['serial'], 'SERIAL22')
+        self.assertEqual(len(self.parsed), 2)
+
+    def testPersistent(self):
+        """the index is kept in a file for the next runs"""
+        index = ProfileIndex(self.index)
+        self.assertEqual(index.update(self.profiles), 2)
+        self.assertEqual(index.update(self.profiles), 0)
+        self.assertTrue(index.save())
+        self.assertEqual(os.listdir(self.cache), ['profiles.json'])
+
+        index = ProfileIndex(self.index)
+        self.assertEqual(index.get(self.profile('node2301'))['slot'], 11)
+        self.assertEqual(len(self.parsed), 2)
+        # profiles that are gone are dropped
+        os.unlink(self.profile('node2301'))
+        self.assertEqual(index.update(self.profiles), 0)
+        self.assertEqual(index.entries.keys(), [os.path.abspath(self.profile('node2201'))])
+        # an index for other fields is not used
+        index.jsonpaths['serial'] = 'hardware,serial'
+        index.save()
+        self.assertEqual(ProfileIndex(self.index).update(self.profiles), 1)
+
+    def testExtractMany(self):
+        """profiles parsed by a pool of processes give the same fields as parsed one by one"""
+        paths = []
+        for number in range(2201, 2201 + MIN_PARALLEL * 2):
+            paths.append(self.profile('node%d' % number))
+            write_profile(paths[-1], 'mmodule01 - slot %d' % (number % 100))
+        open(self.profile('node9999'), 'w').write('not gzipped')
+        paths.append(self.profile('node9999'))
+        jsonpaths = ProfileIndex('').jsonpaths
+        fields = extract_many(paths, jsonpaths, processes=2)
+        self.assertEqual(fields, extract_many(paths, jsonpaths, processes=1))
+        self.assertEqual(len(fields), MIN_PARALLEL * 2)
+        self.assertEqual(fields[self.profile('node2212')]['slot'], 12)
+
+        index = ProfileIndex('')
+        self.assertEqual(index.getMany(paths + [self.profile('gone')]),
+                         dict([(os.path.abspath(path), value) for path, value in fields.items()]))
+        # only node2301 was not in there yet
+        os.unlink(self.profile('node9999'))
+        self.assertEqual(index.update(self.profiles), 1)
+
+    def testCluster(self):
+        """the bulk api on a cluster, with the profiles that come with the tests"""
+        config.CONFIG['quattor_path'] = PROFILES
+        config.CONFIG['quattor_index_path'] = ''
+        cluster = Cluster.getCluster('shuppet')
+        # don't go looking for a working master
+        cluster.master = cluster._getMasters().getNodes()[0]
+        self.assertEqual(cluster.getQuattorFields({'model': 'hardware,model'}, quattor=True),
+                         {'node2201': {'model': 'ONE Virtual Machine'}})
+        self.assertEqual(cluster.getQuattorFields(quattor=True)['node2201']['serial'], 'one/shuppet_2201')
+
+    def testMemory(self):
+        """without a file the index is kept in memory"""
+        index = ProfileIndex('')
+        index.update(self.profiles)
+        self.assertTrue(index.save())
+        self.assertEqual(os.listdir(self.cache), [])
+
+
+class ScanProfilesTest(TestCase):
+
+    def testClassify(self):
+        """the same ids as matching the files with a regex per cluster and role"""
+        filenames = os.listdir(PROFILES) + ['storage3.shuppet.os.json.gz', 'node12.shuppet.os.json.gz.old',
+                                            'nodeA.shuppet.os.json.gz', 'README']
+        hosts = classify_profiles(filenames)
+        self.assertEqual(hosts['shuppet'], {WORKER: ['node12', 'node2201'], MASTER: ['master1', 'master2'],
+                                            STORAGE: ['storage3']})
+        self.assertEqual(hosts['muk'], {WORKER: ['node1001'], MASTER: ['master101', 'master102']})
+        for cluster in set([filename.split('.')[1] for filename in filenames if '.' in filename]):
+            for role, key in ROLE_REGEXES.items():
+                regex = re.compile(config.get_config("QUATTOR_FILES_TPL") % {'nodeid': config.get_config(key),
+                                                                             'clustername': cluster})
+                ids = sorted(set([regex.match(name).group('id') for name in filenames if regex.match(name)]))
+                self.assertEqual(hosts.get(cluster, {}).get(role, []), ids)
+
+    def testCache(self):
+        """the directory is scanned again when it changes"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            open(os.path.join(tmpdir, 'node1.shuppet.os.json.gz'), 'w').close()
+            os.utime(tmpdir, (1, 1))
+            hosts = scan_profiles(tmpdir)
+            self.assertEqual(hosts, {'shuppet': {WORKER: ['node1']}})
+            open(os.path.join(tmpdir, 'master1.shuppet.os.json.gz'), 'w').close()
+            os.utime(tmpdir, (1, 1))
+            self.assertTrue(scan_profiles(tmpdir) is hosts)
+            os.utime(tmpdir, (2, 2))
+            self.assertEqual(scan_profiles(tmpdir), {'shuppet': {WORKER: ['node1'], MASTER: ['master1']}})
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+# what the machines say their serial is, by node id
+SERIALS = {
+    'node2201': ('one/shuppet_2201', None),
+    'node2301': ('CZ3448JE0X\n', None),
+    'node2401': (None, 'Connection refused'),
+}
+
+
+class SerialCommand(Command):
+    """the serial of the machine, from SERIALS"""
+    def run(self):
+        return SERIALS[self.host.split('.')[0]]
+
+
+class SerialNode(TestNode):
+    def __init__(self, nodeid, clustername, masternode):
+        TestNode.__init__(self, nodeid, clustername, masternode)
+        self.customCommandClass = SerialCommand
+
+
+class QuattorColumnTest(TestCase):
+
+    def setUp(self):
+        """the profiles that come with the tests, node2401 has none"""
+        config.CONFIG['quattor_path'] = PROFILES
+        config.CONFIG['quattor_index_path'] = ''
+        self.nodes = CompositeNode()
+        for nodeid, clustername in [('node2201', 'shuppet'), ('node2301', 'phanpy'), ('node2401', 'phanpy')]:
+            self.nodes.add(SerialNode(nodeid, clustername, None))
+
+    def tearDown(self):
+        """start over with a new shared index"""
+        quattor._PROFILE_INDEX = None
+
+    def testColumn(self):
+        """a column from the index, and one that is not in there"""
+        self.assertEqual(self.nodes.getQuattorColumn('hardware, serialnumber'),
+                         {'node2201': 'one/shuppet_2201', 'node2301': 'CZ3448JE0J'})
+        self.assertEqual(self.nodes.getQuattorColumn('hardware,cards,nic,eth0,hwaddr'),
+                         {'node2201': 'AA:01:00:80:04:00', 'node2301': 'C4:34:6B:B8:A4:D4'})
+        self.assertEqual(self.nodes.getQuattorColumn('hardware,nothere'), {})
+
+    def testDiff(self):
+        """the nodes where the machine does not agree with quattor"""
+        diffs = self.nodes.diffQuattorColumn('hardware,serialnumber', 'dmidecode -s system-serial-number')
+        self.assertEqual([[node.getid(), expected, out, err] for node, expected, out, err in diffs], [
+            ['node2301', 'CZ3448JE0J', 'CZ3448JE0X', None],
+            ['node2401', None, None, 'Connection refused'],
+        ])
+
+
+# paths at the start, in the middle and at the end of the profiles, a big value, and ones that are not there
+JSONPATHS = {
+    'location': 'hardware,location',
+    'rack': 'hardware,rack,name',
+    'cards': 'hardware,cards',
+    'nic': 'hardware,cards,nic,eth0,hwaddr',
+    'kernel': 'system,kernel,version',
+    'components': 'software,components',
+    'missing': 'nothere,location',
+    'notobject': 'hardware,location,chassis',
+}
+
+
+def full_parse(path, jsonpaths):
+    """the json paths the old way, from the whole profile"""
+    tree = read_profile(path)
+    fields = {}
+    for name, jsonpath in jsonpaths.items():
+        try:
+            fields[name] = get_json_path(tree, jsonpath)
+        except (KeyError, TypeError):
+            pass
+    return fields
+
+
+class JsonPathReaderTest(TestCase):
+
+    def setUp(self):
+        self.read_size = quattor.READ_SIZE
+
+    def tearDown(self):
+        quattor.READ_SIZE = self.read_size
+
+    def testPaths(self):
+        """the same values as parsing the whole profile, whatever the block size"""
+        for path in sorted(glob.glob(os.path.join(PROFILES, '*.json.gz'))):
+            expected = full_parse(path, JSONPATHS)
+            for size in [7, 1000, self.read_size]:
+                quattor.READ_SIZE = size
+                self.assertEqual(read_json_paths(path, JSONPATHS), expected)
+
+    def testStop(self):
+        """only the start of the profile is read for the fields in hardware"""
+        path = os.path.join(PROFILES, 'node2201.shuppet.os.json.gz')
+        size = len(gzip.open(path).read())
+        reader = JsonPathReader(gzip.open(path), {'location': 'hardware,location', 'rack': 'hardware,rack,name'})
+        self.assertEqual(reader.read_paths(), {'location': 'shuppet hyp'})
+        self.assertTrue(reader.read < size / 4)
+        reader = JsonPathReader(gzip.open(path), {'kernel': 'system,kernel,version'})
+        reader.read_paths()
+        self.assertEqual(reader.read, size)
+
+    def testBroken(self):
+        """a profile that ends too soon"""
+        path = os.path.join(PROFILES, 'node2201.shuppet.os.json.gz')
+        text = gzip.open(path).read()
+        self.assertRaises(ValueError, JsonPathReader(StringIO(text[:2000]), {'kernel': 'system,kernel'}).read_paths)
+
+
+class JsonPathReaderBenchmark(TestCase):
+
+    def testBenchmark(self):
+        """the index fields from a real profile and one with a lot of software, streamed and parsed as a whole"""
+        log = fancylogger.getLogger(self.__class__.__name__)
+        jsonpaths = ProfileIndex('').jsonpaths
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(PROFILES, 'node2201.shuppet.os.json.gz')
+            tree = read_profile(path)
+            components = tree['software']['components']
+            tree['software']['components'] = dict([('%s%d' % (name, copy), value) for copy in range(40)
+                                                   for name, value in components.items()])
+            bigpath = os.path.join(tmpdir, 'big.os.json.gz')
+            big = gzip.open(bigpath, 'w')
+            json.dump(tree, big, indent=2, sort_keys=True)
+            big.close()
+
+            times = {}
+            for profile in [path, bigpath]:
+                start = time.time()
+                expected = full_parse(profile, jsonpaths)
+                times[(profile, 'full')] = time.time() - start
+                start = time.time()
+                self.assertEqual(read_json_paths(profile, jsonpaths), expected)
+                times[(profile, 'stream')] = time.time() - start
+            log.info("%s: full parse %.4fs, stream %.4fs; %d bytes: full parse %.4fs, stream %.4fs" %
+                     (os.path.basename(path), times[(path, 'full')], times[(path, 'stream')],
+                      len(gzip.open(bigpath).read()), times[(bigpath, 'full')], times[(bigpath, 'stream')]))
+            # the big profile is only bigger after the hardware, with a lot of room for a busy machine
+            self.assertTrue(times[(bigpath, 'stream')] < times[(bigpath, 'full')])
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,201 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Tests for the worker pool in vsc.manage.scheduler
+
+@author: Jens Timmerman
+'''
+import os
+import sys
+import threading
+import time
+from vsc.install.testing import TestCase
+
+# use the default shipped configfile
+from vsc.manage import config
+config.DEFAULT_CONFIGFILE = os.path.join(os.path.dirname(sys.argv[0]), 'config/manage_defaults.cfg')
+# get_options will initialize
+config.get_options()
+
+from vsc.manage.scheduler import LimitedExecutor, WorkerPool, SchedulerException, TOTAL
+
+
+class WorkerPoolTest(TestCase):
+
+    def testOrder(self):
+        """
+        results come back in submission order, whatever order the tasks finish in
+        """
+        pool = WorkerPool(4)
+        delays = [0.3, 0.1, 0.2, 0, 0.1]
+        tasks = pool.map(lambda x: time.sleep(x) or x, delays, timeout=5)
+        self.assertEqual([task.result for task in tasks], delays)
+
+    def testBounded(self):
+        """
+        no more than size tasks run at the same time
+        """
+        lock = threading.Lock()
+        state = {'running': 0, 'max': 0}
+
+        def work(_):
+            lock.acquire()
+            state['running'] += 1
+            state['max'] = max(state['max'], state['running'])
+            lock.release()
+            time.sleep(0.05)
+            lock.acquire()
+            state['running'] -= 1
+            lock.release()
+
+        pool = WorkerPool(3)
+        tasks = pool.map(work, range(20), timeout=5)
+        self.assertTrue(all(task.done for task in tasks))
+        self.assertEqual(state['max'], 3)
+
+    def testErrors(self):
+        """
+        exceptions are stored on the task
+        """
+        pool = WorkerPool(1)
+        task = pool.submit(int, 'notanint')
+        self.assertTrue(task.wait(5))
+        self.assertTrue(isinstance(task.error, ValueError))
+
+    def testTimeout(self):
+        """
+        a hanging task is abandoned and replaced, the queue keeps going
+        """
+        pool = WorkerPool(1)
+        event = threading.Event()
+        hanging = pool.submit(event.wait, 10)
+        fast = pool.submit(lambda: 'done')
+        self.assertFalse(hanging.wait(0.2))
+        pool.abandon(hanging)
+        self.assertTrue(fast.wait(1))
+        self.assertEqual(fast.result, 'done')
+        event.set()
+
+    def testThreadLimit(self):
+        """
+        workers stuck on abandoned tasks are only replaced up to the limit, the queue waits for them after that
+        """
+        pool = WorkerPool(1, limit=2)
+        event = threading.Event()
+        hanging = [pool.submit(event.wait, 10) for _ in range(3)]
+        fast = pool.submit(lambda: 'done')
+        for task in hanging[:2]:
+            self.assertFalse(task.wait(0.1))
+            pool.abandon(task)
+        self.assertEqual(pool.threads, 2)
+        self.assertFalse(fast.wait(deadline=time.time() + 0.3))
+        self.assertEqual(hanging[2].started, None)
+        event.set()
+        self.assertTrue(fast.wait(1))
+        self.assertEqual(fast.result, 'done')
+        self.assertTrue(pool.threads <= 2)
+
+    def testAsCompleted(self):
+        """
+        tasks are yielded as they are done, hanging ones when they time out
+        """
+        pool = WorkerPool(4)
+        event = threading.Event()
+        tasks = [pool.submit(event.wait, 10), pool.submit(time.sleep, 0.2), pool.submit(lambda: 'done')]
+        start = time.time()
+        order = []
+        for task in pool.as_completed(tasks, timeout=0.5):
+            order.append((tasks.index(task), task.done, round(time.time() - start, 1)))
+        self.assertEqual(order, [(2, True, 0), (1, True, 0.2), (0, False, 0.5)])
+        self.assertTrue(tasks[0].abandoned)
+        event.set()
+
+    def testDeadline(self):
+        """
+        at the deadline, tasks are given up on whether they started or not
+        """
+        pool = WorkerPool(1)
+        event = threading.Event()
+        tasks = [pool.submit(event.wait, 10), pool.submit(lambda: 'never')]
+        start = time.time()
+        done = [task.done for task in pool.as_completed(tasks, timeout=5, deadline=start + 0.3)]
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(done, [False, False])
+        self.assertFalse(pool.map(event.wait, [10], deadline=time.time() + 0.1)[0].done)
+        event.set()
+
+    def testSize(self):
+        """
+        a pool needs at least one worker
+        """
+        self.assertRaises(SchedulerException, WorkerPool, 0)
+        self.assertRaises(SchedulerException, WorkerPool, 2, 1)
+        self.assertRaises(SchedulerException, LimitedExecutor, WorkerPool(1), {'chassis': 0})
+
+    def testLimits(self):
+        """
+        tasks using the same resource wait for each other without taking up a worker, other tasks go ahead
+        """
+        lock = threading.Lock()
+        state = {'running': {}, 'max': {}, 'total': 0, 'maxtotal': 0}
+
+        def work(chassis):
+            lock.acquire()
+            state['running'][chassis] = state['running'].get(chassis, 0) + 1
+            state['max'][chassis] = max(state['max'].get(chassis, 0), state['running'][chassis])
+            state['total'] += 1
+            state['maxtotal'] = max(state['maxtotal'], state['total'])
+            lock.release()
+            time.sleep(0.1)
+            lock.acquire()
+            state['running'][chassis] -= 1
+            state['total'] -= 1
+            lock.release()
+            return chassis
+
+        executor = LimitedExecutor(WorkerPool(8), {'chassis': 2, TOTAL: 5})
+        chassis = ['chassis%s' % (i % 3) for i in range(12)]
+        start = time.time()
+        tasks = [executor.submitUsing({'chassis': name, 'other': 'ignored'}, work, name) for name in chassis]
+        self.assertEqual([task.result for task in executor.as_completed(tasks, timeout=5)].count('chassis0'), 4)
+        # 4 tasks per chassis, 2 at a time, but only 5 in total: 3 rounds
+        self.assertTrue(time.time() - start < 0.45)
+        self.assertEqual(state['max'], {'chassis0': 2, 'chassis1': 2, 'chassis2': 2})
+        self.assertEqual(state['maxtotal'], 5)
+
+        # tasks waiting for a resource don't hold up the other tasks
+        event = threading.Event()
+        hanging = [executor.submitUsing({'chassis': 'chassis0'}, event.wait, 10) for _ in range(2)]
+        held = executor.submitUsing({'chassis': 'chassis0'}, lambda: 'never')
+        held2 = executor.submitUsing({'chassis': 'chassis0'}, lambda: 'held')
+        self.assertTrue(executor.submitUsing({'chassis': 'chassis1'}, lambda: 'other').wait(1))
+        # an abandoned task that did not start yet won't run anymore
+        executor.abandon(held)
+        self.assertFalse(held2.wait(deadline=time.time() + 0.2))
+        event.set()
+        self.assertTrue(held2.wait(1))
+        self.assertEqual(held2.result, 'held')
+        self.assertFalse(held.done)
+        self.assertTrue(all([task.wait(1) for task in hanging]))
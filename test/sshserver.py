@@ -0,0 +1,199 @@
+#
+# Copyright 2016-2016 Ghent University
+#
+# This file is part of vsc-manage,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://vscentrum.be/nl/en),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-manage
+#
+# vsc-manage is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation v2.
+#
+# vsc-manage is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsc-manage.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+A small ssh server to test the ssh commands against, it runs the commands it gets locally
+
+@author: Jens Timmerman
+'''
+import socket
+import struct
+import subprocess
+import threading
+import time
+import warnings
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    import paramiko
+    from paramiko.common import cMSG_CHANNEL_SUCCESS
+
+USER = 'testuser'
+PASSWD = 'secret'
+
+_HOST_KEY = []
+
+
+def host_key():
+    """generating a key is slow, share one for all test servers"""
+    if not _HOST_KEY:
+        _HOST_KEY.append(paramiko.RSAKey.generate(1024))
+    return _HOST_KEY[0]
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    """
+    accepts password logins and runs exec and shell requests in a thread
+    the thread is only started once the exec request was answered, like sshd does,
+    otherwise the client can see the channel closing before its request succeeded
+    """
+
+    def __init__(self, server, transport):
+        self.server = server
+        self.pending = {}
+        send = transport._send_user_message
+
+        def send_user_message(message):
+            send(message)
+            data = message.asbytes()
+            if data[:1] == cMSG_CHANNEL_SUCCESS:
+                self._start(struct.unpack('>I', data[1:5])[0])
+
+        transport._send_user_message = send_user_message
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if username == USER and password == PASSWD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        if self.server.refuse_exec:
+            return False
+        self.server.commands.append(command)
+        self.pending[channel.remote_chanid] = (channel, command)
+        return True
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.server.shells += 1
+        self.pending[channel.remote_chanid] = (channel, None)
+        return True
+
+    def _start(self, remote_chanid):
+        if remote_chanid in self.pending:
+            channel, command = self.pending.pop(remote_chanid)
+            if command is None:
+                thread = threading.Thread(target=self._shell, args=(channel,))
+            else:
+                thread = threading.Thread(target=self._execute, args=(channel, command))
+            thread.setDaemon(True)
+            thread.start()
+
+    def _shell(self, channel):
+        """a line based shell showing the prompt of the server, echoing its input like a terminal does"""
+        buf = ''
+        try:
+            channel.sendall(self.server.prompt)
+            while True:
+                data = channel.recv(1024)
+                if not data:
+                    break
+                buf += data
+                while '\n' in buf:
+                    line, buf = buf.split('\n', 1)
+                    if line == 'exit':
+                        channel.close()
+                        return
+                    self.server.commands.append(line)
+                    proc = subprocess.Popen(line, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                    out = proc.communicate()[0]
+                    channel.sendall((line + '\n' + out).replace('\n', '\r\n') + self.server.prompt)
+        except Exception:
+            pass
+
+    def _execute(self, channel, command):
+        proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        try:
+            if self.server.status_first:
+                channel.send_exit_status(proc.returncode)
+                # and the output line by line
+                for line in out.splitlines(True):
+                    time.sleep(0.2)
+                    channel.sendall(line)
+                out = ''
+            channel.sendall(out)
+            channel.sendall_stderr(err)
+            if not self.server.status_first:
+                channel.send_exit_status(proc.returncode)
+            channel.close()
+        except Exception:
+            pass
+
+
+class SshServer(object):
+    """
+    ssh server listening on a random port on localhost
+    connections counts the accepted tcp connections, shells the started interactive shells
+    with status_first set, the exit status of a command is sent before its output, which comes in line by line,
+    with refuse_exec set, exec requests fail
+    """
+    def __init__(self, prompt='$ '):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(50)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        self.shells = 0
+        self.prompt = prompt
+        self.status_first = False
+        self.refuse_exec = False
+        self.commands = []
+        self.transports = []
+        thread = threading.Thread(target=self._accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except Exception:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(client)
+            transport.add_server_key(host_key())
+            transport.start_server(server=_ServerInterface(self, transport))
+            self.transports.append(transport)
+
+    def dropConnections(self):
+        """close all open connections from the server side"""
+        for transport in self.transports:
+            transport.close()
+        self.transports = []
+
+    def close(self):
+        self.dropConnections()
+        self.sock.close()